@@ -8,6 +8,7 @@ from PIL import Image, ImageTk
 import os, glob, json, argparse
 
 from constants import *
+from annotation_store import AnnotationStore
 
 COLORS = [ 'red', 'blue', 'green', 'purple', 'cyan', 'orange'  ]
 
@@ -33,6 +34,7 @@ class Annotator:
         self.currentImageKey = None
         self.currentImageIndex = None
         self.currentData = None
+        self.store = None
 
         # GUI parts - dir entry & load
         self.dirLabel = Label(self.frame, text = "Image Directory:")
@@ -105,23 +107,19 @@ class Annotator:
             self.dirEntry.delete(0, END)
             self.dirEntry.insert(END, self.imageDir)
             return
-        self.datasetFile = os.path.join(self.imageDir, "dataset.json")
-        self.dataset = {}
-        if os.path.exists(self.datasetFile):
-            with open(self.datasetFile, "r") as fp:
-                self.dataset = json.load(fp)
-            os.rename(self.datasetFile, self.datasetFile + ".orig")
+        if self.store is not None:
+            self.store.close()
+        self.store = AnnotationStore(self.imageDir)
         for i, imageFile in enumerate(self.imageList):
-            key = self.imageList[i] = os.path.basename(imageFile)
-            if key not in self.dataset:
-                self.dataset[key] = { 'file': key, 'text': "", 'bbs': [] }
-        self.save()
+            self.imageList[i] = os.path.basename(imageFile)
+        self.store.add_files(self.imageList)
+        self.store.commit()
         self.currentImageIndex = 0
         self.loadImage()
 
     def loadImage(self):
         self.currentImageKey = self.imageList[self.currentImageIndex]
-        self.currentData = self.dataset[self.currentImageKey]
+        self.currentData = self.store.get(self.currentImageKey)
 
         # load image
         imageFile = os.path.join(self.imageDir, self.currentImageKey)
@@ -151,14 +149,14 @@ class Annotator:
         return rectId
 
     def save(self):
-        if self.datasetFile is None:
+        # only the current entry is written
+        if self.store is None:
             return
         if self.currentImageKey:
             self.currentData['text'] = self.textEntry.get()
             self.currentData['bbs'].sort(key=lambda e: e[1])
-            self.dataset[self.currentImageKey] = self.currentData
-        with open(self.datasetFile, "w") as fp:
-            json.dump(self.dataset, fp, indent = 2)
+            self.store.put(self.currentData)
+            self.store.commit()
 
     def scaleDown(self, y, x):
         x = int((x - self.offsetX) / self.scale)
@@ -0,0 +1,151 @@
+import os, json, sqlite3
+
+STORE_FILE = "annotations.db"
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    file TEXT PRIMARY KEY,
+    text TEXT NOT NULL DEFAULT '',
+    bbs TEXT,
+    scores TEXT
+);
+CREATE INDEX IF NOT EXISTS annotations_unannotated ON annotations (file) WHERE text = '';
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO meta VALUES ('version', 0);
+INSERT OR IGNORE INTO meta VALUES ('id', lower(hex(randomblob(8))));
+CREATE TRIGGER IF NOT EXISTS annotations_insert AFTER INSERT ON annotations
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+CREATE TRIGGER IF NOT EXISTS annotations_update AFTER UPDATE ON annotations
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+CREATE TRIGGER IF NOT EXISTS annotations_delete AFTER DELETE ON annotations
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'version'; END;
+"""
+
+def _entry(row):
+    file, text, bbs, scores = row
+    entry = { 'file': file, 'text': text, 'bbs': json.loads(bbs) if bbs is not None else None }
+    if scores is not None:
+        entry['scores'] = json.loads(scores)
+    return entry
+
+def _row(entry):
+    scores = entry.get('scores')
+    return (entry['file'], entry.get('text') or '', json.dumps(entry.get('bbs')),
+            json.dumps(scores) if scores is not None else None)
+
+class AnnotationStore:
+    # The annotations of a data directory in an SQLite database
+    # (DIR/annotations.db), one row per image with the same fields as the
+    # entries of dataset.json. Entries with an empty text are unannotated.
+    # Writes are collected in a transaction until commit(); SQLite allows one
+    # writer at a time, so writers keep their transactions short and wait
+    # up to BUSY_TIMEOUT seconds for each other. A new store is filled from
+    # DIR/dataset.json when that file exists.
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        self.filename = os.path.join(dataset_dir, STORE_FILE)
+        exists = os.path.exists(self.filename)
+        self.db = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        json_file = os.path.join(dataset_dir, "dataset.json")
+        if not exists and os.path.exists(json_file):
+            self.import_json(json_file)
+            self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM annotations").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.db.execute("SELECT 1 FROM annotations WHERE file = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        row = self.db.execute("SELECT file, text, bbs, scores FROM annotations WHERE file = ?", (key,)).fetchone()
+        return _entry(row) if row is not None else None
+
+    def put(self, entry):
+        self.put_many([ entry ])
+
+    def put_many(self, entries):
+        self.db.executemany(
+            "INSERT INTO annotations (file, text, bbs, scores) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (file) DO UPDATE SET text = excluded.text, bbs = excluded.bbs, scores = excluded.scores",
+            map(_row, entries))
+
+    def delete_many(self, keys):
+        self.db.executemany("DELETE FROM annotations WHERE file = ?", ((key,) for key in keys))
+
+    def add_files(self, keys):
+        # registers images as unannotated unless they already have an entry
+        self.db.executemany("INSERT OR IGNORE INTO annotations (file, bbs) VALUES (?, '[]')",
+            ((key,) for key in keys))
+
+    def keys(self):
+        return [ row[0] for row in self.db.execute("SELECT file FROM annotations ORDER BY file") ]
+
+    def unannotated(self):
+        # keys of the unannotated images in name order
+        return [ row[0] for row in self.db.execute("SELECT file FROM annotations WHERE text = '' ORDER BY file") ]
+
+    def records(self, length=None):
+        # iterates over the entries in name order without loading them all;
+        # with length, only the entries whose text has that length
+        if length is None:
+            cursor = self.db.execute("SELECT file, text, bbs, scores FROM annotations ORDER BY file")
+        else:
+            cursor = self.db.execute("SELECT file, text, bbs, scores FROM annotations WHERE length(text) = ? ORDER BY file", (length,))
+        for row in cursor:
+            yield _entry(row)
+
+    def letters(self):
+        # the set of characters used in the texts
+        letters = set()
+        for text, in self.db.execute("SELECT text FROM annotations WHERE text != ''"):
+            letters.update(text)
+        return letters
+
+    def stamp(self):
+        # changes whenever an annotation is written, also across processes
+        return [ self.get_meta('id'), self.get_meta('version') ]
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def import_json(self, json_file):
+        with open(json_file, "r") as fp:
+            dataset = json.load(fp)
+        for key, entry in dataset.items():
+            entry.setdefault('file', key)
+        self.put_many(dataset.values())
+        return len(dataset)
+
+    def export_json(self, json_file):
+        # writes the entries in the schema of dataset.json
+        dataset = { entry['file']: entry for entry in self.records() }
+        with open(json_file + ".tmp", "w") as fp:
+            json.dump(dataset, fp, indent=2)
+        os.replace(json_file + ".tmp", json_file)
+        return len(dataset)
+
+# annotation_store.py
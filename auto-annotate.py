@@ -1,37 +1,65 @@
 #!/usr/bin/env python
 
-import os, json, argparse, glob
+import os, sys, argparse, itertools, multiprocessing
 import numpy as np
-from solve import Solver
+from solve import Solver, load_image, BACKENDS
+from constants import DEFAULT_BATCHSIZE
+from annotation_store import AnnotationStore
 
 DEFAULT_GPU = -1
 DEFAULT_MODEL_DIR = "prebuild-model"
 DEFAULT_DATA_DIR = "data"
 
 class AutoAnnotator:
-    def __init__(self, model_dir=DEFAULT_MODEL_DIR, data_dir=DEFAULT_DATA_DIR, gpu=-1):
+    def __init__(self, model_dir=DEFAULT_MODEL_DIR, data_dir=DEFAULT_DATA_DIR, gpu=-1, backend='chainer'):
         self.data_dir = data_dir
-        self.dataset_file = os.path.join(data_dir, "dataset.json")
-        self.solver = Solver(dirname=model_dir, gpu=gpu)
-        self.dataset = {}
-        if os.path.exists(self.dataset_file):
-            with open(self.dataset_file, "r") as fp:
-                self.dataset = json.load(fp)
-
-    def run(self):
-        for giffile in sorted(glob.glob(os.path.join(self.data_dir, "*.gif"))):
-            key = os.path.basename(giffile)
-            if key in self.dataset:
-                entry = self.dataset[key]
-                if 'text' in entry and len(entry['text']) != 0:
-                    print("{}: annotation already exists. skip.".format(key))
-                    continue
-            text, bbox, score = self.solver.solve(giffile)
-            self.dataset[key] = { 'file': key, 'text': text, 'bbs': bbox.tolist() }
-        with open(os.path.join(self.data_dir, "dataset.json"), "w") as fp:
-            json.dump(self.dataset, fp, indent=2)
-
-if __name__ == '__main__':    
+        self.solver = Solver(dirname=model_dir, gpu=gpu, backend=backend)
+        self.store = AnnotationStore(data_dir)
+
+    def pending_files(self):
+        # GIF files that have no annotation yet, in name order; an interrupted
+        # run goes on with the files it has not committed
+        self.store.add_files(e.name for e in os.scandir(self.data_dir) if e.name.endswith('.gif') and e.is_file())
+        self.store.commit()
+        return self.store.unannotated()
+
+    def run(self, batchsize=DEFAULT_BATCHSIZE, jobs=1, scores=False):
+        keys = self.pending_files()
+        n = len(keys)
+        print("{} files to annotate".format(n))
+        if n == 0:
+            return
+
+        # images are decoded by worker processes while the solver runs
+        filenames = [ os.path.join(self.data_dir, key) for key in keys ]
+        pool = None
+        if jobs == 1 or n <= batchsize:
+            images = map(load_image, filenames)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            images = pool.imap(load_image, filenames, chunksize=batchsize)
+
+        try:
+            for i in range(0, n, batchsize):
+                batch = keys[i:i+batchsize]
+                grays = list(itertools.islice(images, len(batch)))
+                entries = []
+                for key, (text, bbox, score) in zip(batch, self.solver.solve_batch(grays)):
+                    entry = { 'file': key, 'text': text, 'bbs': bbox.tolist() }
+                    if scores:
+                        entry['scores'] = [ round(float(s), 4) for s in score ]
+                    entries.append(entry)
+                # one short transaction per batch, so that annotate.py can
+                # write in between
+                self.store.put_many(entries)
+                self.store.commit()
+                print("\rannotating... {}/{}".format(min(i + batchsize, n), n), end='', file=sys.stderr)
+            print(file=sys.stderr)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Auto-Annotator')
     parser.add_argument('--data', default=DEFAULT_DATA_DIR, metavar='DIR',
                         help='data directory (default={})'.format(DEFAULT_DATA_DIR))
@@ -39,9 +67,18 @@ if __name__ == '__main__':
                         help='prebuild model directory (default={})'.format(DEFAULT_MODEL_DIR))
     parser.add_argument('--gpu', default=-1, type=int,
                         help='gpu number (default={})'.format(DEFAULT_GPU))
+    parser.add_argument('--backend', choices=BACKENDS, default='chainer',
+                        help='inference backend (default=chainer)')
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE,
+                        help='number of images solved at once (default={})'.format(DEFAULT_BATCHSIZE))
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes that decode the images (default=1, 0=all cores)')
+    parser.add_argument('--scores', action='store_true', default=False,
+                        help='store the score of every character in the annotation')
     args = parser.parse_args()
 
-    aa = AutoAnnotator(model_dir=args.model, data_dir=args.data, gpu=args.gpu)
-    aa.run()
+    aa = AutoAnnotator(model_dir=args.model, data_dir=args.data, gpu=args.gpu, backend=args.backend)
+    aa.run(batchsize=args.batchsize, jobs=args.jobs or None,
+        scores=args.scores)
 
 # end of auto-annotate.py
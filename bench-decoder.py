@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+from constants import *
+from dataset import Dataset
+from multibox_coder import DECODERS
+from solve import Solver, BACKENDS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Decoder Benchmark')
+    parser.add_argument('--model', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='annotated data directory (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--backend', choices=BACKENDS, default='chainer')
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
+    args = parser.parse_args()
+
+    dataset = Dataset(args.data)
+    images = dataset.images
+    gt_texts = [ ''.join([ dataset.class_labels[l] for l in lbs ]) for lbs in dataset.labels ]
+    print("{} annotated images".format(len(images)))
+
+    texts = {}
+    print("decoder  accuracy  decode(ms/image)")
+    for decoder in DECODERS:
+        solver = Solver(dirname=args.model, backend=args.backend, decoder=decoder, stats=True)
+        texts[decoder] = []
+        for i in range(0, len(images), args.batchsize):
+            texts[decoder].extend([ text for text, _, _ in solver.solve_batch(images[i:i+args.batchsize]) ])
+        accuracy = np.mean([ text == gt for text, gt in zip(texts[decoder], gt_texts) ])
+        print("{:8s} {:8.4f} {:17.3f}".format(decoder, accuracy, solver.stats()['stages']['nms']['per_image'] * 1000))
+
+    agree = np.mean([ a == b for a, b in zip(*[ texts[decoder] for decoder in DECODERS ]) ])
+    print("same answer: {:.4f}".format(agree))
+
+# end of bench-decoder.py
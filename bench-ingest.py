@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import os, time, random, argparse, datetime, tempfile
+from ingest import Ingester, load_config
+
+STATIONS = ("東京", "新宿", "渋谷", "品川", "上野", "池袋", "秋葉原", "横浜")
+
+def backfill(n, seed=0):
+    # n transactions with a consistent balance, oldest first, ending today;
+    # a few of them are equal to an earlier one of the same day
+    rng = random.Random(seed)
+    days = sorted(rng.randrange(n // 20 + 1) for _ in range(n))
+    today = datetime.date.today()
+    balance = 10000
+    rows = []
+    for i in range(n):
+        day = today - datetime.timedelta(days=n // 20 - days[i])
+        if balance < 1000:
+            delta = 5000
+            row = [ day.isoformat(), "ｶｰﾄﾞ", "", "", "", 0, delta ]
+        elif rng.random() < 0.2:
+            delta = -rng.randrange(100, 1000)
+            row = [ day.isoformat(), "物販", "", "", "", 0, delta ]
+        else:
+            delta = -rng.choice((140, 170, 200, 220))
+            row = [ day.isoformat(), "入", rng.choice(STATIONS), "出", rng.choice(STATIONS), 0, delta ]
+        balance += delta
+        row[5] = balance
+        rows.append(tuple(row))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Ingestion Benchmark')
+    parser.add_argument('--config', default='dbi-config.json-sqlite-sample', metavar='FILE',
+                        help='database configuration; an SQLite database is created in a temporary directory '
+                             '(default=dbi-config.json-sqlite-sample)')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='number of transactions of the backfill (default=200000)')
+    parser.add_argument('--batchsize', type=int, default=1000)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    rows = backfill(args.rows)
+    print("{} rows from {} to {}".format(len(rows), rows[0][0], rows[-1][0]))
+    print("{:28s} {:>10s} {:>12s} {:>10s}".format('case', 'seconds', 'rows/s', 'changed'))
+
+    def report(name, seconds, changed):
+        print("{:28s} {:10.3f} {:12.0f} {:10d}".format(name, seconds, len(rows) / seconds, changed))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if config['driver'].lower().endswith('sqlite'):
+            config['database'] = os.path.join(tmp, os.path.basename(config['database']))
+
+        # the way scrape.pl wrote rows: one statement per row
+        with Ingester(config, batchsize=1) as ingester:
+            cursor = ingester.db.cursor()
+            changed = 0
+            start = time.perf_counter()
+            for row in rows:
+                cursor.execute(ingester.insert, row + (None,))
+                changed += cursor.rowcount
+            ingester.summary.update(cursor)
+            ingester.db.commit()
+            report('row by row', time.perf_counter() - start, changed)
+            for t in ('', '_daily', '_monthly', '_station', '_type', '_breaks'):
+                cursor.execute("DELETE FROM {}{}".format(ingester.table, t))
+            cursor.execute("UPDATE {}_state SET value = 0".format(ingester.table))
+            ingester.db.commit()
+
+        with Ingester(config, batchsize=args.batchsize) as ingester:
+            start = time.perf_counter()
+            _, changed = ingester.ingest(rows)
+            report('executemany', time.perf_counter() - start, changed)
+
+            start = time.perf_counter()
+            _, changed = ingester.ingest(rows)
+            report('executemany, all existing', time.perf_counter() - start, changed)
+
+            # one more day of a daily scrape
+            today = datetime.date.fromisoformat(rows[-1][0])
+            day = [ ((today + datetime.timedelta(days=1)).isoformat(),) + row[1:] for row in rows[-20:] ]
+            start = time.perf_counter()
+            _, changed = ingester.ingest(day)
+            print("{:28s} {:10.3f} {:>12s} {:10d}".format('one more day', time.perf_counter() - start, '', changed))
+
+            cursor = ingester.db.cursor()
+            cursor.execute("SELECT count(*) FROM {}".format(ingester.table))
+            count = cursor.fetchone()[0]
+            print("{} rows in the table".format(count))
+
+            # a monthly report from the whole table and from the summary
+            start = time.perf_counter()
+            cursor.execute("SELECT substr(date, 1, 7), count(*), sum(CASE WHEN delta < 0 THEN -delta ELSE 0 END),"
+                " sum(CASE WHEN delta > 0 THEN delta ELSE 0 END) FROM {} GROUP BY 1 ORDER BY 1".format(ingester.table))
+            scanned = cursor.fetchall()
+            middle = time.perf_counter()
+            summarized = ingester.summary.monthly()
+            end = time.perf_counter()
+            assert scanned == [ tuple(m.values()) for m in summarized ]
+            print("monthly report: {:.3f} ms from the table, {:.3f} ms from the summary".format(
+                (middle - start) * 1000, (end - middle) * 1000))
+
+# end of bench-ingest.py
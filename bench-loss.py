@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import time, argparse
+import numpy as np
+import chainer
+
+from multibox_loss import multibox_loss, _hard_negative
+from multibox_coder import MultiboxCoder
+from constants import *
+
+def hard_negative_argsort(x, positive, k):
+    # the former implementation, ranking every row with two full sorts
+    rank = (x * (positive - 1)).argsort(axis=1).argsort(axis=1)
+    hard_negative = rank < (positive.sum(axis=1) * k)[:, np.newaxis]
+    return hard_negative
+
+def measure(func, repeat):
+    func()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - t) / repeat * 1000
+
+def make_batch(batchsize, n_bbox, n_class, rs):
+    # about NCHARS positives per image, like the captcha targets
+    mb_locs = rs.randn(batchsize, n_bbox, 4).astype(np.float32)
+    gt_mb_locs = rs.randn(batchsize, n_bbox, 4).astype(np.float32)
+    mb_confs = rs.randn(batchsize, n_bbox, n_class + 1).astype(np.float32)
+    positive = rs.rand(batchsize, n_bbox) < NCHARS / n_bbox
+    gt_mb_labels = (rs.randint(1, n_class + 1, (batchsize, n_bbox)) * positive).astype(np.int32)
+    return mb_locs, mb_confs, gt_mb_locs, gt_mb_labels
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Hard Negative Mining Benchmark')
+    parser.add_argument('--batchsizes', default='8,32,128')
+    parser.add_argument('--grids', default='6x20,12x40,24x80',
+                        help='grid sizes; the number of default boxes is rows * cols * (1 + aspect ratios)')
+    parser.add_argument('--n_class', type=int, default=33)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(0)
+    print('batch  boxes  argsort(ms)  select(ms)  loss(ms)  fused(ms)')
+    for grid in args.grids.split(','):
+        rows, cols = map(int, grid.split('x'))
+        n_bbox = len(MultiboxCoder(grids=((rows, cols),), aspect_ratios=DEFAULT_ASPECT_RATIOS,
+            variance=DEFAULT_VARIANCE).default_bbox)
+        for batchsize in map(int, args.batchsizes.split(',')):
+            mb_locs, mb_confs, gt_mb_locs, gt_mb_labels = make_batch(batchsize, n_bbox, args.n_class, rs)
+            x = rs.rand(batchsize, n_bbox).astype(np.float32)
+            positive = gt_mb_labels > 0
+            if not (hard_negative_argsort(x, positive, args.k) == _hard_negative(x, positive, args.k)).all():
+                raise AssertionError('the hard negatives differ')
+
+            def loss(fused):
+                mb_confs_var = chainer.Variable(mb_confs)
+                loc_loss, conf_loss = multibox_loss(mb_locs, mb_confs_var, gt_mb_locs, gt_mb_labels, args.k, fused=fused)
+                (loc_loss + conf_loss).backward()
+
+            print('{:5d} {:6d} {:12.3f} {:11.3f} {:9.3f} {:10.3f}'.format(batchsize, n_bbox,
+                measure(lambda: hard_negative_argsort(x, positive, args.k), args.repeat),
+                measure(lambda: _hard_negative(x, positive, args.k), args.repeat),
+                measure(lambda: loss(False), args.repeat),
+                measure(lambda: loss(True), args.repeat)))
+
+# end of bench-loss.py
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import sys, time, argparse
+import numpy as np
+from constants import *
+from solve import Solver, BACKENDS
+from scrape import SuicaClient, ScrapeError
+from mock_suica import MockSuica, load_captchas
+
+CREDENTIALS = { 'user': 'user@example.com', 'password': 'password' }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Scraper Benchmark')
+    parser.add_argument('--model', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='annotated captchas served by the mock site (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--backend', choices=BACKENDS, default='chainer')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='number of scrapes with each setting (default=20)')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='seconds the mock site takes for each response (default=0.05)')
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0.3,
+                        help='probability that the mock site refuses a right answer (default=0.3)')
+    args = parser.parse_args()
+
+    solver = Solver(dirname=args.model, backend=args.backend)
+    print("prefetch  ok/runs  ms/scrape  captchas/login  requests/scrape  connections")
+    for prefetch in (False, True):
+        site = MockSuica(load_captchas(args.data), CREDENTIALS, delay=args.delay, fail_rate=args.fail_rate)
+        server = site.serve()
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        times = []
+        ok = 0
+        with SuicaClient(solver, CREDENTIALS, url=url, prefetch=prefetch) as client:
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                try:
+                    client.login()
+                    client.statement()
+                    ok += 1
+                except ScrapeError as e:
+                    print(e, file=sys.stderr)
+                times.append(time.perf_counter() - start)
+        server.shutdown()
+        server.server_close()
+        c = site.counters
+        print("{:8s} {:4d}/{:<4d} {:10.1f} {:15.2f} {:16.2f} {:12d}".format(str(prefetch), ok, args.runs,
+            np.mean(times) * 1000, c['captchas'] / max(ok, 1), c['requests'] / args.runs, c['connections']))
+
+# end of bench-scrape.py
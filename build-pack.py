@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+import os, argparse
+from constants import *
+from dataset import build_pack, PACK_DIR
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Dataset Packer')
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='data directory (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of decoding processes (default=all cores)')
+    args = parser.parse_args()
+
+    if build_pack(args.data, jobs=args.jobs):
+        print("{}: updated".format(os.path.join(args.data, PACK_DIR)))
+    else:
+        print("{}: up to date".format(os.path.join(args.data, PACK_DIR)))
+
+# end of build-pack.py
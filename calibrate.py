@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import os, re, sys, json, argparse
+import numpy as np
+from constants import *
+from dataset import Dataset
+from solve import Solver, BACKENDS
+from calibration import Calibration, features, fit_logistic, choose_threshold
+
+DEFAULT_LOG_FILE = "log/scrape.log"
+
+def read_scrape_log(log_file, data_dir):
+    # (file, submitted text, success) of the logins recorded by scrape.pl
+    # whose captcha image was archived
+    samples = []
+    with open(log_file, "r", encoding="utf-8") as fp:
+        for line in fp:
+            m = re.match(r'^"([^"]*)","([^"]*)",([01])', line)
+            if not m:
+                continue
+            filename, text, ok = m.group(1), m.group(2), m.group(3) == '1'
+            if not os.path.isfile(filename):
+                filename = os.path.join(data_dir, os.path.basename(filename))
+                if not os.path.isfile(filename):
+                    continue
+            samples.append((filename, text, ok))
+    return samples
+
+def solve_all(solver, images, batchsize):
+    results = []
+    for i in range(0, len(images), batchsize):
+        results.extend(solver.solve_batch(images[i:i+batchsize]))
+    return results
+
+def collect(solver, images, texts, samples, batchsize):
+    # (scores, correct) of the held-out images and of the logins: a success
+    # tells the right answer; a failure only counts when the model still
+    # gives the same answer
+    scores = []
+    correct = []
+    for (text, _, score), gt in zip(solve_all(solver, images, batchsize), texts):
+        scores.append(score)
+        correct.append(text == gt)
+    results = solve_all(solver, [ filename for filename, _, _ in samples ], batchsize)
+    n_log = 0
+    for (filename, submitted, ok), (text, _, score) in zip(samples, results):
+        if ok or text == submitted:
+            scores.append(score)
+            correct.append(ok and text == submitted)
+            n_log += 1
+    return scores, np.array(correct, dtype=bool), n_log
+
+def fit(scores, correct):
+    # the calibration, or None without both right and wrong answers
+    complete = np.array([ len(s) >= NCHARS for s in scores ], dtype=bool)
+    if len(correct) == 0 or len(np.unique(correct[complete])) < 2:
+        return None
+    X = features([ s[:NCHARS] for s, c in zip(scores, complete) if c ])
+    coef, intercept = fit_logistic(X, correct[complete])
+    return Calibration(coef, intercept)
+
+def write_calibration(model_dir, calibration):
+    metadata_file = os.path.join(model_dir, "model.json")
+    with open(metadata_file, 'r') as fp:
+        metadata = json.load(fp)
+    metadata['calibration'] = calibration
+    with open(metadata_file, "w") as fp:
+        json.dump(metadata, fp, sort_keys=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Confidence Calibrator')
+    parser.add_argument('--model', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='annotated data directory (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--log', default=DEFAULT_LOG_FILE, metavar='FILE',
+                        help='login history of scrape.pl (default={})'.format(DEFAULT_LOG_FILE))
+    parser.add_argument('--backend', choices=BACKENDS, default='chainer')
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
+    parser.add_argument('--fetch-cost', dest='fetch_cost', type=float, default=2,
+                        help='requests to get a new captcha (default=2)')
+    parser.add_argument('--submit-cost', dest='submit_cost', type=float, default=1,
+                        help='requests to submit the login form (default=1)')
+    args = parser.parse_args()
+
+    solver = Solver(dirname=args.model, backend=args.backend)
+
+    # the held-out part of the annotated data (the validation split of train.py)
+    dataset = Dataset(args.data)
+    with open(os.path.join(args.model, "model.json"), 'r') as fp:
+        metadata = json.load(fp)
+    _, held_out = dataset.split(**metadata.get('split', { 'mode': 'fixed' }))
+    images = dataset.images[held_out]
+    texts = [ ''.join([ dataset.class_labels[l] for l in lbs ]) for lbs in dataset.labels[held_out] ]
+    samples = read_scrape_log(args.log, args.data) if os.path.isfile(args.log) else []
+
+    scores, correct, n_log = collect(solver, images, texts, samples, args.batchsize)
+    print("{} held-out images".format(len(texts)))
+    if samples:
+        print("{} logins from {}".format(n_log, args.log))
+    calibration = fit(scores, correct)
+    if calibration is None:
+        print("cannot calibrate: both right and wrong answers are needed")
+        exit(1)
+    confidence = calibration(scores)
+
+    reject_thresh, cost = choose_threshold(confidence, correct, args.fetch_cost, args.submit_cost)
+    base_cost = (len(correct) * (args.fetch_cost + args.submit_cost)) / max(correct.sum(), 1)
+    rejected = confidence < reject_thresh
+    print("accuracy {:.4f}, mean confidence {:.4f}, brier score {:.4f}".format(
+        correct.mean(), confidence.mean(), np.mean((confidence - correct) ** 2)))
+    print("reject threshold {:.4f}: rejects {:.1%} of the captchas ({:.1%} of them right)".format(
+        reject_thresh, rejected.mean(), correct[rejected].mean() if rejected.any() else 0))
+    print("requests per successful login: {:.3f} -> {:.3f}".format(base_cost, cost))
+    write_calibration(args.model, dict(calibration.to_dict(), reject_thresh=reject_thresh,
+        samples=len(correct), backend=args.backend))
+
+    # the small model of the cascade has scores of its own; its answers are
+    # calibrated on the same samples so that solve.py --cascade can compare
+    # the confidence of either model with the thresholds
+    if 'cascade' in metadata:
+        small_dir = os.path.join(args.model, metadata['cascade']['dir'])
+        small = Solver(dirname=small_dir, backend=args.backend)
+        scores, correct, _ = collect(small, images, texts, samples, args.batchsize)
+        calibration = fit(scores, correct)
+        if calibration is None:
+            print("cannot calibrate the cascade model: both right and wrong answers are needed")
+            exit(1)
+        confidence = calibration(scores)
+        print("cascade model: accuracy {:.4f}, mean confidence {:.4f}, brier score {:.4f}".format(
+            correct.mean(), confidence.mean(), np.mean((confidence - correct) ** 2)))
+        write_calibration(small_dir, dict(calibration.to_dict(), samples=len(correct), backend=args.backend))
+
+# end of calibrate.py
@@ -0,0 +1,89 @@
+import numpy as np
+
+from constants import *
+
+# A whole-string confidence computed from the scores of the detected
+# characters: logistic regression on the sum of the log scores and the log
+# of the smallest score. A string with fewer than NCHARS characters has
+# confidence 0. Without fitted coefficients the product of the scores is
+# used.
+
+EPSILON = 1e-6
+
+def features(scores):
+    # (N, NCHARS) scores -> (N, 2) features
+    log_scores = np.log(np.maximum(np.asarray(scores, dtype=np.float64), EPSILON))
+    return np.stack([ log_scores.sum(axis=1), log_scores.min(axis=1) ], axis=1)
+
+def fit_logistic(X, y, l2=1e-3, n_iter=100):
+    # Newton's method on the L2-regularized log loss; returns (coef, intercept)
+    X = np.concatenate([ X, np.ones((len(X), 1)) ], axis=1)
+    y = np.asarray(y, dtype=np.float64)
+    w = np.zeros(X.shape[1])
+    penalty = np.full(X.shape[1], l2)
+    penalty[-1] = 0
+    for _ in range(n_iter):
+        p = 1 / (1 + np.exp(-X @ w))
+        gradient = X.T @ (p - y) + penalty * w
+        hessian = (X * (p * (1 - p))[:, None]).T @ X + np.diag(penalty)
+        step = np.linalg.solve(hessian + 1e-9 * np.eye(len(w)), gradient)
+        w -= step
+        if np.abs(step).max() < 1e-8:
+            break
+    return w[:-1], w[-1]
+
+def choose_threshold(confidence, correct, fetch_cost=2, submit_cost=1, fail_cost=0):
+    # The rejection threshold that minimizes the expected number of requests
+    # per successful login on the given samples, when every captcha costs
+    # fetch_cost requests (login page and image), every submission
+    # submit_cost, and every failed submission fail_cost more.
+    # Returns (threshold, cost); threshold 0 means never reject.
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=bool)
+    order = np.argsort(-confidence, kind='stable')
+    confidence = confidence[order]
+    correct = correct[order]
+    n = len(confidence)
+    # submitting the first k samples in order of confidence
+    submitted = np.arange(1, n + 1)
+    succeeded = np.cumsum(correct)
+    cost = (n * fetch_cost + submitted * submit_cost + (submitted - succeeded) * fail_cost) / np.maximum(succeeded, 1)
+    cost[succeeded == 0] = np.inf
+    # only cut between different confidence values
+    cut = np.append(confidence[1:] < confidence[:-1], True)
+    cost[~cut] = np.inf
+    k = int(np.argmin(cost))
+    threshold = 0.0 if k == n - 1 else float(confidence[k])
+    return threshold, float(cost[k])
+
+class Calibration:
+    def __init__(self, coef=None, intercept=0.0):
+        self.coef = None if coef is None else np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+
+    @classmethod
+    def from_dict(cls, d):
+        if d is None:
+            return cls()
+        return cls(d['coef'], d['intercept'])
+
+    def to_dict(self):
+        return { 'coef': self.coef.tolist(), 'intercept': self.intercept }
+
+    @property
+    def fitted(self):
+        return self.coef is not None
+
+    def __call__(self, scores):
+        # list of per-character score arrays -> (N,) confidence
+        confidence = np.zeros(len(scores))
+        complete = [ i for i, s in enumerate(scores) if len(s) >= NCHARS ]
+        if complete:
+            X = features([ scores[i][:NCHARS] for i in complete ])
+            if self.fitted:
+                confidence[complete] = 1 / (1 + np.exp(-(X @ self.coef + self.intercept)))
+            else:
+                confidence[complete] = np.exp(X[:, 0])
+        return confidence
+
+# calibration.py
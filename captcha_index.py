@@ -0,0 +1,127 @@
+import os, re, hashlib, sqlite3, threading
+
+INDEX_FILE = "captchas.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captchas (
+    sha1 TEXT PRIMARY KEY,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO meta VALUES ('counter', 0);
+INSERT OR IGNORE INTO meta VALUES ('fetched', 0);
+INSERT OR IGNORE INTO meta VALUES ('duplicates', 0);
+"""
+
+def _number(filename):
+    m = re.match(r'^(\d+)\.gif$', filename)
+    return int(m.group(1)) if m else None
+
+class CaptchaIndex:
+    # The captcha images of a directory (DIR/NNNNN.gif) by the SHA-1 of
+    # their content, in DIR/captchas.db. add() saves an image under the
+    # next number unless the same image is already there. The next number
+    # and the fetched and duplicate counts are kept in the database, so an
+    # interrupted harvest continues where it stopped. Images saved after the
+    # last commit are indexed again when the index is opened. Thread-safe.
+    def __init__(self, dirname, commit_every=100):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(dirname, INDEX_FILE), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.counter = self._get('counter')
+        self.fetched = self._get('fetched')
+        self.duplicates = self._get('duplicates')
+        self._uncommitted = 0
+        self._index_files()
+
+    def _get(self, key):
+        return self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def _index_files(self):
+        # the files from the counter on were saved without a commit, or by
+        # another program such as getcaptcha.pl
+        numbers = sorted(n for n in map(_number, os.listdir(self.dirname)) if n is not None and n >= self.counter)
+        for n in numbers:
+            filename = "{:05d}.gif".format(n)
+            with open(os.path.join(self.dirname, filename), "rb") as fp:
+                digest = hashlib.sha1(fp.read()).hexdigest()
+            self.db.execute("INSERT OR IGNORE INTO captchas VALUES (?, ?)", (digest, filename))
+            self.counter = n + 1
+        self.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM captchas").fetchone()[0]
+
+    def __contains__(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM captchas WHERE sha1 = ?", (digest,)).fetchone() is not None
+
+    def _save(self, digest, data):
+        # creates the file of the next number that is free and returns its
+        # name; a file that another program, such as getcaptcha.pl or the
+        # Archiver of solve.py, saved in the meantime is never overwritten
+        # but indexed, and None is returned when it is the same image
+        while True:
+            filename = "{:05d}.gif".format(self.counter)
+            path = os.path.join(self.dirname, filename)
+            self.counter += 1
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                with open(path, "rb") as fp:
+                    other = hashlib.sha1(fp.read()).hexdigest()
+                self.db.execute("INSERT OR IGNORE INTO captchas VALUES (?, ?)", (other, filename))
+                if other == digest:
+                    return None
+                continue
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            return filename
+
+    def add(self, data):
+        # returns the file name of the saved image, or None for a duplicate
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.fetched += 1
+            filename = None
+            if self.db.execute("SELECT 1 FROM captchas WHERE sha1 = ?", (digest,)).fetchone() is None:
+                filename = self._save(digest, data)
+            if filename is None:
+                self.duplicates += 1
+            else:
+                self.db.execute("INSERT INTO captchas VALUES (?, ?)", (digest, filename))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._commit()
+        return filename
+
+    def _commit(self):
+        self.db.executemany("UPDATE meta SET value = ? WHERE key = ?",
+            [ (self.counter, 'counter'), (self.fetched, 'fetched'), (self.duplicates, 'duplicates') ])
+        self.db.commit()
+        self._uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# captcha_index.py
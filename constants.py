@@ -20,4 +20,7 @@ DEFAULT_FREQUENCY = 10
 DEFAULT_SCORE_THRESH = 0.1
 DEFAULT_NMS_THRESH = 0.45
 
+CASCADE_DIR = "small"
+DEFAULT_CASCADE_THRESH = 0.9
+
 # constants.py
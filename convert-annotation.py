@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import os, argparse
+from annotation_store import AnnotationStore, STORE_FILE
+from constants import *
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Annotation Importer/Exporter')
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='data directory (default={})'.format(DEFAULT_DATASET_DIR))
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--import', dest='import_file', metavar='FILE',
+                       help='add or replace the entries of a dataset.json file')
+    group.add_argument('--export', dest='export_file', metavar='FILE',
+                       help='write every entry to a file in the dataset.json format')
+    args = parser.parse_args()
+
+    with AnnotationStore(args.data) as store:
+        if args.import_file:
+            n = store.import_json(args.import_file)
+            store.commit()
+            print("{} entries imported into {}".format(n, os.path.join(args.data, STORE_FILE)))
+        else:
+            n = store.export_json(args.export_file)
+            print("{} entries exported to {}".format(n, args.export_file))
+
+# end of convert-annotation.py
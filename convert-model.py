@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import os, json, argparse
+from constants import *
+from numpy_ssd import load_params
+from weights import save_weights, load_weights
+
+WEIGHTS_FILE = "model.weights"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Model Converter')
+    parser.add_argument('--model', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    args = parser.parse_args()
+
+    metadata_file = os.path.join(args.model, "model.json")
+    with open(metadata_file, 'r') as fp:
+        metadata = json.load(fp)
+
+    params = load_params(os.path.join(args.model, metadata['file']))
+    weights_file = os.path.join(args.model, WEIGHTS_FILE)
+    save_weights(weights_file + ".tmp", params)
+    loaded = load_weights(weights_file + ".tmp")
+    for name, a in params.items():
+        if not (loaded[name] == a).all():
+            raise ValueError("{}: verification failed".format(name))
+    del loaded
+    os.replace(weights_file + ".tmp", weights_file)
+    print("{}: {} arrays written".format(weights_file, len(params)))
+
+    metadata['weights_file'] = WEIGHTS_FILE
+    metadata['formats'] = sorted(set(metadata.get('formats', ['npz'])) | {'weights'})
+    with open(metadata_file, "w") as fp:
+        json.dump(metadata, fp, sort_keys=True)
+
+# end of convert-model.py
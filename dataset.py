@@ -1,48 +1,147 @@
-import os, json, cv2
+import os, sys, json, cv2, multiprocessing
 from chainer.datasets.tuple_dataset import TupleDataset
 import numpy as np
 
 from constants import *
 from multibox_coder import MultiboxCoder
+from annotation_store import AnnotationStore
+from image_hash import HashIndex, group_near_duplicates, DEFAULT_RADIUS
 
-class Dataset(TupleDataset):
-    def __init__(self, dataset_dir):
-        dataset_file = os.path.join(dataset_dir, "dataset.json")
-        with open(dataset_file, 'r') as fp:
-            metadata = json.load(fp)
-
-        class_ids = {}
-        for entry in metadata.values():
-            for letter in entry['text']:
-                class_ids[letter] = 1
-        for i, letter in enumerate(sorted(class_ids.keys())):
-            class_ids[letter] = i
-
-        img_data = []
-        bbs_data = []
-        lbs_data = []
-        count = 0
-        for entry in metadata.values():
-            image_file = entry['file']
+PACK_DIR = "pack"
+SPLIT_MODES = ('fixed', 'group')
+
+def read_gray(image_file):
+    gif = cv2.VideoCapture(image_file)
+    ok, color_image = gif.read()
+    if not ok:
+        raise IOError("{}: cannot read the image".format(image_file))
+    return cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
+
+def read_images(filenames, out, rows=None, jobs=None, verbose=True):
+    # Decodes the files into out[rows[i]] (out[i] if rows is None), using a
+    # pool of jobs worker processes (all cores if None) unless jobs is 1.
+    n = len(filenames)
+    if rows is None:
+        rows = range(n)
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or n <= 1:
+        images = map(read_gray, filenames)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        chunksize = max(1, min(64, n // (jobs * 4)))
+        images = pool.imap(read_gray, filenames, chunksize=chunksize)
+    try:
+        for i, gray in enumerate(images):
+            out[rows[i]] = gray
+            if verbose and ((i + 1) % 1000 == 0 or i + 1 == n):
+                print("\rdecoding images... {}/{}".format(i + 1, n), end='', file=sys.stderr)
+        if verbose and n > 0:
+            print(file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def read_annotations(dataset_dir):
+    # Returns the class id table and the usable records of the annotation
+    # store in file order. Class ids are assigned over every record, usable
+    # or not.
+    with AnnotationStore(dataset_dir) as store:
+        class_ids = { letter: i for i, letter in enumerate(sorted(store.letters())) }
+        records = []
+        for entry in store.records(length=NCHARS):
             bbs = entry['bbs']
-            text = entry['text']
-            if bbs is None or len(bbs) != NCHARS or len(text) != NCHARS:
+            if bbs is None or len(bbs) != NCHARS:
                 continue
-            count += 1
-            gif = cv2.VideoCapture(os.path.join(dataset_dir, image_file))
-            _, color_image = gif.read(0)
-            gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
-            h, w = gray_image.shape[:2]
-            img = np.array(gray_image / 255.0, dtype=np.float32).reshape(1, h, w)
-            img_data.append(img)
+            records.append(entry)
+
+    return class_ids, records
+
+def _stamp(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+def build_pack(dataset_dir, jobs=None):
+    # Packs the images of the usable records into one uint8 array with the
+    # boxes and labels in parallel arrays. Nothing is done while the
+    # annotation store is unchanged; otherwise only images that are new or
+    # modified since the last build are decoded, and the others are copied
+    # from the old pack.
+    pack_dir = os.path.join(dataset_dir, PACK_DIR)
+    index_file = os.path.join(pack_dir, "index.json")
+    images_file = os.path.join(pack_dir, "images.npy")
+    with AnnotationStore(dataset_dir) as store:
+        dataset_stamp = store.stamp()
 
-            bbs = np.array(bbs, dtype=np.float32)
-            bbs_data.append(bbs)
+    old_index = None
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as fp:
+            old_index = json.load(fp)
+        if old_index['dataset'] == dataset_stamp:
+            return False
 
-            lbs = np.array(list(map(lambda e: class_ids[e], text)), dtype=np.int32)
-            lbs_data.append(lbs)
+    class_ids, records = read_annotations(dataset_dir)
+    files = [ entry['file'] for entry in records ]
+    stats = { f: _stamp(os.path.join(dataset_dir, f)) for f in files }
 
-        self._count = count
+    reuse = {}
+    if old_index is not None:
+        old_images = np.load(images_file, mmap_mode='r')
+        for row, f in enumerate(old_index['files']):
+            if stats.get(f) == old_index['stat'].get(f):
+                reuse[f] = row
+        os.remove(index_file)
+    os.makedirs(pack_dir, exist_ok=True)
+
+    images = np.lib.format.open_memmap(images_file + ".tmp",
+        mode='w+', dtype=np.uint8, shape=(len(files), IMAGE_HEIGHT, IMAGE_WIDTH))
+    new_rows = []
+    for i, f in enumerate(files):
+        if f in reuse:
+            images[i] = old_images[reuse[f]]
+        else:
+            new_rows.append(i)
+    read_images([ os.path.join(dataset_dir, files[i]) for i in new_rows ], images, rows=new_rows, jobs=jobs)
+    images.flush()
+    del images
+
+    bbs = np.array([ entry['bbs'] for entry in records ], dtype=np.float32).reshape(-1, NCHARS, 4)
+    lbs = np.array([ [ class_ids[c] for c in entry['text'] ] for entry in records ], dtype=np.int32).reshape(-1, NCHARS)
+    np.save(os.path.join(pack_dir, "bbs.npy"), bbs)
+    np.save(os.path.join(pack_dir, "labels.npy"), lbs)
+    os.replace(images_file + ".tmp", images_file)
+
+    class_labels = sorted(class_ids.keys(), key=lambda x: class_ids[x])
+    index = { 'dataset': dataset_stamp, 'files': files, 'stat': stats, 'class_labels': class_labels }
+    with open(index_file + ".tmp", 'w') as fp:
+        json.dump(index, fp)
+    os.replace(index_file + ".tmp", index_file)
+    return True
+
+class Dataset(TupleDataset):
+    def __init__(self, dataset_dir, packed=True, jobs=None):
+        if packed:
+            build_pack(dataset_dir, jobs=jobs)
+            pack_dir = os.path.join(dataset_dir, PACK_DIR)
+            with open(os.path.join(pack_dir, "index.json"), 'r') as fp:
+                index = json.load(fp)
+            class_labels = index['class_labels']
+            files = index['files']
+            class_ids = { l: i for i, l in enumerate(class_labels) }
+            img_data = np.load(os.path.join(pack_dir, "images.npy"), mmap_mode='r')
+            bbs_data = np.load(os.path.join(pack_dir, "bbs.npy"))
+            lbs_data = np.load(os.path.join(pack_dir, "labels.npy"))
+        else:
+            class_ids, records = read_annotations(dataset_dir)
+            files = [ entry['file'] for entry in records ]
+            img_data = np.zeros((len(records), IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint8)
+            read_images([ os.path.join(dataset_dir, entry['file']) for entry in records ], img_data, jobs=jobs)
+            bbs_data = np.array([ entry['bbs'] for entry in records ], dtype=np.float32).reshape(-1, NCHARS, 4)
+            lbs_data = np.array([ [ class_ids[c] for c in entry['text'] ] for entry in records ], dtype=np.int32).reshape(-1, NCHARS)
+
+        self._dataset_dir = dataset_dir
+        self._files = files
+        self._count = len(img_data)
         self._n_class = len(class_ids)
         self._class_ids = class_ids
         self._class_labels = [ l for l in sorted(class_ids.keys(), key=lambda x: class_ids[x]) ]
@@ -65,6 +164,50 @@ class Dataset(TupleDataset):
     def class_labels(self):
         return self._class_labels
 
+    @property
+    def images(self):
+        return self._img_data
+
+    @property
+    def bboxes(self):
+        return self._bbs_data
+
+    @property
+    def labels(self):
+        return self._lbs_data
+
+    @property
+    def files(self):
+        return self._files
+
+    def groups(self, radius=DEFAULT_RADIUS):
+        # group id of every record; near-identical images share a group. The
+        # hashes are those of dedupe-captcha.py, cached in DIR/phash.json
+        index = HashIndex(self._dataset_dir)
+        index.update(verbose=False)
+        return group_near_duplicates(index.hashes(self._files), radius)
+
+    def split(self, ratio=0.9, mode='fixed', radius=DEFAULT_RADIUS, seed=0):
+        # Returns the indices of the training and the validation records.
+        # 'fixed' takes the first ratio of the records for training; 'group'
+        # puts whole groups of near duplicates on one side or the other, in
+        # an order shuffled with seed, so that no image is validated against
+        # a copy of itself.
+        n_data = len(self)
+        thresh = int(n_data * ratio + 0.5)
+        if mode == 'fixed':
+            return np.arange(thresh), np.arange(thresh, n_data)
+        if mode != 'group':
+            raise ValueError('unknown split mode: {}'.format(mode))
+        groups = self.groups(radius)
+        sizes = np.bincount(groups)
+        order = np.random.RandomState(seed).permutation(len(sizes))
+        n_test = np.searchsorted(np.cumsum(sizes[order]), n_data - thresh) + 1
+        if n_test >= len(sizes):
+            raise ValueError('cannot split {} records in {} groups'.format(n_data, len(sizes)))
+        test = np.isin(groups, order[:n_test])
+        return np.flatnonzero(~test), np.flatnonzero(test)
+
     def __getitem__(self, index):
         if isinstance(index, slice):
             current, stop, step = index.indices(len(self))
@@ -75,4 +218,6 @@ class Dataset(TupleDataset):
             return self.get_example(index)
 
     def get_example(self, i):
-        return self._img_data[i], self._bbs_data[i], self._lbs_data[i]
+        # images are kept as uint8 and converted when they are fetched
+        img = np.array(self._img_data[i] / 255.0, dtype=np.float32)
+        return img.reshape(1, *img.shape), self._bbs_data[i], self._lbs_data[i]
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os, time, argparse, collections
+import numpy as np
+from constants import *
+from image_hash import HashIndex, group_near_duplicates, DEFAULT_RADIUS
+from annotation_store import AnnotationStore
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Near-Duplicate Finder')
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='captcha image directory (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--radius', type=int, default=DEFAULT_RADIUS,
+                        help='largest Hamming distance of the hashes of near-identical images (default={})'.format(DEFAULT_RADIUS))
+    parser.add_argument('--list', action='store_true', default=False,
+                        help='print the groups of near-identical images')
+    parser.add_argument('--move', metavar='DIR', default=None,
+                        help='keep one image of each group and move the others with their annotation to DIR')
+    args = parser.parse_args()
+
+    index = HashIndex(args.data)
+    start = time.perf_counter()
+    n_hashed = index.update()
+    files = index.files()
+    hashes = index.hashes(files)
+    hashed = time.perf_counter()
+    groups = group_near_duplicates(hashes, args.radius)
+    grouped = time.perf_counter()
+
+    members = collections.defaultdict(list)
+    for f, g in zip(files, groups):
+        members[g].append(f)
+    sizes = np.bincount(groups) if len(groups) else np.zeros(0, dtype=np.int64)
+    print("{} images ({} hashed now in {:.1f}s), {} groups in {:.3f}s, {} near duplicates".format(
+        len(files), n_hashed, hashed - start, len(sizes), grouped - hashed, len(files) - len(sizes)))
+    for size, count in sorted(collections.Counter(sizes.tolist()).items()):
+        print("  {:6d} groups of {} images".format(count, size))
+
+    if args.list:
+        for g, fs in members.items():
+            if len(fs) > 1:
+                print(' '.join(fs))
+
+    if args.move:
+        # an annotated image is kept rather than an unannotated one
+        os.makedirs(args.move, exist_ok=True)
+        with AnnotationStore(args.data) as store:
+            moved = []
+            for fs in members.values():
+                if len(fs) == 1:
+                    continue
+                entries = [ store.get(f) for f in fs ]
+                keep = max(range(len(fs)), key=lambda i: entries[i] is not None and entries[i]['text'] != '')
+                for i, f in enumerate(fs):
+                    if i != keep:
+                        os.replace(os.path.join(args.data, f), os.path.join(args.move, f))
+                        moved.append(f)
+            store.delete_many(moved)
+            store.commit()
+        index.update(verbose=False)
+        print("{} images moved to {}".format(len(moved), args.move))
+
+# end of dedupe-captcha.py
@@ -1,26 +1,80 @@
-import copy
+import os, copy, json, time, tempfile
 import numpy as np
 from constants import *
 
-from chainer import reporter, dataset, function
+import chainer
+from chainer import reporter, dataset, function, serializer as serializer_module
 import chainer.training.extensions
 
+def select_labels(bbox, label, count, n_char=NCHARS):
+    # Padded detections sorted by score -> (B, n_char) labels of the best
+    # n_char detections of each image in left-to-right order, -1 where an
+    # image has fewer detections
+    bbox = chainer.backends.cuda.to_cpu(bbox[:, :n_char])
+    label = chainer.backends.cuda.to_cpu(label[:, :n_char])
+    count = np.minimum(chainer.backends.cuda.to_cpu(count), n_char)
+    valid = np.arange(label.shape[1])[None, :] < count[:, None]
+    order = np.argsort(np.where(valid, bbox[:, :, 1], np.inf), axis=1, kind='stable')
+    label = np.take_along_axis(np.where(valid, label, -1), order, axis=1)
+    if label.shape[1] < n_char:
+        label = np.pad(label, ((0, 0), (0, n_char - label.shape[1])), constant_values=-1)
+    return label
+
 class Evaluator(chainer.training.extensions.Evaluator):
+    # Reports the exact match accuracy ('acc'), the character accuracy
+    # ('acc/char', 'acc/0', 'acc/1', ...) and the forward and decode time in
+    # ms per image ('time/forward', 'time/decode'). Every evaluation is also
+    # appended to the JSON file log_name in the trainer's output directory
+    # with the per-class accuracy and the confusion matrix (rows are the
+    # true classes, columns the predicted ones).
     trigger = 1, 'epoch'
     default_name = 'validation'
     priority = chainer.training.PRIORITY_WRITER
 
-    def __init__(self, iterator, target, label_names=None, score_thresh=DEFAULT_SCORE_THRESH, device=-1):
+    def __init__(self, iterator, target, label_names=None, score_thresh=DEFAULT_SCORE_THRESH, device=-1,
+                 log_name='evaluation'):
         if iterator is None:
             iterator = {}
         super(Evaluator, self).__init__(iterator, target, device=device)
         self.label_names = label_names
         self.score_thresh = score_thresh
+        self.log_name = log_name
+        self._log = []
+        self._details = None
+
+    def __call__(self, trainer=None):
+        observation = super(Evaluator, self).__call__(trainer)
+        if trainer is not None and self.log_name is not None:
+            entry = { key: float(value) for key, value in observation.items() }
+            entry.update(self._details)
+            entry['epoch'] = trainer.updater.epoch
+            entry['iteration'] = trainer.updater.iteration
+            self._log.append(entry)
+            self._write_log(trainer.out)
+        return observation
+
+    def _write_log(self, out):
+        fd, path = tempfile.mkstemp(prefix=self.log_name, dir=out)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self._log, fp, indent=4)
+        os.replace(path, os.path.join(out, self.log_name))
+
+    def serialize(self, serializer):
+        super(Evaluator, self).serialize(serializer)
+        if isinstance(serializer, serializer_module.Serializer):
+            serializer('_log', json.dumps(self._log))
+        else:
+            # snapshots taken before the log was serialized have no '_log'
+            try:
+                self._log = json.loads(serializer('_log', '[]'))
+            except KeyError:
+                self._log = []
 
     def evaluate(self):
         target = self._targets['main']
         iterator = self._iterators['main']
         xp = target.xp
+        n_class = target.n_class
 
         if hasattr(iterator, 'reset'):
             iterator.reset()
@@ -29,28 +83,54 @@ class Evaluator(chainer.training.extensions.Evaluator):
             it = copy.copy(iterator)
 
         total_count = good_count = 0
+        position_good = np.zeros(NCHARS, dtype=np.int64)
+        class_total = np.zeros(n_class, dtype=np.int64)
+        confusion = np.zeros((n_class, n_class), dtype=np.int64)
+        forward_time = decode_time = 0.0
         for batch in it:
             batch = dataset.convert.concat_examples(batch, self.device)
             imgs, gt_bboxes, gt_labels = batch
-            pred_bboxes, pred_labels, pred_scores = target.predict(imgs)
-
-            for pred_bbox, pred_label, pred_score, gt_label in zip(pred_bboxes, pred_labels, pred_scores, gt_labels):
-                total_count += 1
-                gt_len = len(gt_label)
-                if len(pred_label) < gt_len:
-                    continue
-                if len(pred_label) > gt_len:
-                    indices = xp.argsort(pred_score)[:-gt_len-1:-1]
-                    pred_label = pred_label[indices]
-                    pred_bbox = pred_bbox[indices]
-                indices = xp.argsort(pred_bbox[:, 1])
-                pred_label = pred_label[indices]
-                if xp.all(pred_label == gt_label):
-                    good_count += 1
-
-        report = { 'acc': good_count / total_count }
+
+            t0 = time.perf_counter()
+            mb_locs, mb_confs = target.infer(imgs)
+            self._synchronize(xp)
+            t1 = time.perf_counter()
+            bbox, label, score, count = target.decode(mb_locs, mb_confs)
+            self._synchronize(xp)
+            t2 = time.perf_counter()
+            forward_time += t1 - t0
+            decode_time += t2 - t1
+
+            pred_labels = select_labels(bbox, label, count)
+            gt_labels = chainer.backends.cuda.to_cpu(gt_labels)
+            correct = pred_labels == gt_labels
+            total_count += len(gt_labels)
+            good_count += int(correct.all(axis=1).sum())
+            position_good += correct.sum(axis=0)
+            class_total += np.bincount(gt_labels.ravel(), minlength=n_class)
+            found = pred_labels >= 0
+            confusion += np.bincount(gt_labels[found] * n_class + pred_labels[found],
+                minlength=n_class * n_class).reshape(n_class, n_class)
+
+        n = max(total_count, 1)
+        report = { 'acc': good_count / n, 'acc/char': position_good.sum() / (n * NCHARS),
+            'time/forward': forward_time * 1000 / n, 'time/decode': decode_time * 1000 / n }
+        for i, good in enumerate(position_good):
+            report['acc/{}'.format(i)] = good / n
+
+        label_names = self.label_names or [ str(i) for i in range(n_class) ]
+        class_good = np.diag(confusion)
+        self._details = {
+            'class_acc': { label_names[i]: class_good[i] / class_total[i]
+                for i in range(n_class) if class_total[i] > 0 },
+            'confusion': { 'labels': list(label_names), 'matrix': confusion.tolist() },
+        }
 
         observation = {}
         with reporter.report_scope(observation):
             reporter.report(report, target)
         return observation
+
+    def _synchronize(self, xp):
+        if xp is not np:
+            chainer.backends.cuda.Stream.null.synchronize()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import sys, time, argparse, threading, concurrent.futures
+from urllib.parse import urljoin
+import requests
+from constants import *
+from scrape import SUICA_URL, USER_AGENT, DEFAULT_TIMEOUT, parse_page
+from captcha_index import CaptchaIndex
+
+DEFAULT_RATE = 2.0
+DEFAULT_SESSIONS = 4
+MAX_ERRORS = 10
+MAX_DUPLICATES = 1000
+
+class TokenBucket:
+    # allows rate acquisitions per second on average and up to burst at once
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        # the token is taken before waiting, so the waits of the threads add up
+        if wait > 0:
+            time.sleep(wait)
+
+class Harvester:
+    # Downloads captcha images from the login page with a number of
+    # concurrent sessions. Every request takes a token from one bucket, so
+    # the request rate of all the sessions together is limited. Like
+    # getcaptcha.pl, every captcha is fetched with an empty cookie jar.
+    def __init__(self, index, url=SUICA_URL, rate=DEFAULT_RATE, burst=1, sessions=DEFAULT_SESSIONS,
+            timeout=DEFAULT_TIMEOUT):
+        self.index = index
+        self.url = url
+        self.bucket = TokenBucket(rate, burst)
+        self.sessions = sessions
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.saved = 0
+        self.fetching = 0
+        self.duplicates = 0
+        self.requests = 0
+        self.errors = 0
+        # consecutive errors of all the sessions; a success resets it
+        self.failing = 0
+
+    def get(self, session, url, **kwargs):
+        self.bucket.acquire()
+        with self.lock:
+            self.requests += 1
+        r = session.get(url, timeout=self.timeout, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def fetch(self, session):
+        session.cookies.clear()
+        r0 = self.get(session, self.url)
+        src = next((src for src in parse_page(r0.text).images if 'WebCaptchaImage.axd' in src), None)
+        if src is None:
+            raise requests.RequestException('{}: cannot find the captcha'.format(r0.url))
+        return self.get(session, urljoin(r0.url, src), headers={ 'Referer': r0.url }).content
+
+    def _work(self, n):
+        session = requests.Session()
+        session.headers['User-Agent'] = USER_AGENT
+        errors = 0
+        while True:
+            # no more fetches are started than images are missing
+            with self.lock:
+                if (self.saved + self.fetching >= n or self.failing >= MAX_ERRORS
+                        or self.duplicates >= MAX_DUPLICATES or self.stop.is_set()):
+                    return
+                self.fetching += 1
+            try:
+                data = self.fetch(session)
+                errors = 0
+            except requests.RequestException as e:
+                # backs off while the site keeps failing
+                print(e, file=sys.stderr)
+                errors += 1
+                with self.lock:
+                    self.fetching -= 1
+                    self.errors += 1
+                    self.failing += 1
+                self.stop.wait(min(2 ** errors, 60))
+                continue
+            filename = self.index.add(data)
+            with self.lock:
+                self.fetching -= 1
+                self.failing = 0
+                if filename is not None:
+                    self.saved += 1
+                    self.duplicates = 0
+                else:
+                    # consecutive duplicates
+                    self.duplicates += 1
+            if filename is not None:
+                print(filename, file=sys.stderr)
+
+    def run(self, n):
+        # saves n new images; returns the number saved
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.sessions)
+        futures = [ executor.submit(self._work, n) for _ in range(self.sessions) ]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            self.stop.set()
+            executor.shutdown(wait=True)
+            self.index.commit()
+        return self.saved
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Captcha Harvester')
+    parser.add_argument('n', type=int, metavar='N',
+                        help='number of new images to get')
+    parser.add_argument('--output', '-o', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='directory to save the captcha images (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help='requests per second of all the sessions together (default={})'.format(DEFAULT_RATE))
+    parser.add_argument('--burst', type=int, default=1,
+                        help='requests that may be sent at once after an idle time (default=1)')
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS,
+                        help='number of concurrent sessions (default={})'.format(DEFAULT_SESSIONS))
+    parser.add_argument('--url', default=SUICA_URL,
+                        help='top page of the site, e.g. that of mock_suica.py (default={})'.format(SUICA_URL))
+    args = parser.parse_args()
+
+    with CaptchaIndex(args.output) as index:
+        print("{} images in {}; next file {:05d}.gif".format(len(index), args.output, index.counter), file=sys.stderr)
+        harvester = Harvester(index, url=args.url, rate=args.rate, burst=args.burst, sessions=args.sessions)
+        start = time.monotonic()
+        try:
+            saved = harvester.run(args.n)
+        except KeyboardInterrupt:
+            saved = harvester.saved
+        elapsed = time.monotonic() - start
+        print("{} saved, {} duplicates in total, {} requests in {:.1f}s ({:.2f}/s), {} errors".format(
+            saved, index.duplicates, harvester.requests, elapsed, harvester.requests / max(elapsed, 1e-9),
+            harvester.errors), file=sys.stderr)
+
+# end of harvest-captcha.py
@@ -0,0 +1,151 @@
+import os, json
+import numpy as np
+from PIL import Image
+
+# Perceptual hashes of the captcha images: the signs of the 8x8 lowest
+# frequencies of the DCT of the image scaled down to 32x32, compared with
+# their median, as a 64-bit integer. Near-identical images have hashes a
+# few bits apart, so near duplicates are the hashes within a small Hamming
+# distance, found by multi-index hashing.
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+DEFAULT_RADIUS = 6
+HASH_FILE = "phash.json"
+
+def _dct_matrix(n, k):
+    i = np.arange(n)
+    return np.cos(np.pi * (2 * i[None, :] + 1) * np.arange(k)[:, None] / (2 * n))
+
+_DCT = _dct_matrix(DCT_SIZE, HASH_SIZE)
+
+def phash(images):
+    # (N, H, W) uint8 gray images -> (N,) uint64 hashes
+    small = np.stack([ np.asarray(Image.fromarray(np.asarray(image)).resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR),
+        dtype=np.float64) for image in images ])
+    coeffs = np.einsum('ki,nij,lj->nkl', _DCT, small, _DCT).reshape(len(small), -1)
+    # the DC term is left out of the median
+    bits = coeffs > np.median(coeffs[:, 1:], axis=1)[:, None]
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def _read_gray(filename):
+    with Image.open(filename) as image:
+        return np.asarray(image.convert('L'))
+
+def hamming(a, b):
+    # element-wise Hamming distances of uint64 hashes (SWAR popcount)
+    x = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int32)
+
+class MultiIndex:
+    # Multi-index hashing: the hashes are cut into radius // 2 + 1 chunks of
+    # bits. Two hashes within radius of each other differ in at most one bit
+    # in at least one chunk, so the candidates of a query are the hashes
+    # whose chunk in one of the chunk tables, sorted arrays here, is equal
+    # to that of the query or one bit away from it.
+    def __init__(self, hashes, radius=DEFAULT_RADIUS):
+        if not 0 <= radius < 32:
+            raise ValueError('radius must be in [0, 32)')
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+        bounds = np.linspace(0, 64, radius // 2 + 2).astype(int)
+        self.tables = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            bits = int(hi - lo)
+            mask = np.uint64((1 << bits) - 1)
+            keys = (self.hashes >> np.uint64(lo)) & mask
+            order = np.argsort(keys, kind='stable')
+            flips = [ np.uint64(0) ] + ([ np.uint64(1 << b) for b in range(bits) ] if radius > 0 else [])
+            self.tables.append((np.uint64(lo), mask, keys[order], order, flips))
+
+    def _candidates(self, queries):
+        # (query index, hash index) arrays of the candidates, some of them
+        # more than once
+        for lo, mask, keys, order, flips in self.tables:
+            q = (queries >> lo) & mask
+            for flip in flips:
+                begin = np.searchsorted(keys, q ^ flip, 'left')
+                count = np.searchsorted(keys, q ^ flip, 'right') - begin
+                query = np.repeat(np.arange(len(queries)), count)
+                offset = np.arange(len(query)) - np.repeat(np.cumsum(count) - count, count)
+                yield query, order[np.repeat(begin, count) + offset]
+
+    def search(self, h):
+        # (indices, distances) of the hashes within radius of h
+        index = np.unique(np.concatenate([ i for _, i in self._candidates(np.array([ h ], dtype=np.uint64)) ]))
+        d = hamming(self.hashes[index], h)
+        return index[d <= self.radius], d[d <= self.radius]
+
+    def pairs(self, block=1 << 16):
+        # (i, j) arrays of the pairs i < j within radius, some of them more
+        # than once, for block queries at a time
+        for begin in range(0, len(self.hashes), block):
+            queries = self.hashes[begin:begin+block]
+            for query, index in self._candidates(queries):
+                i = query + begin
+                near = (i < index) & (hamming(self.hashes[i], self.hashes[index]) <= self.radius)
+                yield i[near], index[near]
+
+def group_near_duplicates(hashes, radius=DEFAULT_RADIUS):
+    # (N,) group ids, numbered in order of appearance; images within radius
+    # of each other, also through other images, are in the same group
+    unique, inverse = np.unique(np.asarray(hashes, dtype=np.uint64), return_inverse=True)
+    parent = list(range(len(unique)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in MultiIndex(unique, radius).pairs():
+        for a, b in zip(i.tolist(), j.tolist()):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    ids = {}
+    return np.array([ ids.setdefault(find(i), len(ids)) for i in inverse.tolist() ], dtype=np.int32)
+
+class HashIndex:
+    # The hashes of the GIF files of a directory, cached in DIR/phash.json
+    # with the size and mtime of each file, so only new or modified files
+    # are decoded again.
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, HASH_FILE)
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as fp:
+                self.entries = json.load(fp)
+
+    def update(self, verbose=True):
+        # hashes the files that are not up to date; returns their number
+        files = sorted(e.name for e in os.scandir(self.dirname) if e.name.endswith('.gif') and e.is_file())
+        stats = {}
+        for f in files:
+            st = os.stat(os.path.join(self.dirname, f))
+            stats[f] = [ st.st_size, st.st_mtime_ns ]
+        stale = [ f for f in files if self.entries.get(f, [None])[:2] != stats[f] ]
+        for i in range(0, len(stale), 1000):
+            chunk = stale[i:i+1000]
+            for f, h in zip(chunk, phash([ _read_gray(os.path.join(self.dirname, f)) for f in chunk ])):
+                self.entries[f] = stats[f] + [ '{:016x}'.format(int(h)) ]
+            if verbose:
+                print("\rhashing images... {}/{}".format(i + len(chunk), len(stale)), end='', flush=True)
+        if verbose and stale:
+            print()
+        self.entries = { f: self.entries[f] for f in files }
+        with open(self.filename + ".tmp", 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(self.filename + ".tmp", self.filename)
+        return len(stale)
+
+    def files(self):
+        return sorted(self.entries)
+
+    def hashes(self, files=None):
+        files = self.files() if files is None else files
+        return np.array([ int(self.entries[f][2], 16) for f in files ], dtype=np.uint64)
+
+# image_hash.py
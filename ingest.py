@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import re, sys, csv, json, argparse, datetime
+from summary import Summary
+
+DEFAULT_CONFIG = "dbi-config.json"
+DEFAULT_BATCHSIZE = 1000
+
+COLUMNS = ('date', 'type1', 'loc1', 'type2', 'loc2', 'balance', 'delta', 'remarks')
+# a transaction is identified by its contents; the balance after it makes
+# two equal purchases on the same day different rows
+NATURAL_KEY = ('date', 'type1', 'loc1', 'type2', 'loc2', 'balance', 'delta')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {t} (
+    id INTEGER PRIMARY KEY,
+    date date,
+    type1 varchar(16),
+    loc1 varchar(16),
+    type2 varchar(16),
+    loc2 varchar(16),
+    balance int,
+    delta int,
+    remarks varchar(256)
+);
+CREATE INDEX IF NOT EXISTS {t}_date ON {t} (date);
+"""
+
+MYSQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {t} (
+    id int auto_increment primary key,
+    date date,
+    type1 varchar(16),
+    loc1 varchar(16),
+    type2 varchar(16),
+    loc2 varchar(16),
+    balance int,
+    delta int,
+    remarks varchar(256),
+    KEY {t}_date (date),
+    UNIQUE KEY {t}_natural ({key})
+) DEFAULT CHARSET=utf8mb4
+"""
+
+def load_config(config_file=DEFAULT_CONFIG):
+    with open(config_file, 'r') as fp:
+        return json.load(fp)
+
+def connect(config):
+    # the DBI driver names of dbi-config.json are mapped to Python modules;
+    # returns (connection, dialect)
+    driver = config['driver'].split(':')[-1].lower()
+    if driver == 'sqlite':
+        import sqlite3
+        return sqlite3.connect(config['database']), 'sqlite'
+    if driver == 'mysql':
+        try:
+            import pymysql as mysql
+        except ImportError:
+            import MySQLdb as mysql
+        options = config.get('options', {})
+        kwargs = { 'host': config.get('host', 'localhost'), 'user': config['user'], 'password': config['password'],
+            'database': config['database'], 'autocommit': False }
+        if options.get('mysql_enable_utf8') or options.get('mysql_enable_utf8mb4'):
+            kwargs['charset'] = 'utf8mb4'
+        if 'port' in config:
+            kwargs['port'] = int(config['port'])
+        return mysql.connect(**kwargs), 'mysql'
+    raise ValueError('unsupported driver: {}'.format(config['driver']))
+
+def _int(text):
+    text = re.sub(r'[¥,\s]', '', text or '')
+    return int(text) if text else None
+
+def parse_row(fields):
+    # the CSV fields written by scrape.pl and scrape.py -> a tuple of COLUMNS;
+    # dates are written with two-digit months and days. A row without a
+    # balance or an amount, such as a 繰 (carried over) row, is rejected:
+    # the unique index treats NULLs as distinct, so it would be stored again
+    # on every ingestion
+    date = datetime.date(*map(int, fields[0].split('-'))).isoformat()
+    remarks = fields[7] if len(fields) > 7 and fields[7] else None
+    row = (date, fields[1], fields[2], fields[3], fields[4], _int(fields[5]), _int(fields[6]), remarks)
+    _check_key(row)
+    return row
+
+def _check_key(row):
+    missing = [ k for k, v in zip(COLUMNS, row) if k in NATURAL_KEY and v is None ]
+    if missing:
+        raise ValueError('no {}: {}'.format(' or '.join(missing), ','.join('' if v is None else str(v) for v in row)))
+
+class Ingester:
+    # Writes transactions into the table of dbi-config.json. Rows are sent
+    # with executemany in batches and committed as one transaction; a row
+    # that is already in the table (by NATURAL_KEY) is not inserted again,
+    # only its remarks are updated. The table and its indexes are created
+    # when they are missing. The summary tables are updated with the new
+    # rows in the same transaction.
+    def __init__(self, config, batchsize=DEFAULT_BATCHSIZE):
+        self.db, self.dialect = connect(config)
+        self.table = config['table']
+        self.batchsize = batchsize
+        self.summary = Summary(self.db, self.dialect, self.table)
+        self.breaks = []
+        self.param = '?' if self.dialect == 'sqlite' else '%s'
+        self.setup()
+        columns = ', '.join(COLUMNS)
+        values = ', '.join([ self.param ] * len(COLUMNS))
+        if self.dialect == 'sqlite':
+            self.insert = ("INSERT INTO {t} ({c}) VALUES ({v}) ON CONFLICT ({k}) DO UPDATE SET remarks = excluded.remarks"
+                " WHERE excluded.remarks IS NOT NULL AND excluded.remarks IS NOT {t}.remarks").format(
+                t=self.table, c=columns, v=values, k=', '.join(NATURAL_KEY))
+        else:
+            self.insert = ("INSERT INTO {t} ({c}) VALUES ({v})"
+                " ON DUPLICATE KEY UPDATE remarks = COALESCE(VALUES(remarks), remarks)").format(
+                t=self.table, c=columns, v=values)
+
+    def setup(self):
+        t = self.table
+        cursor = self.db.cursor()
+        if self.dialect == 'sqlite':
+            self.db.executescript(SQLITE_SCHEMA.format(t=t))
+            # tables written by older versions of scrape.pl have dates
+            # like 2019-1-2 (and no id, so they are found by rowid)
+            rows = cursor.execute("SELECT rowid, date FROM {} WHERE length(date) < 10".format(t)).fetchall()
+            cursor.executemany("UPDATE {} SET date = ? WHERE rowid = ?".format(t),
+                [ (datetime.date(*map(int, date.split('-'))).isoformat(), rowid) for rowid, date in rows ])
+            if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (t + "_natural",)).fetchall():
+                # a row stored twice by an older version is kept once
+                cursor.execute("DELETE FROM {t} WHERE rowid NOT IN (SELECT min(rowid) FROM {t} GROUP BY {k})".format(
+                    t=t, k=', '.join(NATURAL_KEY)))
+                cursor.execute("CREATE UNIQUE INDEX {t}_natural ON {t} ({k})".format(t=t, k=', '.join(NATURAL_KEY)))
+        else:
+            cursor.execute(MYSQL_SCHEMA.format(t=t, key=', '.join(NATURAL_KEY)))
+            cursor.execute("SHOW INDEX FROM {}".format(t))
+            keys = { row[2] for row in cursor.fetchall() }
+            if t + "_date" not in keys:
+                cursor.execute("ALTER TABLE {t} ADD KEY {t}_date (date)".format(t=t))
+            if t + "_natural" not in keys:
+                cursor.execute("DELETE a FROM {t} a JOIN {t} b ON {on} AND a.id > b.id".format(
+                    t=t, on=' AND '.join('a.{0} <=> b.{0}'.format(k) for k in NATURAL_KEY)))
+                cursor.execute("ALTER TABLE {t} ADD UNIQUE KEY {t}_natural ({k})".format(t=t, k=', '.join(NATURAL_KEY)))
+        self.summary.setup(cursor)
+        self.db.commit()
+
+    def ingest(self, rows):
+        # rows of COLUMNS (remarks may be left out, the columns of NATURAL_KEY
+        # may not be None); returns the number of rows and the number of them
+        # that were new or changed. The balance breaks found around the new
+        # rows are left in self.breaks.
+        n_rows = 0
+        n_changed = 0
+        cursor = self.db.cursor()
+        before = self.db.total_changes if self.dialect == 'sqlite' else 0
+        try:
+            batch = []
+            for row in rows:
+                row = tuple(row)
+                row += (None,) * (len(COLUMNS) - len(row))
+                _check_key(row)
+                batch.append(row)
+                if len(batch) >= self.batchsize:
+                    n_changed += self._execute(cursor, batch)
+                    n_rows += len(batch)
+                    batch = []
+            if batch:
+                n_changed += self._execute(cursor, batch)
+                n_rows += len(batch)
+            if self.dialect == 'sqlite':
+                n_changed = self.db.total_changes - before
+            _, self.breaks = self.summary.update(cursor)
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        return n_rows, n_changed
+
+    def _execute(self, cursor, batch):
+        cursor.executemany(self.insert, batch)
+        # the affected rows of MySQL count an updated row twice; SQLite is
+        # counted with total_changes
+        return max(cursor.rowcount, 0) if self.dialect == 'mysql' else 0
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_csv(files):
+    for f in files:
+        with (open(f, 'r', encoding='utf-8', newline='') if f != '-' else sys.stdin) as fp:
+            reader = csv.reader(fp)
+            for fields in reader:
+                if not fields:
+                    continue
+                try:
+                    yield parse_row(fields)
+                except ValueError as e:
+                    print("{}:{}: skipped, {}".format(f, reader.line_num, e), file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Transaction Ingester')
+    parser.add_argument('files', nargs='*', default=['-'], metavar='FILE',
+                        help='CSV output of scrape.pl or scrape.py (default=stdin)')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, metavar='FILE',
+                        help='database configuration (default={})'.format(DEFAULT_CONFIG))
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE,
+                        help='rows sent to the database at once (default={})'.format(DEFAULT_BATCHSIZE))
+    args = parser.parse_args()
+
+    with Ingester(load_config(args.config), batchsize=args.batchsize) as ingester:
+        n_rows, n_changed = ingester.ingest(read_csv(args.files))
+    print("{} rows read, {} new or updated".format(n_rows, n_changed), file=sys.stderr)
+    for row_id, date, expected, balance in ingester.breaks:
+        print("{}: balance {} where {} was expected (row {})".format(date, balance, expected, row_id), file=sys.stderr)
+
+# end of ingest.py
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import os, sys, json, time, random, secrets, argparse, datetime, threading, http.server
+from urllib.parse import urlsplit, parse_qs
+from http.cookies import SimpleCookie
+from constants import *
+from annotation_store import AnnotationStore
+
+# A local stand-in for the pages of https://www.mobilesuica.com/ that
+# scrape.pl and scrape.py go through: the login page with form1 and the
+# captcha, the Suica list, and the statement. Captchas are taken from an
+# annotated data directory, so the right answer is known.
+
+SESSION_COOKIE = "ASP.NET_SessionId"
+CLIENT_STATE = "[[[[null]],[],[]],[{},[]],null]"
+SAMPLE_CAPTCHA = ("sample-Captcha.gif", "f6hrp")
+
+LOGIN_PAGE = """<html><head><meta charset="utf-8"><title>モバイルSuica ログイン</title></head>
+<body><form name="form1" method="post" action="./" id="form1">
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{state}" />
+<input name="MailAddress" type="text" id="MailAddress" />
+<input name="Password" type="password" id="Password" />
+<img src="WebCaptchaImage.axd?t={state}" alt="" />
+<input name="WebCaptcha1__editor" type="text" id="WebCaptcha1__editor" />
+<input type="hidden" name="WebCaptcha1_clientState" id="WebCaptcha1_clientState" />
+<input type="hidden" name="WebCaptcha1__editor_clientState" id="WebCaptcha1__editor_clientState" />
+<input type="image" name="LOGIN" id="LOGIN" src="img/login.gif" />
+</form></body></html>
+"""
+
+MENU_PAGE = """<html><head><meta charset="utf-8"><title>モバイルSuica Suica一覧</title></head>
+<body><form name="form1" method="post" action="iq/ir/SuicaList.aspx" id="form1">
+<input type="hidden" name="__VIEWSTATE" value="{state}" />
+<input type="image" name="NEXT" src="img/next.gif" />
+</form></body></html>
+"""
+
+LIST_PAGE = """<html><head><meta charset="utf-8"><title>モバイルSuica SF利用履歴</title></head>
+<body><a href="SuicaDisp.aspx?returnId=SFRCMMEPC03">SF利用履歴</a></body></html>
+"""
+
+STATEMENT_PAGE = """<html><head><meta charset="utf-8"><title>モバイルSuica SF利用履歴</title></head>
+<body><table><tr><td class="grybg01"><table>
+<tr><th>月/日</th><th>種別</th><th>利用場所</th><th>種別</th><th>利用場所</th><th>残高</th><th>差額</th></tr>
+{rows}</table></td></tr></table></body></html>
+"""
+
+STATIONS = ("東京", "新宿", "渋谷", "品川", "上野", "池袋", "秋葉原", "横浜")
+
+def statement_rows(days=30, seed=0):
+    # the cells of the statement rows, newest first; the balance of each row
+    # is that of the older row plus its delta
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    balance = 5000
+    rows = []
+    for i in range(days):
+        date = (today - datetime.timedelta(days=i)).strftime("%m/%d")
+        if rng.random() < 0.2:
+            cost = rng.randrange(100, 1000)
+            rows.append([ date, "物販", "", "", "", "¥{:,}".format(balance), "-{}".format(cost) ])
+        else:
+            cost = rng.choice((140, 170, 200, 220))
+            rows.append([ date, "入", rng.choice(STATIONS), "出", rng.choice(STATIONS), "¥{:,}".format(balance), "-{}".format(cost) ])
+        balance += cost
+    rows.append([ rows[-1][0], "繰", "", "", "", "¥{:,}".format(balance), "" ])
+    return rows
+
+def load_captchas(data_dir, limit=1000):
+    # (GIF bytes, text) of the annotated images of a data directory, or the
+    # sample captcha when there are none
+    captchas = []
+    if data_dir is not None and os.path.isdir(data_dir):
+        with AnnotationStore(data_dir) as store:
+            for entry in store.records(length=NCHARS):
+                filename = os.path.join(data_dir, entry['file'])
+                if os.path.isfile(filename):
+                    with open(filename, "rb") as fp:
+                        captchas.append((fp.read(), entry['text']))
+                if len(captchas) >= limit:
+                    break
+    if not captchas:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), SAMPLE_CAPTCHA[0])
+        with open(filename, "rb") as fp:
+            captchas.append((fp.read(), SAMPLE_CAPTCHA[1]))
+    return captchas
+
+class MockSuica:
+    # The state of the site: sessions by cookie, each with its current
+    # captcha, and counters of the requests. delay is added to every
+    # response; fail_rate is the probability that a right answer is refused
+    # anyway, to exercise the retries of the client.
+    def __init__(self, captchas, credentials, delay=0.0, fail_rate=0.0, seed=0):
+        self.captchas = captchas
+        self.credentials = credentials
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.rows = statement_rows(seed=seed)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.counters = { 'requests': 0, 'captchas': 0, 'logins': 0, 'failures': 0, 'connections': 0 }
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def new_captcha(self, session):
+        with self.lock:
+            session['captcha'] = self.rng.choice(self.captchas)
+            session['state'] = secrets.token_hex(8)
+
+    def check_login(self, session, form):
+        answer = form.get('WebCaptcha1__editor', [''])[0]
+        expected = session.get('captcha', (None, None))[1]
+        with self.lock:
+            refused = self.rng.random() < self.fail_rate
+        return (form.get('MailAddress', [''])[0] == self.credentials['user']
+            and form.get('Password', [''])[0] == self.credentials['password']
+            and answer == expected and not refused
+            and form.get('WebCaptcha1_clientState', [''])[0] == CLIENT_STATE
+            and form.get('WebCaptcha1__editor_clientState', [''])[0].endswith('"01{}"]'.format(answer))
+            and 'LOGIN.x' in form)
+
+    def statement_html(self):
+        rows = ''.join('<tr>' + ''.join('<td>{}</td>'.format(cell) for cell in row) + '</tr>\n' for row in self.rows)
+        return STATEMENT_PAGE.format(rows=rows)
+
+    def serve(self, port=0, host='127.0.0.1'):
+        # starts the server in a background thread and returns it; its URL
+        # is http://host:server.server_port/
+        site = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                site.increment('connections')
+
+            def session(self):
+                cookie = SimpleCookie(self.headers.get('Cookie', ''))
+                sid = cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+                with site.lock:
+                    if sid not in site.sessions:
+                        sid = secrets.token_hex(12)
+                        site.sessions[sid] = { 'id': sid, 'new': True }
+                    return site.sessions[sid]
+
+            def respond(self, session, body, content_type='text/html; charset=utf-8', status=200):
+                if site.delay:
+                    time.sleep(site.delay)
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if session.pop('new', False):
+                    self.send_header('Set-Cookie', '{}={}; path=/; HttpOnly'.format(SESSION_COOKIE, session['id']))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                site.increment('requests')
+                session = self.session()
+                path = urlsplit(self.path).path
+                if path == '/':
+                    site.new_captcha(session)
+                    self.respond(session, LOGIN_PAGE.format(state=session['state']))
+                elif path == '/WebCaptchaImage.axd' and 'captcha' in session:
+                    site.increment('captchas')
+                    self.respond(session, session['captcha'][0], content_type='image/gif')
+                else:
+                    self.respond(session, 'not found', status=404)
+
+            def do_POST(self):
+                site.increment('requests')
+                session = self.session()
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True)
+                path = urlsplit(self.path).path
+                if path == '/':
+                    if site.check_login(session, form):
+                        site.increment('logins')
+                        session['login'] = True
+                        self.respond(session, MENU_PAGE.format(state=session['state']))
+                    else:
+                        site.increment('failures')
+                        site.new_captcha(session)
+                        self.respond(session, LOGIN_PAGE.format(state=session['state']))
+                elif not session.get('login'):
+                    self.respond(session, 'forbidden', status=403)
+                elif path == '/iq/ir/SuicaList.aspx':
+                    self.respond(session, LIST_PAGE)
+                elif path == '/iq/ir/SuicaDisp.aspx':
+                    self.respond(session, site.statement_html())
+                else:
+                    self.respond(session, 'not found', status=404)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Mock Mobile Suica Site')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='annotated captchas to serve (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--credentials', '-c', default='credentials.json-sample', metavar='FILE',
+                        help='the account that can log in (default=credentials.json-sample)')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds added to every response (default=0)')
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0.0,
+                        help='probability that a right answer is refused (default=0)')
+    args = parser.parse_args()
+
+    with open(args.credentials, 'r') as fp:
+        credentials = json.load(fp)
+    site = MockSuica(load_captchas(args.data), credentials, delay=args.delay, fail_rate=args.fail_rate)
+    server = site.serve(port=args.port)
+    print('serving {} captchas at http://127.0.0.1:{}/'.format(len(site.captchas), server.server_port), file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(site.counters), file=sys.stderr)
+
+# end of mock_suica.py
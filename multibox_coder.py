@@ -1,10 +1,19 @@
 import itertools
 import numpy as np
-import chainer
-from chainer.backends import cuda
-from chainercv import utils
 from constants import *
 
+def get_array_module(array):
+    # chainer is imported only for non-NumPy arrays, so that decoding works
+    # without it
+    if isinstance(array, np.ndarray):
+        return np
+    import chainer
+    return chainer.backends.cuda.get_array_module(array)
+
+# decoders of SSD.decode: generic NMS (decode_batch) or the fixed-length
+# left-to-right decoder over the grid columns (decode_grid)
+DECODERS = ('nms', 'grid')
+
 class MultiboxCoder:
     def __init__(self, grids, aspect_ratios, variance=(0.1, 0.1)):
         size = 24
@@ -22,15 +31,27 @@ class MultiboxCoder:
 
         self._default_bbox = np.stack(default_bbox)
         self._variance = variance
+        self._grids = tuple(grids)
+        self._n_per_cell = [ 1 + 2 * len(ar) for ar in aspect_ratios ]
 
     @property
     def xp(self):
-        return chainer.backends.cuda.get_array_module(self._default_bbox)
+        return get_array_module(self._default_bbox)
+
+    @property
+    def default_bbox(self):
+        return self._default_bbox
+
+    @property
+    def variance(self):
+        return self._variance
 
     def to_cpu(self):
+        import chainer
         self._default_bbox = chainer.backends.cuda.to_cpu(self._default_bbox)
 
     def to_gpu(self, device=None):
+        import chainer
         self._default_bbox = chainer.backends.cuda.to_gpu(self._default_bbox, device=device)
 
     def encode(self, bbox, label, iou_thresh=0.5):
@@ -41,84 +62,233 @@ class MultiboxCoder:
                 xp.zeros(self._default_bbox.shape, dtype=np.float32),
                 xp.zeros(self._default_bbox.shape[0], dtype=np.int32))
 
-        iou = utils.bbox_iou(
+        mb_loc, mb_label = self.encode_batch(
+            xp.asarray(bbox)[None], xp.asarray(label)[None], iou_thresh)
+        return mb_loc[0], mb_label[0]
+
+    def encode_batch(self, bboxes, labels, iou_thresh=0.5):
+        # bboxes: (B, M, 4), labels: (B, M) -> mb_locs: (B, N, 4), mb_labels: (B, N)
+        xp = self.xp
+        n_batch, n_bbox = labels.shape
+        default_bbox = self._default_bbox
+        n_default = len(default_bbox)
+
+        if n_bbox == 0:
+            return (
+                xp.zeros((n_batch, n_default, 4), dtype=np.float32),
+                xp.zeros((n_batch, n_default), dtype=np.int32))
+
+        iou = _bbox_iou(
             xp.hstack((
-                self._default_bbox[:, :2] - self._default_bbox[:, 2:] / 2,
-                self._default_bbox[:, :2] + self._default_bbox[:, 2:] / 2)),
-            bbox)
+                default_bbox[:, :2] - default_bbox[:, 2:] / 2,
+                default_bbox[:, :2] + default_bbox[:, 2:] / 2)),
+            bboxes)
 
-        index = xp.empty(len(self._default_bbox), dtype=int)
-        index[:] = -1 # background
+        index = xp.full((n_batch, n_default), -1, dtype=np.int32) # background
 
+        # greedy bipartite matching; every step matches one ground truth box
+        # of each image, so it takes at most n_bbox steps
+        batch = xp.arange(n_batch)
         masked_iou = iou.copy()
-        while True:
-            i, j = xp.unravel_index(masked_iou.argmax(), masked_iou.shape)
-            if masked_iou[i, j] < 1e-6:
-                break
-            index[i] = j
-            masked_iou[i, :] = 0
-            masked_iou[:, j] = 0
-
-        mask = xp.logical_and(index < 0, iou.max(axis=1) >= iou_thresh)
-        index[mask] = iou[mask].argmax(axis=1)
-
-        mb_bbox = bbox[index].copy()
-        mb_bbox[:, 2:] -= mb_bbox[:, :2]
-        mb_bbox[:, :2] += mb_bbox[:, 2:] / 2
-
-        mb_loc = xp.empty_like(mb_bbox)
-        mb_loc[:, :2] = (mb_bbox[:, :2] - self._default_bbox[:, :2]) / \
-                (self._variance[0] * self._default_bbox[:, 2:])
-        mb_loc[:, 2:] = xp.log(mb_bbox[:, 2:] / self._default_bbox[:, 2:]) / \
+        for _ in range(n_bbox):
+            k = masked_iou.reshape(n_batch, -1).argmax(axis=1)
+            i, j = k // n_bbox, k % n_bbox
+            active = masked_iou[batch, i, j] >= 1e-6
+            index[batch, i] = xp.where(active, j, index[batch, i])
+            masked_iou[batch, i, :] = xp.where(active[:, None], 0, masked_iou[batch, i, :])
+            masked_iou[batch, :, j] = xp.where(active[:, None], 0, masked_iou[batch, :, j])
+
+        mask = xp.logical_and(index < 0, iou.max(axis=2) >= iou_thresh)
+        index = xp.where(mask, iou.argmax(axis=2), index)
+
+        # background entries take the last box as before; their targets are
+        # masked out by the label
+        gather = index % n_bbox
+        mb_bbox = xp.take_along_axis(bboxes, gather[:, :, None], axis=1)
+        size = mb_bbox[:, :, 2:] - mb_bbox[:, :, :2]
+        center = mb_bbox[:, :, :2] + size / 2
+
+        mb_loc = xp.empty((n_batch, n_default, 4), dtype=np.float32)
+        mb_loc[:, :, :2] = (center - default_bbox[:, :2]) / \
+                (self._variance[0] * default_bbox[:, 2:])
+        mb_loc[:, :, 2:] = xp.log(size / default_bbox[:, 2:]) / \
                 self._variance[1]
 
-        mb_label = label[index] + 1
-        mb_label[index < 0] = 0
+        mb_label = xp.take_along_axis(labels, gather, axis=1) + 1
+        mb_label = xp.where(index < 0, 0, mb_label)
 
-        return mb_loc.astype(np.float32), mb_label.astype(np.int32)
+        return mb_loc, mb_label.astype(np.int32)
 
     def decode(self, mb_loc, mb_conf, nms_thresh, score_thresh):
+        bbox, label, score, count = self.decode_batch(
+            mb_loc[None], mb_conf[None], nms_thresh, score_thresh)
+        n = int(count[0])
+        return bbox[0, :n], label[0, :n], score[0, :n]
+
+    def decode_batch(self, mb_locs, mb_confs, nms_thresh, score_thresh):
+        # Decodes a whole batch at once. The results are padded to the largest
+        # number of detections in the batch and sorted by descending score;
+        # padding has label -1 and score 0, and count holds the valid lengths.
+        xp = self.xp
+        n_batch = mb_locs.shape[0]
+        n_class = mb_confs.shape[2] - 1
+
+        mb_bbox = self._decode_bbox(mb_locs)
+        mb_score = _softmax(mb_confs)
+
+        # intra-class non-maximum suppression, one row per (image, class)
+        score = mb_score[:, :, 1:].transpose(0, 2, 1).reshape(n_batch * n_class, -1)
+        score = xp.where(score >= score_thresh, score, -1)
+        index, score = _sorted_candidates(score)
+        image = xp.arange(n_batch * n_class)[:, None] // n_class
+        keep = _greedy_nms(mb_bbox[image, index], score >= 0, nms_thresh)
+
+        # inter-class non-maximum suppression, one row per image
+        K = index.shape[1]
+        score = xp.where(keep, score, -1).reshape(n_batch, n_class * K)
+        position, score = _sorted_candidates(score)
+        label = position // K
+        index = xp.take_along_axis(index.reshape(n_batch, n_class * K), position, axis=1)
+        bbox = mb_bbox[xp.arange(n_batch)[:, None], index]
+        keep = _greedy_nms(bbox, score >= 0, nms_thresh)
+
+        # move the survivors to the front, keeping them sorted by score
+        count = keep.sum(axis=1)
+        M = int(count.max()) if n_batch > 0 else 0
+        order = xp.argsort(~keep, axis=1, kind='stable')[:, :M]
+        valid = xp.arange(M)[None, :] < count[:, None]
+        bbox = xp.take_along_axis(bbox, order[:, :, None], axis=1)
+        bbox = xp.where(valid[:, :, None], bbox, 0).astype(np.float32)
+        label = xp.where(valid, xp.take_along_axis(label, order, axis=1), -1).astype(np.int32)
+        score = xp.where(valid, xp.take_along_axis(score, order, axis=1), 0).astype(np.float32)
+
+        return bbox, label, score, count.astype(np.int32)
+
+    def decode_grid(self, mb_locs, mb_confs, nms_thresh, n_char=NCHARS):
+        # Decodes a batch into exactly n_char characters in left-to-right
+        # order without NMS. Each grid column contributes its best default
+        # box, and dynamic programming over the columns picks the n_char
+        # columns, each to the right of the previous one and overlapping it
+        # by less than nms_thresh, that maximize the sum of log scores.
+        # Returns the same padded arrays as decode_batch, sorted from left to
+        # right; count is less than n_char only when no such choice exists.
         xp = self.xp
+        if len(self._grids) != 1:
+            raise ValueError('the grid decoder requires a single grid')
+        n_row, n_col = self._grids[0]
+        n_per_cell = self._n_per_cell[0]
+        n_batch = mb_locs.shape[0]
+        batch = xp.arange(n_batch)[:, None]
+
+        # log score of the best class of every default box
+        x_max = mb_confs.max(axis=2)
+        log_z = x_max + xp.log(xp.exp(mb_confs - x_max[:, :, None]).sum(axis=2))
+        mb_log_score = mb_confs[:, :, 1:].max(axis=2) - log_z
+
+        # the best default box of every column; labels and boxes are decoded
+        # only for those
+        column_score = mb_log_score.reshape(n_batch, n_row, n_col, n_per_cell) \
+            .transpose(0, 2, 1, 3).reshape(n_batch, n_col, n_row * n_per_cell)
+        best = column_score.argmax(axis=2)
+        index = ((best // n_per_cell) * n_col + xp.arange(n_col)) * n_per_cell + best % n_per_cell
+        value = mb_log_score[batch, index]
+        label = mb_confs[batch, index, 1:].argmax(axis=2)
+        bbox = self._decode_bbox(mb_locs[batch, index], self._default_bbox[index])
+
+        # compatible[b, i, j]: column j may follow column i
+        tl = xp.maximum(bbox[:, :, None, :2], bbox[:, None, :, :2])
+        br = xp.minimum(bbox[:, :, None, 2:], bbox[:, None, :, 2:])
+        area_i = xp.prod(br - tl, axis=3) * (tl < br).all(axis=3)
+        area = xp.prod(bbox[:, :, 2:] - bbox[:, :, :2], axis=2)
+        iou = area_i / (area[:, :, None] + area[:, None, :] - area_i)
+        compatible = (iou < nms_thresh) & xp.triu(xp.ones((n_col, n_col), dtype=bool), k=1)
+
+        total = [ value ]
+        back = [ None ]
+        for _ in range(1, n_char):
+            candidate = xp.where(compatible, total[-1][:, :, None], -np.inf)
+            back.append(candidate.argmax(axis=1))
+            total.append(candidate.max(axis=1) + value)
+
+        best_total = xp.stack([ t.max(axis=1) for t in total ], axis=1)
+        count = (best_total > -np.inf).sum(axis=1)
+        column = xp.full((n_batch, n_char), -1, dtype=np.int64)
+        j = xp.zeros(n_batch, dtype=np.int64)
+        for k in reversed(range(n_char)):
+            j = xp.where(count - 1 == k, total[k].argmax(axis=1), j)
+            active = k < count
+            column[:, k] = xp.where(active, j, -1)
+            if k > 0:
+                j = xp.where(active, back[k][batch[:, 0], j], j)
+
+        valid = column >= 0
+        column = xp.maximum(column, 0)
+        bbox = xp.where(valid[:, :, None], bbox[batch, column], 0).astype(np.float32)
+        label = xp.where(valid, label[batch, column], -1).astype(np.int32)
+        score = xp.where(valid, xp.exp(value[batch, column]), 0).astype(np.float32)
+        return bbox, label, score, count.astype(np.int32)
+
+    def _decode_bbox(self, mb_locs, default_bbox=None):
+        xp = self.xp
+        if default_bbox is None:
+            default_bbox = self._default_bbox
+        center = default_bbox[..., :2] + mb_locs[:, :, :2] * self._variance[0] * default_bbox[..., 2:]
+        size = default_bbox[..., 2:] * xp.exp(mb_locs[:, :, 2:] * self._variance[1])
+        return xp.concatenate((center - size / 2, center + size / 2), axis=2)
+
+def _softmax(x):
+    xp = get_array_module(x)
+    y = xp.exp(x - x.max(axis=2, keepdims=True))
+    y /= y.sum(axis=2, keepdims=True)
+    return y
+
+def _bbox_iou(bbox_a, bbox_b):
+    # IoU of every default box against the boxes of each image:
+    # (N, 4), (B, M, 4) -> (B, N, M)
+    xp = get_array_module(bbox_b)
+    tl = xp.maximum(bbox_a[None, :, None, :2], bbox_b[:, None, :, :2])
+    br = xp.minimum(bbox_a[None, :, None, 2:], bbox_b[:, None, :, 2:])
+    area_i = xp.prod(br - tl, axis=3) * (tl < br).all(axis=3)
+    area_a = xp.prod(bbox_a[:, 2:] - bbox_a[:, :2], axis=1)
+    area_b = xp.prod(bbox_b[:, :, 2:] - bbox_b[:, :, :2], axis=2)
+    return area_i / (area_a[None, :, None] + area_b[:, None, :] - area_i)
+
+def _sorted_candidates(score):
+    # Picks the entries of every row whose score is non-negative and returns
+    # their column indices and scores sorted by descending score, padded with
+    # score -1 to the longest row.
+    xp = get_array_module(score)
+    n_row, n_col = score.shape
+    K = int((score >= 0).sum(axis=1).max()) if n_row > 0 else 0
+    if K < n_col:
+        index = xp.argpartition(-score, K, axis=1)[:, :K]
+    else:
+        index = xp.broadcast_to(xp.arange(n_col), (n_row, n_col))
+    score = xp.take_along_axis(score, index, axis=1)
+    order = xp.argsort(-score, axis=1)
+    return xp.take_along_axis(index, order, axis=1), xp.take_along_axis(score, order, axis=1)
+
+def _greedy_nms(bbox, valid, thresh):
+    # Greedy NMS over score-sorted candidates, one independent set per row.
+    # Each step keeps the best remaining candidate of every row and drops the
+    # ones it overlaps, so the loop runs as many times as the largest number
+    # of boxes kept in a single row.
+    xp = get_array_module(bbox)
+    n_row, K = valid.shape
+    row = xp.arange(n_row)
+    area = xp.prod(bbox[:, :, 2:] - bbox[:, :, :2], axis=2)
+    keep = xp.zeros((n_row, K), dtype=bool)
+    remaining = valid.copy()
+    while remaining.any():
+        i = remaining.argmax(axis=1)
+        active = remaining[row, i]
+        keep[row, i] |= active
+        remaining[row, i] = False
 
-        mb_bbox = self._default_bbox.copy()
-        mb_bbox[:, :2] += mb_loc[:, :2] * self._variance[0] * self._default_bbox[:, 2:]
-        mb_bbox[:, 2:] *= xp.exp(mb_loc[:, 2:] * self._variance[1])
-
-        mb_bbox[:, :2] -= mb_bbox[:, 2:] / 2
-        mb_bbox[:, 2:] += mb_bbox[:, :2]
-
-        if xp == np:
-            mb_conf[mb_conf > 88.72] = 88.72 # avoid overflow
-        mb_score = xp.exp(mb_conf)
-        mb_score /= mb_score.sum(axis=1, keepdims=True)
-
-        # intra-class non-maximum suppression
-        bbox = []
-        label = []
-        score = []
-        for l in range(mb_conf.shape[1] - 1):
-            bbox_l = mb_bbox
-            score_l = mb_score[:, l + 1]
-
-            mask = score_l >= score_thresh
-            bbox_l = bbox_l[mask]
-            score_l = score_l[mask]
-
-            indices = utils.non_maximum_suppression(bbox_l, nms_thresh, score_l)
-            bbox_l = bbox_l[indices]
-            score_l = score_l[indices]
-
-            bbox.append(bbox_l)
-            label.append(xp.array((l,) * len(bbox_l)))
-            score.append(score_l)
-
-        # inter-class non-maximum suppression
-        bbox = xp.vstack(bbox)
-        label = xp.hstack(label)
-        score = xp.hstack(score)
-        indices = utils.non_maximum_suppression(bbox, nms_thresh, score)
-        bbox = bbox[indices].astype(np.float32)
-        label = label[indices].astype(np.int32)
-        score = score[indices].astype(np.float32)
-
-        return bbox, label, score
+        selected = bbox[row, i][:, None, :]
+        tl = xp.maximum(selected[:, :, :2], bbox[:, :, :2])
+        br = xp.minimum(selected[:, :, 2:], bbox[:, :, 2:])
+        area_i = xp.prod(br - tl, axis=2) * (tl < br).all(axis=2)
+        iou = area_i / (area[row, i][:, None] + area - area_i)
+        remaining &= ~((iou >= thresh) & active[:, None])
+    return keep
@@ -14,12 +14,41 @@ def _elementwise_softmax_cross_entropy(x, t):
 
 
 def _hard_negative(x, positive, k):
-    rank = (x * (positive - 1)).argsort(axis=1).argsort(axis=1)
-    hard_negative = rank < (positive.sum(axis=1) * k)[:, np.newaxis]
+    # Marks the k * n_positive entries of each row that come first when the
+    # row is sorted by x * (positive - 1), i.e. the negatives with the
+    # largest loss. Only the first m = max(k * n_positive) entries are
+    # selected and sorted instead of ranking whole rows.
+    xp = chainer.backends.cuda.get_array_module(x)
+    n_row, n_col = x.shape
+    n_hard = positive.sum(axis=1) * k
+    m = min(int(n_hard.max()), n_col) if n_row > 0 else 0
+    hard_negative = xp.zeros(x.shape, dtype=bool)
+    if m == 0:
+        return hard_negative
+
+    key = x * (positive - 1)
+    rows = xp.arange(n_row)[:, np.newaxis]
+    if m < n_col:
+        index = xp.argpartition(key, m - 1, axis=1)[:, :m]
+    else:
+        index = xp.broadcast_to(xp.arange(n_col), x.shape)
+    index = index[rows, key[rows, index].argsort(axis=1)]
+    hard_negative[rows, index] = xp.arange(m)[np.newaxis, :] < n_hard[:, np.newaxis]
     return hard_negative
 
 
-def multibox_loss(mb_locs, mb_confs, gt_mb_locs, gt_mb_labels, k, comm=None):
+def _softmax_cross_entropy_array(x, t):
+    # elementwise softmax cross entropy of plain arrays
+    xp = chainer.backends.cuda.get_array_module(x)
+    x_max = x.max(axis=-1, keepdims=True)
+    log_z = xp.log(xp.exp(x - x_max).sum(axis=-1)) + x_max[..., 0]
+    return log_z - xp.take_along_axis(x, t[..., np.newaxis], axis=-1)[..., 0]
+
+
+def multibox_loss(mb_locs, mb_confs, gt_mb_locs, gt_mb_labels, k, comm=None, fused=False):
+    # With fused=True the negatives are mined on plain arrays and the
+    # confidence loss is computed only for the positive and hard negative
+    # boxes, so the graph does not hold the loss of every default box.
     mb_locs = chainer.as_variable(mb_locs)
     mb_confs = chainer.as_variable(mb_confs)
     gt_mb_locs = chainer.as_variable(gt_mb_locs)
@@ -42,10 +71,19 @@ def multibox_loss(mb_locs, mb_confs, gt_mb_locs, gt_mb_labels, k, comm=None):
         loc_loss *= positive.astype(loc_loss.dtype)
         loc_loss = F.sum(loc_loss) / n_positive
 
-        conf_loss = _elementwise_softmax_cross_entropy(mb_confs, gt_mb_labels)
-        hard_negative = _hard_negative(conf_loss.array, positive, k)
-        conf_loss *= xp.logical_or(
-            positive, hard_negative).astype(conf_loss.dtype)
-        conf_loss = F.sum(conf_loss) / n_positive
+        if fused:
+            x = _softmax_cross_entropy_array(mb_confs.array, gt_mb_labels.array)
+            hard_negative = _hard_negative(x, positive, k)
+            index = xp.flatnonzero(xp.logical_or(positive, hard_negative))
+            conf_loss = F.softmax_cross_entropy(
+                F.reshape(mb_confs, (-1, mb_confs.shape[-1]))[index],
+                gt_mb_labels.array.ravel()[index], reduce='no')
+            conf_loss = F.sum(conf_loss) / n_positive
+        else:
+            conf_loss = _elementwise_softmax_cross_entropy(mb_confs, gt_mb_labels)
+            hard_negative = _hard_negative(conf_loss.array, positive, k)
+            conf_loss *= xp.logical_or(
+                positive, hard_negative).astype(conf_loss.dtype)
+            conf_loss = F.sum(conf_loss) / n_positive
 
     return loc_loss, conf_loss
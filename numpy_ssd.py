@@ -0,0 +1,158 @@
+import numpy as np
+
+from multibox_coder import MultiboxCoder, DECODERS
+
+# layers of Extractor as (name, dilation); None is a 2x2 max pooling
+EXTRACTOR_LAYERS = (
+    ('conv1_1', 1), ('conv1_2', 1), None,
+    ('conv2_1', 1), ('conv2_2', 1), None,
+    ('conv3_1', 2), ('conv3_2', 2), None,
+    ('conv4_1', 1), ('conv4_2', 1),
+)
+
+def load_params(npz_file):
+    with np.load(npz_file) as npz:
+        return { name: npz[name] for name in npz.files }
+
+def _kernel(W):
+    # (out, in, 3, 3) -> (in * 3 * 3, out) as a view, so that memory-mapped
+    # weights are used in place
+    return W.reshape(W.shape[0], -1).T
+
+def _conv3x3(x, W, b=None, dilate=1):
+    # 3x3 convolution with pad 1 on NHWC arrays: (B, H, W, C) -> (B, H', W', O)
+    n, h, w, c = x.shape
+    x = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    ho, wo = h + 2 - 2 * dilate, w + 2 - 2 * dilate
+    sb, sh, sw, sc = x.strides
+    cols = np.lib.stride_tricks.as_strided(x, shape=(n, ho, wo, c, 3, 3),
+        strides=(sb, sh, sw, sc, sh * dilate, sw * dilate), writeable=False)
+    y = cols.reshape(n * ho * wo, 9 * c) @ W
+    if b is not None:
+        y += b
+    return y.reshape(n, ho, wo, -1)
+
+def _max_pooling_2x2(x):
+    # same as F.max_pooling_2d(x, 2) with cover_all=True on NHWC arrays
+    n, h, w, c = x.shape
+    if h % 2 or w % 2:
+        x = np.pad(x, ((0, 0), (0, h % 2), (0, w % 2), (0, 0)), constant_values=-np.inf)
+    return x.reshape(n, x.shape[1] // 2, 2, x.shape[2] // 2, 2, c).max(axis=(2, 4))
+
+class NumpySSD:
+    # Inference-only SSD that runs on the parameters of a trained model
+    # with plain NumPy. It provides the same prediction methods as SSD.
+    xp = np
+
+    def __init__(self, params, n_class, grids, aspect_ratios, variance, nms_thresh, score_thresh, decoder='nms'):
+        self.n_class = n_class
+        self.nms_thresh = nms_thresh
+        self.score_thresh = score_thresh
+        if decoder not in DECODERS:
+            raise ValueError('unknown decoder: {}'.format(decoder))
+        self.decoder = decoder
+        self.coder = MultiboxCoder(grids=grids, aspect_ratios=aspect_ratios, variance=variance)
+
+        self._extractor = []
+        for layer in EXTRACTOR_LAYERS:
+            if layer is None:
+                self._extractor.append(None)
+            else:
+                name, dilate = layer
+                self._extractor.append(('extractor/' + name, dilate))
+        self._loc = [ 'multibox/loc/{}'.format(i) for i in range(len(grids)) ]
+        self._conf = [ 'multibox/conf/{}'.format(i) for i in range(len(grids)) ]
+
+        self._params = {}
+        for name in [ l[0] for l in self._extractor if l is not None ] + self._loc + self._conf:
+            self._params[name] = self._load_layer(params, name)
+
+    @property
+    def layer_names(self):
+        return list(self._params.keys())
+
+    def _load_layer(self, params, name):
+        return _kernel(params[name + '/W']), params[name + '/b']
+
+    def _conv(self, name, x, dilate=1):
+        W, b = self._params[name]
+        return _conv3x3(x, W, b, dilate)
+
+    def forward(self, x):
+        h = x.transpose(0, 2, 3, 1)
+        for layer in self._extractor:
+            if layer is None:
+                h = _max_pooling_2x2(h)
+            else:
+                name, dilate = layer
+                h = np.maximum(self._conv(name, h, dilate), 0)
+        hs = [ h ]
+
+        # outputs are NHWC already, so the heads need no transposition
+        n = x.shape[0]
+        mb_locs = [ self._conv(name, h).reshape(n, -1, 4) for h, name in zip(hs, self._loc) ]
+        mb_confs = [ self._conv(name, h).reshape(n, -1, self.n_class + 1) for h, name in zip(hs, self._conf) ]
+        return np.concatenate(mb_locs, axis=1), np.concatenate(mb_confs, axis=1)
+
+    def infer(self, x):
+        return self.forward(np.asarray(x, dtype=np.float32))
+
+    def decode(self, mb_locs, mb_confs):
+        if self.decoder == 'grid':
+            return self.coder.decode_grid(mb_locs, mb_confs, self.nms_thresh)
+        return self.coder.decode_batch(
+            mb_locs, mb_confs, self.nms_thresh, self.score_thresh)
+
+    def predict_padded(self, imgs):
+        if getattr(imgs, 'ndim', None) == 4:
+            x = np.asarray(imgs)
+        else:
+            x = np.stack([ np.asarray(img) for img in imgs ])
+        return self.decode(*self.infer(x))
+
+    def predict(self, imgs):
+        bbox, label, score, count = self.predict_padded(imgs)
+        bboxes = [ b[:n] for b, n in zip(bbox, count) ]
+        labels = [ l[:n] for l, n in zip(label, count) ]
+        scores = [ s[:n] for s, n in zip(score, count) ]
+        return bboxes, labels, scores
+
+class QuantizedSSD(NumpySSD):
+    # Runs a model quantized by quantize-model.py: per-output-channel int8
+    # weights and per-layer uint8 activations. It gives the answers of the
+    # int8 model, to measure what the quantization costs in accuracy, but
+    # not its speed: NumPy has no int8 matrix product (its integer products
+    # do not use BLAS and are several times slower than float32), so the
+    # integer operands are multiplied as floats; this is exact as long as
+    # every sum stays below 2**24, and float64 is used for the layers where
+    # it might not.
+    def _load_layer(self, params, name):
+        W = _kernel(params[name + '/W'])
+        dtype = np.float32 if W.shape[0] * 255 * 127 < 1 << 24 else np.float64
+        return (W.astype(dtype), params[name + '/b'],
+                float(params[name + '/x_scale']), params[name + '/W_scale'])
+
+    def _conv(self, name, x, dilate=1):
+        W, b, x_scale, W_scale = self._params[name]
+        x = np.rint(x * (1 / x_scale)).astype(W.dtype)
+        np.clip(x, 0, 255, out=x)
+        y = _conv3x3(x, W, None, dilate)
+        y *= x_scale * W_scale
+        y += b
+        return y.astype(np.float32, copy=False)
+
+def quantize_params(params, x_max):
+    # x_max maps each layer name to the largest input activation observed
+    # during calibration
+    qparams = {}
+    for name, m in x_max.items():
+        W = params[name + '/W']
+        W_scale = np.abs(W).reshape(W.shape[0], -1).max(axis=1) / 127
+        W_scale[W_scale == 0] = 1
+        qparams[name + '/W'] = np.rint(W / W_scale[:, None, None, None]).astype(np.int8)
+        qparams[name + '/W_scale'] = W_scale.astype(np.float32)
+        qparams[name + '/b'] = params[name + '/b']
+        qparams[name + '/x_scale'] = np.float32(m / 255 if m > 0 else 1)
+    return qparams
+
+# numpy_ssd.py
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import os, json, time, argparse
+import numpy as np
+from constants import *
+from dataset import Dataset
+from numpy_ssd import NumpySSD, QuantizedSSD, load_params, quantize_params
+from solve import Solver
+
+INT8_FILE = "model-int8.npz"
+
+class CalibratingSSD(NumpySSD):
+    # records the largest input activation of every layer
+    def __init__(self, *args, **kwargs):
+        super(CalibratingSSD, self).__init__(*args, **kwargs)
+        self.x_max = { name: 0.0 for name in self.layer_names }
+
+    def _conv(self, name, x, dilate=1):
+        self.x_max[name] = max(self.x_max[name], float(x.max()))
+        return super(CalibratingSSD, self)._conv(name, x, dilate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Int8 Quantization Accuracy Report')
+    parser.add_argument('--model', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    parser.add_argument('--data', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='annotated data directory (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='number of images used for calibration (default=1000)')
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
+    args = parser.parse_args()
+
+    metadata_file = os.path.join(args.model, "model.json")
+    with open(metadata_file, 'r') as fp:
+        metadata = json.load(fp)
+
+    # the activations are calibrated on the training part of the data and
+    # the accuracy is measured on the held-out part (the validation split of
+    # train.py), as Evaluator does
+    dataset = Dataset(args.data)
+    train, held_out = dataset.split(**metadata.get('split', { 'mode': 'fixed' }))
+    images = dataset.images[held_out]
+    texts = [ ''.join([ dataset.class_labels[l] for l in lbs ]) for lbs in dataset.labels[held_out] ]
+    print("{} annotated images found, {} held out".format(len(dataset), len(images)))
+
+    # calibration
+    params = load_params(os.path.join(args.model, metadata['file']))
+    kwargs = dict(n_class=metadata['n_class'],
+        nms_thresh=DEFAULT_NMS_THRESH, score_thresh=DEFAULT_SCORE_THRESH,
+        grids=DEFAULT_GRIDS, aspect_ratios=DEFAULT_ASPECT_RATIOS,
+        variance=DEFAULT_VARIANCE)
+    model = CalibratingSSD(params, **kwargs)
+    samples = train[np.random.RandomState(0).permutation(len(train))[:args.samples]]
+    samples.sort()
+    for i in range(0, len(samples), args.batchsize):
+        x = dataset.images[samples[i:i+args.batchsize]].astype(np.float32) / 255.0
+        model.infer(x[:, None])
+    qparams = quantize_params(params, model.x_max)
+
+    # accuracy and latency of both models; the int8 model is run before it
+    # is written, so model.json only ever has measured numbers
+    float_solver = Solver(dirname=args.model, backend='numpy')
+    int8_solver = Solver(dirname=args.model, backend='numpy')
+    int8_solver.model = QuantizedSSD(qparams, **kwargs)
+    accuracy = {}
+    latency = {}
+    for key, solver in (('float', float_solver), ('int8', int8_solver)):
+        solver.solve_batch(images[:args.batchsize])
+        start = time.perf_counter()
+        accuracy[key] = solver.accuracy(images, texts, args.batchsize)
+        latency[key] = (time.perf_counter() - start) / max(len(images), 1)
+    print("accuracy: float {:.4f}, int8 {:.4f} ({:+.4f})".format(
+        accuracy['float'], accuracy['int8'], accuracy['int8'] - accuracy['float']))
+    print("latency: float {:.3f} ms/image, int8 {:.3f} ms/image ({:.2f}x)".format(
+        latency['float'] * 1000, latency['int8'] * 1000, latency['float'] / latency['int8']))
+
+    np.savez(os.path.join(args.model, INT8_FILE), **qparams)
+    metadata['int8'] = { 'file': INT8_FILE, 'accuracy': accuracy, 'latency': latency,
+        'samples': len(images), 'batchsize': args.batchsize }
+    with open(metadata_file, "w") as fp:
+        json.dump(metadata, fp, sort_keys=True)
+
+# end of quantize-model.py
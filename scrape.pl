@@ -7,7 +7,9 @@ use Web::Scraper;
 use JSON;
 use File::Path;
 use File::Basename;
-use DBI;
+use IO::Handle;
+use IPC::Open2;
+use MIME::Base64;
 use Getopt::Long qw(:config posix_default no_ignore_case gnu_compat auto_abbrev);
 binmode(STDOUT, ":utf8");
 binmode(STDERR, ":utf8");
@@ -19,6 +21,9 @@ my $log_dir = "log";
 my $data_dir = "data";
 my $use_db;
 my $dbi_config_file = "dbi-config.json";
+my $archive = 1;
+my $reject = "auto";
+my $max_rejects = 10;
 
 GetOptions(
     "credentials|c=s" => \$credential_file,
@@ -26,6 +31,9 @@ GetOptions(
     "gpu|g=i" => \$gpu,
     "data|d=s" => \$data_dir,
     "db" => \$use_db,
+    "archive!" => \$archive,
+    "reject=s" => \$reject,
+    "max-rejects=i" => \$max_rejects,
 );
 
 my $home_dir = dirname($0);
@@ -56,15 +64,6 @@ sub save_file {
     return 1;
 }
 
-sub new_file {
-    my $base = shift;
-    my $ext = shift;
-    for (my $i = 0; ; $i++) {
-	my $file_name = sprintf("%s%05d%s", $base, $i, $ext);
-	return $file_name unless -e $file_name;
-    }
-}
-
 # check if data and log directories exist
 mkpath($data_dir) unless -d $data_dir;
 mkpath($log_dir) unless -d $log_dir;
@@ -89,11 +88,8 @@ EOS
 }
 my $credentials = decode_json(read_file($credential_file));
 
-# read dbi-config if needed
-my $dbi_config;
-if ($use_db) {
-    $dbi_config = decode_json(read_file($dbi_config_file));
-}
+# check dbi-config if needed
+die "$dbi_config_file: not found" if $use_db && ! -r $dbi_config_file;
 
 # initialize WWW::Mechanize
 my $cookie_jar = {};
@@ -130,62 +126,42 @@ sub close {
 
 package output_db;
 
+# the rows are written to the database by ingest.py, in one transaction and
+# without the rows that are already there
+
 sub new {
     my $class = shift;
-    
-    my $dbh = DBI->connect($dbi_config->{'driver'} . ":" . $dbi_config->{'database'},
-			   $dbi_config->{'user'}, $dbi_config->{'password'},
-			   $dbi_config->{'options'});
-
-    eval {
-	my $sql = <<EOS;
-create table $dbi_config->{'table'}(
-id int auto_increment primary key,
-date date,
-type1 varchar(16),
-loc1 varchar(16),
-type2 varchar(16),
-loc2 varchar(16),
-balance int,
-delta int,
-remarks varchar(256)
-)
-EOS
-	$dbh->do($sql);
-	$dbh->do("create index " . $dbi_config->{'table'} . "_date on " . $dbi_config->{'table'} . "(date)");
-    };
-
-    my $stmt0 = $dbh->prepare("select max(date) from " . $dbi_config->{'table'});
-    $stmt0->execute();
-    my $maxdate = eval {
-	($stmt0->fetchrow_array)[0];
-    } || "1900-01-01";
-    $stmt0->finish;
-
-    my $stmt = $dbh->prepare("insert into " . $dbi_config->{'table'} . "(date,type1,loc1,type2,loc2,balance,delta) values(?,?,?,?,?,?,?)");
-
-    return bless { dbh => $dbh, stmt => $stmt, maxdate => $maxdate }, $class;
+    open(my $pipe, "|-", "./ingest.py", "--config=$dbi_config_file") || die "./ingest.py: $!";
+    binmode($pipe, ":utf8");
+    return bless { pipe => $pipe }, $class;
 }
 
 sub write {
     my $self = shift;
     my @list = @_;
-
-    return if $list[0] le $self->{'maxdate'};
-    $self->{'stmt'}->execute(@list);
+    print { $self->{'pipe'} } "\"" . join("\",\"", @list) . "\"\n";
 }
 
 sub close {
     my $self = shift;
-    $self->{'stmt'}->finish;
-    $self->{'dbh'}->commit;
-    $self->{'dbh'}->disconnect;
+    CORE::close($self->{'pipe'}) || die "./ingest.py: exit status " . ($? >> 8);
 }
 
 package main;
 
+# start the captcha solver once; it stays resident during the login loop
+# it saves the captcha images in the data directory in the background
+my @solver_args = ("--model=$model_dir", "--serve");
+push @solver_args, "--archive=$data_dir" if $archive;
+# captchas the solver is unlikely to get right are skipped without a login
+push @solver_args, "--reject=$reject" if $reject ne "none";
+my $solver_pid = open2(my $solver_out, my $solver_in, "./solve.py", @solver_args)
+    || die "./solve.py: $!";
+$solver_in->autoflush(1);
+
 # login loop
 my $login_success = 0;
+my $rejects = 0;
 for (my $retry = 0; $retry < 5; $retry++) {
 
     # fetch LOGIN page
@@ -204,14 +180,21 @@ for (my $retry = 0; $retry < 5; $retry++) {
     $mech->back() || die "could not go back";
 
     # solve the captcha
-    my $gif_file = new_file("$data_dir/", ".gif");
-    save_file($gif_file, $captcha_image);
-
     my $captcha_string = "";
-    open(my $pipe, "-|", "./solve.py --model=$model_dir --file $gif_file") || die "./solve.py: $!";
-    chomp(my $result = <$pipe>);
-    if ($result =~ /^.*\.gif (.*)$/) {
-	$captcha_string = $1;
+    print $solver_in encode_json({ gif => encode_base64($captcha_image, ""), archive => JSON::true }) . "\n";
+    my $result = <$solver_out>;
+    die "./solve.py: terminated unexpectedly" unless defined $result;
+    my $answer = decode_json($result);
+    die "./solve.py: $answer->{error}" if $answer->{error};
+    $captcha_string = $answer->{text};
+    my $gif_file = $answer->{file} || "-";
+    my $confidence = sprintf("%.4f", $answer->{confidence});
+    if ($answer->{reject} && $rejects < $max_rejects) {
+	# a rejected captcha does not use up a login attempt
+	$rejects++;
+	$retry--;
+	print $log "# rejected \"$gif_file\",\"$captcha_string\",$confidence\n";
+	next;
     }
     next unless length($captcha_string) == 5;
 
@@ -229,11 +212,13 @@ for (my $retry = 0; $retry < 5; $retry++) {
     # check if login successful
     if ($r2->decoded_content =~ /<title>.*Suica一覧<\/title>/) {
 	$login_success = 1;
-	print $log "\"$gif_file\",\"$captcha_string\",1\n";
+	print $log "\"$gif_file\",\"$captcha_string\",1,$confidence\n";
 	last;
     }
-    print $log "\"$gif_file\",\"$captcha_string\",0\n";
+    print $log "\"$gif_file\",\"$captcha_string\",0,$confidence\n";
 } # end of login loop
+close($solver_in);
+waitpid($solver_pid, 0);
 die "login unsuccessful" unless $login_success;
 # login successful
 
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+import os, re, sys, csv, json, time, argparse, datetime, concurrent.futures
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+import requests
+from constants import *
+from stage_stats import StageStats
+from solve import Solver, Archiver, BACKENDS
+from ingest import Ingester, load_config, parse_row, DEFAULT_CONFIG
+
+SUICA_URL = "https://www.mobilesuica.com/"
+STATEMENT_PATH = "iq/ir/SuicaDisp.aspx?returnId=SFRCMMEPC03"
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.75 Safari/537.36"
+DEFAULT_RETRIES = 5
+DEFAULT_MAX_REJECTS = 10
+DEFAULT_TIMEOUT = 30
+
+LOGIN_TITLE = re.compile(r'<title>.*Suica一覧</title>', re.S)
+OUT_OF_SERVICE = "時間をお確かめの上、再度実行してください。"
+VOID_ELEMENTS = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr')
+
+class ScrapeError(Exception):
+    pass
+
+class Form:
+    # the controls of an HTML form in document order; submit buttons and
+    # image buttons are only sent when they are clicked
+    def __init__(self, attrs):
+        self.id = attrs.get('id')
+        self.name = attrs.get('name')
+        self.action = attrs.get('action') or ''
+        self.method = (attrs.get('method') or 'get').lower()
+        self.fields = []
+        self.buttons = {}
+
+    def add(self, name, value):
+        self.fields.append([name, value])
+
+    def __setitem__(self, name, value):
+        for field in self.fields:
+            if field[0] == name:
+                field[1] = value
+                return
+        raise KeyError('{}: no such field in form {}'.format(name, self.id or self.name))
+
+    def __getitem__(self, name):
+        for field in self.fields:
+            if field[0] == name:
+                return field[1]
+        raise KeyError(name)
+
+    def data(self, button=None, x=1, y=1):
+        data = [ tuple(field) for field in self.fields ]
+        if button is not None:
+            if button not in self.buttons:
+                raise KeyError('{}: no such button in form {}'.format(button, self.id or self.name))
+            kind, value = self.buttons[button]
+            if kind == 'image':
+                data += [ (button + '.x', str(x)), (button + '.y', str(y)) ]
+            else:
+                data.append((button, value))
+        return data
+
+class PageParser(HTMLParser):
+    # collects the title, the image sources and the forms of a page
+    def __init__(self):
+        super().__init__()
+        self.title = ''
+        self.images = []
+        self.forms = []
+        self._form = None
+        self._in_title = False
+        self._select = None
+        self._textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = { k: v if v is not None else '' for k, v in attrs }
+        if tag == 'title':
+            self._in_title = True
+        elif tag == 'img':
+            self.images.append(attrs.get('src', ''))
+        elif tag == 'form':
+            self._form = Form(attrs)
+            self.forms.append(self._form)
+        elif self._form is None:
+            pass
+        elif tag == 'input' and 'name' in attrs:
+            kind = attrs.get('type', 'text').lower()
+            if kind in ('submit', 'image', 'button'):
+                self._form.buttons[attrs['name']] = (kind, attrs.get('value', ''))
+                if kind == 'image':
+                    self.images.append(attrs.get('src', ''))
+            elif kind in ('checkbox', 'radio'):
+                if 'checked' in attrs:
+                    self._form.add(attrs['name'], attrs.get('value', 'on'))
+            else:
+                self._form.add(attrs['name'], attrs.get('value', ''))
+        elif tag == 'select' and 'name' in attrs:
+            self._select = [ attrs['name'], None, None ]
+        elif tag == 'option' and self._select is not None:
+            value = attrs.get('value', '')
+            if self._select[1] is None or 'selected' in attrs:
+                self._select[1] = value
+        elif tag == 'textarea' and 'name' in attrs:
+            self._textarea = [ attrs['name'], '' ]
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'form':
+            self._form = None
+        elif tag == 'select' and self._select is not None:
+            if self._form is not None:
+                self._form.add(self._select[0], self._select[1] or '')
+            self._select = None
+        elif tag == 'textarea' and self._textarea is not None:
+            if self._form is not None:
+                self._form.add(*self._textarea)
+            self._textarea = None
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif self._textarea is not None:
+            self._textarea[1] += data
+
+    def form(self, id=None, name=None):
+        for form in self.forms:
+            if (id is not None and form.id == id) or (name is not None and form.name == name):
+                return form
+        raise ScrapeError('cannot find form {}'.format(id or name))
+
+def parse_page(html):
+    parser = PageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+class StatementParser(HTMLParser):
+    # the cells of the table rows inside td.grybg01; like a CSS descendant
+    # selector, a row has every td below it
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self._depth = 0
+        self._stack = []
+        self._open = []
+
+    def handle_starttag(self, tag, attrs):
+        classes = (dict(attrs).get('class') or '').split()
+        if tag in VOID_ELEMENTS or self._depth == 0 and not (tag == 'td' and 'grybg01' in classes):
+            return
+        self._depth += 1
+        self._stack.append(tag)
+        if tag == 'tr' and self._depth > 1:
+            self._open.append([ self._depth, [], [] ])
+        elif tag == 'td':
+            for row in self._open:
+                row[1].append('')
+                row[2].append(len(row[1]) - 1)
+
+    def handle_endtag(self, tag):
+        if self._depth == 0 or tag not in self._stack:
+            return
+        # also closes the elements whose end tag was omitted
+        while self._stack:
+            closed = self._stack.pop()
+            if closed == 'td':
+                for row in self._open:
+                    if row[2]:
+                        row[2].pop()
+            elif closed == 'tr' and self._open and self._open[-1][0] == self._depth:
+                self.rows.append(self._open.pop()[1])
+            self._depth -= 1
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        for row in self._open:
+            for i in row[2]:
+                row[1][i] += data
+
+def parse_statement(html, today=None):
+    # rows of (date, type1, loc1, type2, loc2, balance, delta); the year is
+    # not on the page and is counted back from today
+    parser = StatementParser()
+    parser.feed(html)
+    parser.close()
+    today = today or datetime.date.today()
+    year, month = today.year, today.month
+    rows = []
+    for cells in parser.rows:
+        cells = [ ' '.join(cell.split()) for cell in cells ]
+        if len(cells) != 7:
+            continue
+        m = re.match(r'^(\d*)/(\d*)$', cells[0])
+        if not m:
+            continue
+        new_month, day = int(m.group(1)), int(m.group(2))
+        if month < new_month:
+            year -= 1
+        month = new_month
+        if cells[1] == "繰":
+            continue
+        cells[0] = "{}-{}-{}".format(year, month, day)
+        cells[5] = re.sub(r'[¥,]', '', cells[5])
+        cells[6] = re.sub(r'[¥,]', '', cells[6])
+        rows.append(cells)
+    return rows
+
+def _text(response):
+    # the site does not always send the charset
+    if 'charset' not in response.headers.get('content-type', ''):
+        response.encoding = response.apparent_encoding
+    return response.text
+
+class Captcha:
+    # a login page and its captcha, fetched in their own session
+    def __init__(self, session, url, form, image):
+        self.session = session
+        self.url = url
+        self.form = form
+        self.image = image
+
+class SuicaClient:
+    # Logs in to Mobile Suica and scrapes the statement in-process: the
+    # captcha is solved from the response bytes by the given Solver. All
+    # sessions share one pool of keep-alive connections. Each captcha is
+    # fetched in a new session, so with prefetch the next captcha is fetched
+    # while a login form is being submitted and is ready when the login fails.
+    def __init__(self, solver, credentials, url=SUICA_URL, archiver=None, log=None,
+            reject_thresh=None, max_rejects=DEFAULT_MAX_REJECTS, prefetch=True,
+            timeout=DEFAULT_TIMEOUT, stats=False):
+        self.solver = solver
+        self.credentials = credentials
+        self.url = url
+        self.archiver = archiver
+        self.log = log
+        self.reject_thresh = reject_thresh
+        self.max_rejects = max_rejects
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.metrics = StageStats(enabled=stats)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.session = None
+        self.page = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.adapter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def new_session(self):
+        session = requests.Session()
+        session.headers['User-Agent'] = USER_AGENT
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        return session
+
+    def fetch_captcha(self):
+        session = self.new_session()
+        r0 = session.get(self.url, timeout=self.timeout)
+        r0.raise_for_status()
+        if 'ServiceOvertime.html' in r0.url:
+            raise ScrapeError('{} is out of service now'.format(self.url))
+        page = parse_page(_text(r0))
+        src = next((src for src in page.images if 'WebCaptchaImage.axd' in src), None)
+        if src is None:
+            raise ScrapeError('cannot find img tag')
+        r1 = session.get(urljoin(r0.url, src), headers={ 'Referer': r0.url }, timeout=self.timeout)
+        r1.raise_for_status()
+        self.metrics.increment('captchas')
+        return Captcha(session, r0.url, page.form(id='form1'), r1.content)
+
+    def submit(self, session, url, form, button, x=1, y=1):
+        action = urljoin(url, form.action)
+        if form.method == 'post':
+            r = session.post(action, data=form.data(button, x, y), headers={ 'Referer': url }, timeout=self.timeout)
+        else:
+            r = session.get(action, params=form.data(button, x, y), headers={ 'Referer': url }, timeout=self.timeout)
+        r.raise_for_status()
+        return r
+
+    def _log(self, line):
+        if self.log is not None:
+            print(line, file=self.log)
+            self.log.flush()
+
+    def login(self, retries=DEFAULT_RETRIES):
+        # the same form flow as scrape.pl; writes its login history
+        pending = None
+        rejects = 0
+        attempt = 0
+        while attempt < retries:
+            start = time.perf_counter()
+            captcha = pending.result() if pending is not None else self.fetch_captcha()
+            pending = None
+            fetched = time.perf_counter()
+            self.metrics.record('fetch', fetched - start)
+
+            text, bbox, score, confidence = self.solver.solve_bytes(captcha.image, confidence=True)
+            filename = (self.archiver.archive(captcha.image) if self.archiver is not None else None) or '-'
+            solved = time.perf_counter()
+            self.metrics.record('solve', solved - fetched)
+            if self.reject_thresh is not None and confidence < self.reject_thresh and rejects < self.max_rejects:
+                # a rejected captcha does not use up a login attempt
+                rejects += 1
+                self.metrics.increment('rejects')
+                self._log('# rejected "{}","{}",{:.4f}'.format(filename, text, confidence))
+                continue
+            attempt += 1
+            if len(text) != NCHARS:
+                continue
+
+            if self.prefetch and attempt < retries:
+                pending = self.executor.submit(self.fetch_captcha)
+            form = captcha.form
+            form['MailAddress'] = self.credentials['user']
+            form['Password'] = self.credentials['password']
+            form['WebCaptcha1__editor'] = text
+            form['WebCaptcha1_clientState'] = '[[[[null]],[],[]],[{},[]],null]'
+            form['WebCaptcha1__editor_clientState'] = '|0|01{}||[[[[]],[],[]],[{{}},[]],"01{}"]'.format(text, text)
+            r2 = self.submit(captcha.session, captcha.url, form, 'LOGIN', 100, 10)
+            self.metrics.increment('submissions')
+            self.metrics.record('submit', time.perf_counter() - solved)
+
+            html = _text(r2)
+            if LOGIN_TITLE.search(html):
+                self._log('"{}","{}",1,{:.4f}'.format(filename, text, confidence))
+                if pending is not None:
+                    pending.cancel()
+                    self.metrics.increment('prefetch_unused')
+                self.session = captcha.session
+                self.page = (r2.url, html)
+                return True
+            self._log('"{}","{}",0,{:.4f}'.format(filename, text, confidence))
+        raise ScrapeError('login unsuccessful')
+
+    def statement(self, today=None):
+        # the usage statement of the first Suica after login()
+        if self.session is None:
+            raise ScrapeError('not logged in')
+        url, html = self.page
+        r3 = self.submit(self.session, url, parse_page(html).form(name='form1'), 'NEXT', 50, 10)
+        if 'SuicaList.aspx' not in r3.url:
+            raise ScrapeError('unknown page transition')
+        r4 = self.session.post(urljoin(self.url, STATEMENT_PATH), headers={ 'Referer': r3.url }, timeout=self.timeout)
+        r4.raise_for_status()
+        html = _text(r4)
+        if OUT_OF_SERVICE in html:
+            raise ScrapeError('{} is out of service now'.format(r4.url))
+        return parse_statement(html, today)
+
+    def stats(self):
+        return self.metrics.stats()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Scraper')
+    parser.add_argument('--credentials', '-c', default='credentials.json', metavar='FILE',
+                        help='Mobile Suica account (default=credentials.json)')
+    parser.add_argument('--model', '-m', default=DEFAULT_MODEL_DIR, metavar='DIR',
+                        help='model directory (default={})'.format(DEFAULT_MODEL_DIR))
+    parser.add_argument('--gpu', '-g', type=int, default=DEFAULT_GPU)
+    parser.add_argument('--backend', choices=[ b for b in BACKENDS if b != 'int8' ], default='chainer',
+                        help='inference backend (default=chainer)')
+    parser.add_argument('--data', '-d', default=DEFAULT_DATASET_DIR, metavar='DIR',
+                        help='directory where the captcha images are saved (default={})'.format(DEFAULT_DATASET_DIR))
+    parser.add_argument('--no-archive', dest='archive', action='store_false', default=True,
+                        help='do not save the captcha images')
+    parser.add_argument('--log', default='log', metavar='DIR',
+                        help='directory of scrape.log (default=log)')
+    parser.add_argument('--reject', default='auto', metavar='THRESH',
+                        help='fetch another captcha when the confidence is below THRESH; '
+                             '"auto" uses the threshold chosen by calibrate.py, "none" submits every answer')
+    parser.add_argument('--max-rejects', dest='max_rejects', type=int, default=DEFAULT_MAX_REJECTS)
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='number of login attempts (default={})'.format(DEFAULT_RETRIES))
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false', default=True,
+                        help='do not fetch the next captcha while a login form is submitted')
+    parser.add_argument('--url', default=SUICA_URL,
+                        help='top page of the site, e.g. that of mock_suica.py (default={})'.format(SUICA_URL))
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='print the time spent in each step to stderr')
+    parser.add_argument('--db', action='store_true', default=False,
+                        help='store the transactions in the database of --dbi-config instead of printing them')
+    parser.add_argument('--dbi-config', dest='dbi_config', default=DEFAULT_CONFIG, metavar='FILE',
+                        help='database configuration (default={})'.format(DEFAULT_CONFIG))
+    args = parser.parse_args()
+
+    if not os.access(args.credentials, os.R_OK):
+        print('{}: not found'.format(args.credentials), file=sys.stderr)
+        print('Create it from credentials.json-sample and run chmod 600 {}'.format(args.credentials), file=sys.stderr)
+        exit(1)
+    with open(args.credentials, 'r') as fp:
+        credentials = json.load(fp)
+    if args.db:
+        dbi_config = load_config(args.dbi_config)
+
+    solver = Solver(dirname=args.model, gpu=args.gpu, backend=args.backend)
+    if args.reject == 'auto':
+        reject_thresh = solver.reject_thresh
+    else:
+        reject_thresh = float(args.reject) if args.reject != 'none' else None
+    archiver = Archiver(args.data) if args.archive else None
+
+    os.makedirs(args.log, exist_ok=True)
+    with open(os.path.join(args.log, "scrape.log"), "a", encoding="utf-8") as log:
+        print('#-------- {} --------'.format(time.ctime()), file=log)
+        with SuicaClient(solver, credentials, url=args.url, archiver=archiver, log=log,
+                reject_thresh=reject_thresh, max_rejects=args.max_rejects, prefetch=args.prefetch,
+                stats=args.stats) as client:
+            try:
+                client.login(retries=args.retries)
+                rows = client.statement()
+            except ScrapeError as e:
+                print(e, file=sys.stderr)
+                exit(1)
+            finally:
+                if archiver is not None:
+                    archiver.close()
+            if args.db:
+                with Ingester(dbi_config) as ingester:
+                    ingester.ingest(parse_row(row) for row in rows)
+            else:
+                writer = csv.writer(sys.stdout, quoting=csv.QUOTE_ALL, lineterminator='\n')
+                writer.writerows(rows)
+            if args.stats:
+                stats = client.stats()
+                for name, s in stats['stages'].items():
+                    print('{:16s} {:4d} calls {:10.3f} ms/call'.format(name, s['calls'], s['mean'] * 1000), file=sys.stderr)
+                for name, n in sorted(stats['counters'].items()):
+                    print('{:16s} {:4d}'.format(name, n), file=sys.stderr)
+
+# end of scrape.py
@@ -1,18 +1,43 @@
 #!/usr/bin/env python
 
-import os, json, cv2, random, argparse, glob, re, sys
+import os, io, json, random, argparse, glob, re, sys, threading, socketserver, itertools, multiprocessing, queue, base64, time
+import http.server
 import numpy as np
+from PIL import Image
 from constants import *
+from stage_stats import StageStats
+from calibration import Calibration
+from multibox_coder import DECODERS
 
-import chainer
+# chainer and cv2 are imported on demand, so that the numpy backend starts
+# without them
 
-from ssd import SSD
-from extractor import Extractor
-from multibox import Multibox
+BACKENDS = ('chainer', 'numpy', 'int8')
+
+def to_cpu(array):
+    return array if isinstance(array, np.ndarray) else array.get()
+
+def load_image(image):
+    # accepts a file name, raw GIF bytes or an array and returns a 2-D gray image
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3 and image.shape[2] == 3:
+            import cv2
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image.reshape(image.shape[-2:])
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return np.asarray(Image.open(io.BytesIO(image)).convert('L'))
+    import cv2
+    gif = cv2.VideoCapture(image)
+    ok, color_image = gif.read()
+    if not ok:
+        raise IOError("{}: cannot read the image".format(image))
+    return cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
 
 class Solver:
     def __init__(self, dirname=DEFAULT_MODEL_DIR, gpu=-1,
-            nms_thresh=DEFAULT_NMS_THRESH, score_thresh=DEFAULT_SCORE_THRESH):
+            nms_thresh=DEFAULT_NMS_THRESH, score_thresh=DEFAULT_SCORE_THRESH,
+            backend='chainer', stats=False, decoder='nms',
+            cascade=False, cascade_thresh=DEFAULT_CASCADE_THRESH):
         with open(os.path.join(dirname, "model.json"), 'r') as fp:
             metadata = json.load(fp)
 
@@ -20,55 +45,356 @@ class Solver:
         n_channel = metadata['n_channel']
         npz_file = metadata['file']
         self.class_labels = metadata['class_labels']
+        # fitted by calibrate.py; reject_thresh is the suggested threshold
+        calibration = metadata.get('calibration')
+        self.calibration = Calibration.from_dict(calibration)
+        self.reject_thresh = calibration.get('reject_thresh') if calibration else None
+
+        # memory-mapped weights (see convert-model.py) are preferred to the npz
+        # by the backends that run the float model
+        def load_float_weights():
+            if 'weights' not in metadata.get('formats', ['npz']):
+                return None
+            from weights import load_weights
+            return load_weights(os.path.join(dirname, metadata['weights_file']))
+
+        # accuracy of the int8 model minus that of the float model and the
+        # latencies of both, measured by quantize-model.py
+        self.accuracy_delta = None
+        self.int8_latency = None
+
+        if backend == 'numpy' or backend == 'int8':
+            if gpu >= 0:
+                raise ValueError('the {} backend cannot use a GPU'.format(backend))
+            from numpy_ssd import NumpySSD, QuantizedSSD, load_params
+            if backend == 'int8':
+                if 'int8' not in metadata:
+                    raise ValueError('{}: no int8 model; run quantize-model.py first'.format(dirname))
+                model_class = QuantizedSSD
+                params = load_params(os.path.join(dirname, metadata['int8']['file']))
+                accuracy = metadata['int8']['accuracy']
+                self.accuracy_delta = accuracy['int8'] - accuracy['float']
+                self.int8_latency = metadata['int8'].get('latency')
+            else:
+                model_class = NumpySSD
+                params = load_float_weights()
+                if params is None:
+                    params = load_params(os.path.join(dirname, npz_file))
+            self.model = model_class(params,
+                n_class=n_class, nms_thresh=nms_thresh, score_thresh=score_thresh,
+                grids=DEFAULT_GRIDS, aspect_ratios=DEFAULT_ASPECT_RATIOS,
+                variance=DEFAULT_VARIANCE, decoder=decoder)
+        elif backend == 'chainer':
+            import chainer
+            from ssd import SSD
+            self.model = SSD(n_class=n_class, n_channel=n_channel,
+                nms_thresh=nms_thresh, score_thresh=score_thresh,
+                grids=DEFAULT_GRIDS, aspect_ratios=DEFAULT_ASPECT_RATIOS,
+                variance=DEFAULT_VARIANCE, decoder=decoder)
+            params = load_float_weights()
+            if params is None:
+                chainer.serializers.load_npz(os.path.join(dirname, npz_file), self.model)
+            else:
+                chainer.serializers.NpzDeserializer(params).load(self.model)
 
-        self.model = SSD(n_class=n_class, n_channel=n_channel,
-            nms_thresh=nms_thresh, score_thresh=score_thresh,
-            grids=DEFAULT_GRIDS, aspect_ratios=DEFAULT_ASPECT_RATIOS,
-            variance=DEFAULT_VARIANCE)
-        chainer.serializers.load_npz(os.path.join(dirname, npz_file), self.model)
+            if gpu >= 0:
+                chainer.backends.cuda.get_device_from_id(gpu).use()
+                self.model.to_gpu(gpu)
+        else:
+            raise ValueError('unknown backend: {}'.format(backend))
 
-        if gpu >= 0:
-            chainer.backends.cuda.get_device_from_id(gpu).use()
-            self.model.to_gpu(gpu)
+        self._batch = None
+        # per-stage timings of solve_batch: load, convert, forward, nms, select
+        self.metrics = StageStats(enabled=stats)
+
+        # cascade: the reduced-width model trained by train.py --cascade-channel
+        # answers first, and this model only solves the images whose answer
+        # has fewer than NCHARS characters or a confidence below cascade_thresh
+        self.small = None
+        if cascade:
+            if 'cascade' not in metadata:
+                raise ValueError('{}: no cascade model; train it with train.py --cascade-channel'.format(dirname))
+            self.small = Solver(dirname=os.path.join(dirname, metadata['cascade']['dir']), gpu=gpu,
+                nms_thresh=nms_thresh, score_thresh=score_thresh, backend=backend, decoder=decoder)
+            self.small.metrics = self.metrics
+            self.cascade_thresh = cascade_thresh
+            self._cascade = { 'images': 0, 'escalated': 0, 'seconds': 0.0 }
 
     @property
     def xp(self):
         return self.model.xp
 
-    def solve(self, filename):
-        xp = self.xp
-        gif = cv2.VideoCapture(filename)
-        _, color_image = gif.read(0)
-        gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
-        h, w = gray_image.shape[:2]
-        img = xp.array(gray_image / 255.0, dtype=xp.float32).reshape(1, 1, h, w)
+    def stats(self):
+        stats = self.metrics.stats()
+        if self.small is not None:
+            stats['cascade'] = self.cascade_stats()
+        return stats
+
+    def cascade_stats(self):
+        # how often the cascade escalated to this model and the mean latency
+        c = self._cascade
+        n = max(c['images'], 1)
+        return { 'images': c['images'], 'escalated': c['escalated'], 'escalation_rate': c['escalated'] / n,
+            'latency': c['seconds'] / n, 'threshold': self.cascade_thresh }
+
+    def confidence(self, scores):
+        # probability that each string is right, from the per-character scores
+        return self.calibration(scores)
+
+    def solve(self, filename, confidence=False):
+        return self.solve_batch([filename], confidence=confidence)[0]
+
+    def solve_bytes(self, buf, confidence=False):
+        # decodes the GIF in memory with Pillow; no file or video backend involved
+        return self.solve_batch([bytes(buf)], confidence=confidence)[0]
+
+    def solve_batch(self, images, confidence=False):
+        # (text, bbox, score) of each image; with confidence, also the
+        # confidence of the answer by the calibration of the model that gave
+        # it, which is the small model for the answers the cascade kept
+        if len(images) == 0:
+            return []
+        watch = self.metrics.stopwatch(len(images))
+        grays = [ load_image(image) for image in images ]
+        watch.lap('load')
+        h, w = grays[0].shape
+        if any(gray.shape != (h, w) for gray in grays):
+            raise ValueError('all images in a batch must have the same size')
+
+        # reuse the input buffer between calls of the same batch size
+        shape = (len(grays), 1, h, w)
+        if self._batch is None or self._batch.shape != shape:
+            self._batch = np.empty(shape, dtype=np.float32)
+        batch = self._batch
+        # uint8 images are scaled to [0, 1]; float images already are
+        for i, gray in enumerate(grays):
+            if gray.dtype == np.uint8:
+                np.divide(gray, np.float32(255.0), out=batch[i, 0])
+            else:
+                batch[i, 0] = gray
+        x = self.xp.asarray(batch)
+        watch.lap('convert')
+
+        if self.small is None:
+            results = self._solve_array(x, watch)
+            conf = self.confidence([ score for _, _, score in results ]) if confidence else None
+        else:
+            results, conf = self._solve_cascade(x, watch)
+        watch.done()
+        if confidence:
+            return [ result + (float(c),) for result, c in zip(results, conf) ]
+        return results
+
+    def _solve_array(self, x, watch, prefix=''):
+        mb_locs, mb_confs = self.model.infer(x)
+        if self.metrics.enabled and self.xp is not np:
+            self.xp.cuda.Stream.null.synchronize()
+        watch.lap(prefix + 'forward')
+        bbox, label, score, count = self.model.decode(mb_locs, mb_confs)
+        watch.lap(prefix + 'nms')
+        results = self._select(bbox, label, score, count)
+        watch.lap(prefix + 'select')
+        return results
+
+    def _solve_cascade(self, x, watch):
+        start = time.perf_counter()
+        results = self.small._solve_array(x, watch, prefix='small/')
+        confidence = self.small.confidence([ score for _, _, score in results ])
+        escalate = [ i for i, ((text, _, _), c) in enumerate(zip(results, confidence))
+            if len(text) < NCHARS or c < self.cascade_thresh ]
+        confidence = np.array(confidence, dtype=np.float64)
+        if escalate:
+            index = self.xp.asarray(np.array(escalate))
+            escalated = self._solve_array(x[index], watch)
+            for i, result, c in zip(escalate, escalated, self.confidence([ score for _, _, score in escalated ])):
+                results[i] = result
+                confidence[i] = c
+        self._cascade['images'] += len(results)
+        self._cascade['escalated'] += len(escalate)
+        self._cascade['seconds'] += time.perf_counter() - start
+        self.metrics.increment('cascade_images', len(results))
+        self.metrics.increment('cascade_escalated', len(escalate))
+        return results, confidence
 
-        output = self.model.predict(img)
-        bbox, label, score = output[0][0], output[1][0], output[2][0]
-        bbox = chainer.dataset.to_device(-1, bbox)
-        label = chainer.dataset.to_device(-1, label)
-        score = chainer.dataset.to_device(-1, score)
+    def accuracy(self, images, texts, batchsize=DEFAULT_BATCHSIZE):
+        # ratio of exact matches, the metric of Evaluator
+        good_count = 0
+        for i in range(0, len(images), batchsize):
+            results = self.solve_batch(images[i:i+batchsize])
+            good_count += sum(text == gt for (text, _, _), gt in zip(results, texts[i:i+batchsize]))
+        return good_count / len(images) if len(images) > 0 else 0.0
 
-        if len(label) > NCHARS:
-            indices = np.argsort(score)[-1:-NCHARS-1:-1]
-            bbox = bbox[indices]
-            label = label[indices]
-            score = score[indices]
-        bbox = np.vectorize(lambda v: int(v + 0.5), otypes=[int])(bbox)
+    def _select(self, bbox, label, score, count):
+        # detections are sorted by score; keep the best NCHARS of each image
+        # and put them in left-to-right order
+        bbox = to_cpu(bbox[:, :NCHARS])
+        label = to_cpu(label[:, :NCHARS])
+        score = to_cpu(score[:, :NCHARS])
+        count = np.minimum(to_cpu(count), NCHARS)
 
-        indices = np.argsort(bbox[:, 1])
-        text = ''.join([ self.class_labels[label[i]] for i in indices ])
+        bbox = np.trunc(bbox + 0.5).astype(int)
+        valid = np.arange(bbox.shape[1])[None, :] < count[:, None]
+        order = np.argsort(np.where(valid, bbox[:, :, 1], np.iinfo(int).max), axis=1, kind='stable')
+        bbox = np.take_along_axis(bbox, order[:, :, None], axis=1)
+        label = np.take_along_axis(label, order, axis=1)
+        score = np.take_along_axis(score, order, axis=1)
 
-        return text, bbox[indices], score[indices]
+        results = []
+        for b, l, s, n in zip(bbox, label, score, count):
+            text = ''.join([ self.class_labels[i] for i in l[:n] ])
+            results.append((text, b[:n], s[:n]))
+        return results
+
+class Archiver:
+    # saves captcha images as DIR/NNNNN.gif from a background thread; the
+    # file is created when the image is archived, with the next number that
+    # is free, so a file that another program such as harvest-captcha.py or
+    # getcaptcha.pl saved in the meantime is never overwritten
+    def __init__(self, dirname):
+        os.makedirs(dirname, exist_ok=True)
+        numbers = [ int(f[:-4]) for f in os.listdir(dirname) if re.match(r'^\d+\.gif$', f) ]
+        self.dirname = dirname
+        self.counter = max(numbers) + 1 if numbers else 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def archive(self, data):
+        # returns the name of the file, or None when it cannot be created
+        with self.lock:
+            while True:
+                filename = os.path.join(self.dirname, "{:05d}.gif".format(self.counter))
+                self.counter += 1
+                try:
+                    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                    break
+                except FileExistsError:
+                    continue
+                except OSError as e:
+                    print("{}: {}".format(filename, e), file=sys.stderr)
+                    return None
+        self.queue.put((filename, fd, data))
+        return filename
+
+    def close(self):
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            filename, fd, data = self.queue.get()
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+            except OSError as e:
+                print("{}: {}".format(filename, e), file=sys.stderr)
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+            self.queue.task_done()
+
+class SolverServer:
+    def __init__(self, solver, archiver=None, reject_thresh=None):
+        self.solver = solver
+        self.archiver = archiver
+        self.reject_thresh = reject_thresh
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        # {"file": NAME} solves a file, {"gif": BASE64} solves the image data
+        # and, with "archive": true, saves it in the archive directory;
+        # {"stats": true} returns the statistics of the solver. The response
+        # has "reject": true when the confidence is below reject_thresh
+        if request.get('stats'):
+            return self.solver.stats()
+        self.solver.metrics.increment('requests')
+        if 'gif' in request:
+            data = base64.b64decode(request['gif'])
+            with self.lock:
+                text, bbox, score, confidence = self.solver.solve_bytes(data, confidence=True)
+            filename = None
+            if request.get('archive') and self.archiver is not None:
+                filename = self.archiver.archive(data)
+        else:
+            filename = request['file']
+            with self.lock:
+                text, bbox, score, confidence = self.solver.solve(filename, confidence=True)
+        response = { 'file': filename, 'text': text, 'bbs': bbox.tolist(), 'score': score.tolist(),
+            'confidence': confidence }
+        if self.reject_thresh is not None:
+            response['reject'] = confidence < self.reject_thresh
+        return response
+
+    def serve_stream(self, rfile, wfile):
+        # one request per line: either a JSON object or a bare file name
+        for line in rfile:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line) if line.startswith('{') else { 'file': line }
+                response = self.handle(request)
+            except Exception as e:
+                self.solver.metrics.increment('errors')
+                response = { 'error': str(e) }
+            wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            wfile.flush()
+
+    def serve_unix(self, path):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve_stream(self.rfile, self.wfile)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.unlink(path)
+                self.close()
+
+    def serve_metrics(self, port):
+        # exposes the statistics at http://localhost:PORT/metrics in the
+        # Prometheus text format from a background thread
+        metrics = self.solver.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        return httpd
+
+    def close(self):
+        if self.archiver is not None:
+            self.archiver.close()
 
 if __name__ == '__main__':
 
     colors = [(255, 0, 0), (0, 0, 255), (0, 255, 0), (255, 255, 0), (0, 255, 255)]
     scale = 4
-    font = cv2.FONT_HERSHEY_PLAIN
     text_color = (255, 0, 255)
 
     def display(filename, text, bbox, score):
+        import cv2
+        font = cv2.FONT_HERSHEY_PLAIN
         gif = cv2.VideoCapture(filename)
         _, color_image = gif.read(0)
         gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
@@ -83,45 +409,131 @@ if __name__ == '__main__':
         cv2.waitKey(0)
         # end of display()
 
-    def run(solvere, filenames, show, jsonfile):
+    def run(solver, filenames, show, jsonfile, batchsize, jobs, stats):
+        # images are decoded by worker processes while the solver runs
+        pool = None
+        if jobs == 1 or len(filenames) <= batchsize:
+            images = map(load_image, filenames)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            images = pool.imap(load_image, filenames, chunksize=batchsize)
         results = {}
-        for filename in filenames:
-            text, bbox, score = solver.solve(filename)
-            print("{} {}".format(filename, text))
-            if show:
-                display(filename, text, bbox, score)
-            results[filename] = { 'file': filename, 'text': text, 'bbs': bbox.tolist(), 'score': score.tolist() }
+        for i in range(0, len(filenames), batchsize):
+            batch = filenames[i:i+batchsize]
+            grays = list(itertools.islice(images, len(batch)))
+            solved = solver.solve_batch(grays, confidence=True)
+            for filename, (text, bbox, score, conf) in zip(batch, solved):
+                print("{} {}".format(filename, text))
+                if show:
+                    display(filename, text, bbox, score)
+                results[filename] = { 'file': filename, 'text': text, 'bbs': bbox.tolist(), 'score': score.tolist(),
+                    'confidence': float(conf) }
             # end of for
+        if pool is not None:
+            pool.terminate()
+        if stats:
+            # with --stats the results and the statistics are written together
+            results = { 'results': results, 'stats': solver.stats() }
+            print_stats(solver.stats())
         if jsonfile is not None:
             with open(jsonfile, "w") as fp:
                 json.dump(results, fp, indent=2)
         # end of run()
 
+    def print_stats(stats):
+        print("{:14s} {:>8s} {:>8s} {:>12s} {:>12s} {:>10s}".format(
+            'stage', 'calls', 'images', 'ms/call', 'ms/image', 'max(ms)'), file=sys.stderr)
+        for name, s in stats['stages'].items():
+            print("{:14s} {:8d} {:8d} {:12.3f} {:12.3f} {:10.3f}".format(
+                name, s['calls'], s['images'], s['mean'] * 1000, s['per_image'] * 1000, s['max'] * 1000), file=sys.stderr)
+        if 'cascade' in stats:
+            c = stats['cascade']
+            print("cascade: {}/{} images escalated ({:.1%}), {:.3f} ms/image".format(
+                c['escalated'], c['images'], c['escalation_rate'], c['latency'] * 1000), file=sys.stderr)
+        # end of print_stats()
+
     # main routine starts here
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', default='model')
     parser.add_argument('--gpu', type=int, default=-1)
     parser.add_argument('--thresh', type=float, default=DEFAULT_SCORE_THRESH)
+    parser.add_argument('--backend', choices=BACKENDS, default='chainer',
+                        help='int8 runs the model of quantize-model.py to check the accuracy of its quantization; '
+                             'it computes in floats and is not faster than numpy')
+    parser.add_argument('--decoder', choices=DECODERS, default='nms',
+                        help='nms: generic non-maximum suppression, grid: exactly five characters from left to right')
+    parser.add_argument('--cascade', action='store_true', default=False,
+                        help='solve with the small model of the cascade first (train.py --cascade-channel)')
+    parser.add_argument('--cascade-thresh', dest='cascade_thresh', type=float, default=DEFAULT_CASCADE_THRESH,
+                        help='confidence below which the full model is used (default={})'.format(DEFAULT_CASCADE_THRESH))
     parser.add_argument('--dir', metavar='DIR', type=str, default=None)
     parser.add_argument('--file', metavar='FILE', nargs='+', type=str, default=None)
     parser.add_argument('--json', metavar='FILE', default=None)
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
+    parser.add_argument('--jobs', type=int, default=None)
     parser.add_argument('--show', action='store_true', default=False)
+    parser.add_argument('--serve', action='store_true', default=False)
+    parser.add_argument('--socket', metavar='PATH', type=str, default=None)
+    parser.add_argument('--archive', metavar='DIR', type=str, default=None)
+    parser.add_argument('--reject', metavar='THRESH', default=None,
+                        help='with --serve, mark answers whose confidence is below THRESH as rejected; '
+                             '"auto" uses the threshold chosen by calibrate.py, "none" rejects nothing')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='collect per-stage timings; printed to stderr and written to --json')
+    parser.add_argument('--metrics-port', dest='metrics_port', metavar='PORT', type=int, default=None,
+                        help='with --serve, expose the timings at http://localhost:PORT/metrics')
     args = parser.parse_args()
 
-    if not args.dir and not args.file:
-        print('Either --dir or --file must be specified.')
+    if args.serve:
+        if args.dir or args.file:
+            print('--serve cannot be used with --dir or --file.')
+            exit(1)
+    elif not args.dir and not args.file:
+        print('Either --dir, --file or --serve must be specified.')
         exit(1)
     if args.dir and args.file:
         print('--dir and --file are exclusive.')
         exit(1)
+    if args.reject not in (None, 'auto', 'none'):
+        try:
+            float(args.reject)
+        except ValueError:
+            print('--reject must be a number, "auto" or "none".')
+            exit(1)
+    if (args.socket or args.archive or args.metrics_port or args.reject) and not args.serve:
+        print('--socket, --archive, --metrics-port and --reject require --serve.')
+        exit(1)
 
-    solver = Solver(dirname=args.model, gpu=args.gpu, score_thresh=args.thresh)
+    solver = Solver(dirname=args.model, gpu=args.gpu, score_thresh=args.thresh, backend=args.backend,
+        stats=args.stats or args.metrics_port is not None, decoder=args.decoder,
+        cascade=args.cascade, cascade_thresh=args.cascade_thresh)
+    if solver.accuracy_delta is not None:
+        print('int8 model: accuracy {:+.4f} against the float model'.format(solver.accuracy_delta), file=sys.stderr)
+        if solver.int8_latency is not None:
+            print('int8 model: {:.3f} ms/image against {:.3f} ms/image of the float model'.format(
+                solver.int8_latency['int8'] * 1000, solver.int8_latency['float'] * 1000), file=sys.stderr)
 
-    if args.dir:
-        filenames = sorted(glob.glob(os.path.join(dirname, "*.gif")))
-        run(solver, filenames, show=args.show, jsonfile=args.json)
+    if args.serve:
+        if args.reject == 'auto':
+            reject_thresh = solver.reject_thresh
+        elif args.reject is None or args.reject == 'none':
+            reject_thresh = None
+        else:
+            reject_thresh = float(args.reject)
+        server = SolverServer(solver, archiver=Archiver(args.archive) if args.archive else None,
+            reject_thresh=reject_thresh)
+        if args.metrics_port is not None:
+            server.serve_metrics(args.metrics_port)
+        if args.socket:
+            server.serve_unix(args.socket)
+        else:
+            server.serve_stream(sys.stdin.buffer, sys.stdout.buffer)
+            server.close()
+    elif args.dir:
+        filenames = sorted(glob.glob(os.path.join(args.dir, "*.gif")))
+        run(solver, filenames, show=args.show, jsonfile=args.json, batchsize=args.batchsize, jobs=args.jobs, stats=args.stats)
     else:
-        run(solver, args.file, show=args.show, jsonfile=args.json)
+        run(solver, args.file, show=args.show, jsonfile=args.json, batchsize=args.batchsize, jobs=args.jobs, stats=args.stats)
 
 # solve.py
@@ -2,10 +2,10 @@ import chainer
 
 from extractor import Extractor
 from multibox import Multibox
-from multibox_coder import MultiboxCoder
+from multibox_coder import MultiboxCoder, DECODERS
 
 class SSD(chainer.Chain):
-    def __init__(self, n_class, n_channel, grids, aspect_ratios, variance, nms_thresh, score_thresh):
+    def __init__(self, n_class, n_channel, grids, aspect_ratios, variance, nms_thresh, score_thresh, decoder='nms'):
         super(SSD, self).__init__()
         n_feature_map = len(grids)
         with self.init_scope():
@@ -13,6 +13,9 @@ class SSD(chainer.Chain):
             self.multibox = Multibox(n_class+1, aspect_ratios)
         self.nms_thresh = nms_thresh
         self.score_thresh = score_thresh
+        if decoder not in DECODERS:
+            raise ValueError('unknown decoder: {}'.format(decoder))
+        self.decoder = decoder
         self.coder = MultiboxCoder(grids=grids, aspect_ratios=aspect_ratios)
 
     @property
@@ -34,23 +37,29 @@ class SSD(chainer.Chain):
     def forward(self, x):
         return self.multibox(self.extractor(x))
 
-    def predict(self, imgs):
-        x = [ self.xp.array(img) for img in imgs ]
-
+    def infer(self, x):
         with chainer.using_config('train', False), \
           chainer.function.no_backprop_mode():
-            x = chainer.Variable(self.xp.stack(x))
-            mb_locs, mb_confs = self.forward(x)
-            mb_locs, mb_confs = mb_locs.array, mb_confs.array
-
-        bboxes = []
-        labels = []
-        scores = []
-        for mb_loc, mb_conf in zip(mb_locs, mb_confs):
-            bbox, label, score = self.coder.decode(
-                mb_loc, mb_conf, self.nms_thresh, self.score_thresh)
-            bboxes.append(bbox)
-            labels.append(label)
-            scores.append(score)
+            mb_locs, mb_confs = self.forward(chainer.Variable(x))
+        return mb_locs.array, mb_confs.array
+
+    def decode(self, mb_locs, mb_confs):
+        if self.decoder == 'grid':
+            return self.coder.decode_grid(mb_locs, mb_confs, self.nms_thresh)
+        return self.coder.decode_batch(
+            mb_locs, mb_confs, self.nms_thresh, self.score_thresh)
 
+    def predict_padded(self, imgs):
+        if getattr(imgs, 'ndim', None) == 4:
+            x = self.xp.asarray(imgs)
+        else:
+            x = self.xp.stack([ self.xp.array(img) for img in imgs ])
+        return self.decode(*self.infer(x))
+
+    def predict(self, imgs):
+        bbox, label, score, count = self.predict_padded(imgs)
+        count = chainer.backends.cuda.to_cpu(count)
+        bboxes = [ b[:n] for b, n in zip(bbox, count) ]
+        labels = [ l[:n] for l, n in zip(label, count) ]
+        scores = [ s[:n] for s, n in zip(score, count) ]
         return bboxes, labels, scores
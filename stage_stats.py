@@ -0,0 +1,107 @@
+import time, bisect, threading
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class _Stage:
+    def __init__(self, n_bucket):
+        self.calls = 0
+        self.images = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bucket_counts = [0] * (n_bucket + 1)
+
+class Stopwatch:
+    # measures the consecutive stages of one call; lap(STAGE) records the
+    # time since the previous lap and done() the time of the whole call
+    def __init__(self, stats, n):
+        self.stats = stats
+        self.n = n
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stats.record(stage, now - self.last, self.n)
+        self.last = now
+
+    def done(self):
+        self.stats.record('total', time.perf_counter() - self.start, self.n)
+
+class _NullStopwatch:
+    def lap(self, stage):
+        pass
+
+    def done(self):
+        pass
+
+class StageStats:
+    # Thread-safe latency statistics of named stages: calls, images, total
+    # and largest time, and a histogram of the time per call. A disabled
+    # instance records nothing and costs one method call per stage.
+    def __init__(self, enabled=True, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    def stopwatch(self, n=1):
+        return Stopwatch(self, n) if self.enabled else _NullStopwatch()
+
+    def record(self, stage, seconds, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = _Stage(len(self.buckets))
+            s.calls += 1
+            s.images += n
+            s.total += seconds
+            s.max = max(s.max, seconds)
+            s.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def increment(self, counter, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def stats(self):
+        # { 'stages': { STAGE: {...} }, 'counters': { COUNTER: n } } with
+        # times in seconds and cumulative histogram buckets as [le, count]
+        with self.lock:
+            stages = {}
+            for name, s in self._stages.items():
+                cumulative = 0
+                buckets = []
+                for le, count in zip(self.buckets + (float('inf'),), s.bucket_counts):
+                    cumulative += count
+                    buckets.append(['+Inf' if le == float('inf') else le, cumulative])
+                stages[name] = { 'calls': s.calls, 'images': s.images, 'total': s.total, 'max': s.max,
+                    'mean': s.total / s.calls, 'per_image': s.total / max(s.images, 1),
+                    'buckets': buckets }
+            return { 'stages': stages, 'counters': dict(self._counters) }
+
+    def prometheus(self, prefix='captcha_solver'):
+        # the statistics in the Prometheus text exposition format
+        stats = self.stats()
+        lines = [
+            '# HELP {}_stage_seconds Time per call of each solver stage.'.format(prefix),
+            '# TYPE {}_stage_seconds histogram'.format(prefix),
+        ]
+        for name, s in stats['stages'].items():
+            for le, count in s['buckets']:
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, name, le, count))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {!r}'.format(prefix, name, s['total']))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, s['calls']))
+        lines.append('# HELP {}_stage_images_total Images processed by each solver stage.'.format(prefix))
+        lines.append('# TYPE {}_stage_images_total counter'.format(prefix))
+        for name, s in stats['stages'].items():
+            lines.append('{}_stage_images_total{{stage="{}"}} {}'.format(prefix, name, s['images']))
+        for name, n in sorted(stats['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, n))
+        return '\n'.join(lines) + '\n'
+
+# stage_stats.py
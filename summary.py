@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import sys, argparse, itertools
+
+# Aggregates of the transaction table of dbi-config.json, kept in tables
+# next to it ({table}_daily, _monthly, _station, _type) and updated with the
+# rows added since the last update, so reports never scan the whole
+# history. The same pass checks that the balance of each row is that of the
+# row before it plus its delta; the rows where it is not are listed in
+# {table}_breaks. The rows of a day are put in the order in which their
+# balances follow each other, as they may have been stored by different
+# scrapes; rows that do not follow any other are taken in the order of
+# their row ids.
+
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {t}_daily (
+    date date PRIMARY KEY,
+    n int,
+    spend int,
+    charge int,
+    balance int
+);
+CREATE TABLE IF NOT EXISTS {t}_monthly (
+    month char(7) PRIMARY KEY,
+    n int,
+    spend int,
+    charge int
+);
+CREATE TABLE IF NOT EXISTS {t}_station (
+    station varchar(16) PRIMARY KEY,
+    departures int,
+    arrivals int,
+    spend int
+);
+CREATE TABLE IF NOT EXISTS {t}_type (
+    type varchar(16) PRIMARY KEY,
+    n int,
+    spend int,
+    charge int
+);
+CREATE TABLE IF NOT EXISTS {t}_breaks (
+    row_id bigint PRIMARY KEY,
+    date date,
+    expected int,
+    balance int
+);
+CREATE TABLE IF NOT EXISTS {t}_state (
+    name varchar(32) PRIMARY KEY,
+    value bigint
+)
+"""
+
+SPEND = "CASE WHEN delta < 0 THEN -delta ELSE 0 END"
+CHARGE = "CASE WHEN delta > 0 THEN delta ELSE 0 END"
+
+# (table, key column, columns that are added up, the select of the rows
+# after {i} > {p}, grouped by the key); the closing balance of a day is set
+# by the balance check
+AGGREGATES = (
+    ('daily', 'date', ('n', 'spend', 'charge'),
+     "SELECT date, count(*), sum({spend}), sum({charge}) FROM {t} WHERE {i} > {p} GROUP BY date"),
+    ('monthly', 'month', ('n', 'spend', 'charge'),
+     "SELECT substr(date, 1, 7), count(*), sum({spend}), sum({charge}) FROM {t} WHERE {i} > {p} GROUP BY 1"),
+    ('station', 'station', ('departures', 'arrivals', 'spend'),
+     "SELECT station, sum(departure), sum(arrival), sum(spend) FROM ("
+     " SELECT loc1 AS station, 1 AS departure, CASE WHEN loc2 = loc1 THEN 1 ELSE 0 END AS arrival, {spend} AS spend"
+     " FROM {t} WHERE {i} > {p} AND loc1 <> ''"
+     " UNION ALL SELECT loc2, 0, 1, {spend} FROM {t} WHERE {i} > {p} AND loc2 <> '' AND (loc1 IS NULL OR loc1 <> loc2)"
+     ") new GROUP BY station"),
+    ('type', 'type', ('n', 'spend', 'charge'),
+     "SELECT coalesce(type1, ''), count(*), sum({spend}), sum({charge}) FROM {t} WHERE {i} > {p} GROUP BY 1"),
+)
+
+def _order(rows, balance):
+    # the rows (row id, date, balance, delta) of one day, starting from the
+    # closing balance of the day before
+    rest = list(rows)
+    ordered = []
+    while rest:
+        i = next((k for k, row in enumerate(rest)
+            if balance is not None and row[2] is not None and row[2] - (row[3] or 0) == balance), 0)
+        ordered.append(rest.pop(i))
+        if ordered[-1][2] is not None:
+            balance = ordered[-1][2]
+    return ordered
+
+class Summary:
+    def __init__(self, db, dialect, table):
+        self.db = db
+        self.dialect = dialect
+        self.table = table
+        self.param = '?' if dialect == 'sqlite' else '%s'
+        # legacy SQLite tables written by scrape.pl have no ids
+        self.row_id = 'rowid' if dialect == 'sqlite' else 'id'
+        self.upserts = []
+        for name, key, columns, select in AGGREGATES:
+            select = select.format(t=table, i=self.row_id, p=self.param, spend=SPEND, charge=CHARGE)
+            if dialect == 'sqlite':
+                sets = ', '.join('{0} = {0} + excluded.{0}'.format(c) for c in columns)
+                sql = "INSERT INTO {t}_{n} ({k}, {c}) {q} ON CONFLICT ({k}) DO UPDATE SET {s}"
+            else:
+                sets = ', '.join('{0} = {0} + VALUES({0})'.format(c) for c in columns)
+                sql = "INSERT INTO {t}_{n} ({k}, {c}) {q} ON DUPLICATE KEY UPDATE {s}"
+            self.upserts.append((sql.format(t=table, n=name, k=key, c=', '.join(columns), q=select, s=sets),
+                select.count(self.param)))
+
+    def setup(self, cursor):
+        # a new summary starts from the first row of the table
+        for sql in SUMMARY_SCHEMA.format(t=self.table).split(';'):
+            cursor.execute(sql)
+        if self._get(cursor, 'summarized') is None:
+            cursor.execute("INSERT INTO {}_state (name, value) VALUES ({p}, {p})".format(self.table, p=self.param),
+                ('summarized', 0))
+
+    def _get(self, cursor, name):
+        cursor.execute("SELECT value FROM {}_state WHERE name = {}".format(self.table, self.param), (name,))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def update(self, cursor):
+        # adds the rows after the last update to the aggregates and checks
+        # the balances around them; returns the number of rows added and the
+        # breaks found. Run in the transaction that inserted the rows.
+        t, row_id, p = self.table, self.row_id, self.param
+        mark = self._get(cursor, 'summarized')
+        cursor.execute("SELECT count(*), max({i}), min(date), max(date) FROM {t} WHERE {i} > {p}".format(t=t, i=row_id, p=p),
+            (mark,))
+        n, last_id, first, last = cursor.fetchone()
+        if not n:
+            return 0, []
+        for sql, n_params in self.upserts:
+            cursor.execute(sql, (mark,) * n_params)
+        breaks = self._check(cursor, str(first), str(last))
+        cursor.execute("UPDATE {}_state SET value = {p} WHERE name = {p}".format(t, p=p), (last_id, 'summarized'))
+        return n, breaks
+
+    def _check(self, cursor, first, last):
+        # checks the days of the new rows and the day after them, which
+        # starts from a balance that may have changed
+        t, row_id, p = self.table, self.row_id, self.param
+        cursor.execute("SELECT balance FROM {t}_daily WHERE date < {p} ORDER BY date DESC LIMIT 1".format(t=t, p=p), (first,))
+        row = cursor.fetchone()
+        balance = row[0] if row else None
+        cursor.execute("SELECT min(date) FROM {t} WHERE date > {p}".format(t=t, p=p), (last,))
+        after = cursor.fetchone()[0]
+        last = str(after) if after is not None else last
+        cursor.execute("SELECT {i}, date, balance, delta FROM {t} WHERE date >= {p} AND date <= {p} ORDER BY date, {i}".format(
+            t=t, i=row_id, p=p), (first, last))
+
+        breaks = []
+        closing = []
+        for date, rows in itertools.groupby(cursor.fetchall(), key=lambda row: str(row[1])):
+            for i, _, b, delta in _order(rows, balance):
+                if b is None:
+                    continue
+                if balance is not None and balance + (delta or 0) != b:
+                    breaks.append((i, date, balance + (delta or 0), b))
+                balance = b
+            closing.append((balance, date))
+        cursor.execute("DELETE FROM {t}_breaks WHERE date >= {p} AND date <= {p}".format(t=t, p=p), (first, last))
+        cursor.executemany("INSERT INTO {}_breaks (row_id, date, expected, balance) VALUES ({p}, {p}, {p}, {p})".format(
+            t, p=p), breaks)
+        cursor.executemany("UPDATE {}_daily SET balance = {p} WHERE date = {p}".format(t, p=p), closing)
+        return breaks
+
+    # queries
+
+    def _query(self, sql, args=()):
+        cursor = self.db.cursor()
+        cursor.execute(sql.format(t=self.table, p=self.param), args)
+        names = [ d[0] for d in cursor.description ]
+        return [ dict(zip(names, [ str(v) if n in ('date', 'month') else v for n, v in zip(names, row) ]))
+            for row in cursor.fetchall() ]
+
+    def _range(self, column, start, end):
+        where = []
+        args = []
+        if start is not None:
+            where.append("{} >= {{p}}".format(column))
+            args.append(start)
+        if end is not None:
+            where.append("{} <= {{p}}".format(column))
+            args.append(end)
+        return (" WHERE " + " AND ".join(where) if where else ""), tuple(args)
+
+    def daily(self, start=None, end=None):
+        # start and end are dates like 2019-01-02, both included
+        where, args = self._range('date', start, end)
+        return self._query("SELECT date, n, spend, charge, balance FROM {t}_daily" + where + " ORDER BY date", args)
+
+    def monthly(self, start=None, end=None):
+        # start and end are months like 2019-01, both included
+        where, args = self._range('month', start, end)
+        return self._query("SELECT month, n, spend, charge FROM {t}_monthly" + where + " ORDER BY month", args)
+
+    def stations(self, limit=None):
+        # the stations from or to which most was spent first
+        return self._query("SELECT station, departures, arrivals, spend FROM {t}_station ORDER BY spend DESC, station"
+            + (" LIMIT {:d}".format(limit) if limit else ""))
+
+    def types(self):
+        return self._query("SELECT type, n, spend, charge FROM {t}_type ORDER BY n DESC, type")
+
+    def breaks(self):
+        return self._query("SELECT row_id, date, expected, balance FROM {t}_breaks ORDER BY date, row_id")
+
+if __name__ == '__main__':
+    from ingest import Ingester, load_config, DEFAULT_CONFIG
+    parser = argparse.ArgumentParser(description='Mobile Suica Scraper -- Summary Report')
+    parser.add_argument('report', choices=('daily', 'monthly', 'stations', 'types', 'breaks'))
+    parser.add_argument('--config', default=DEFAULT_CONFIG, metavar='FILE',
+                        help='database configuration (default={})'.format(DEFAULT_CONFIG))
+    parser.add_argument('--start', default=None, help='first date or month of daily and monthly')
+    parser.add_argument('--end', default=None, help='last date or month of daily and monthly')
+    parser.add_argument('--limit', type=int, default=None, help='number of stations')
+    args = parser.parse_args()
+
+    # opening the table brings the summary up to date
+    with Ingester(load_config(args.config)) as ingester:
+        ingester.ingest([])
+        summary = ingester.summary
+        if args.report in ('daily', 'monthly'):
+            rows = getattr(summary, args.report)(args.start, args.end)
+        elif args.report == 'stations':
+            rows = summary.stations(args.limit)
+        else:
+            rows = getattr(summary, args.report)()
+    if rows:
+        print(','.join(rows[0]))
+    for row in rows:
+        print(','.join('' if v is None else str(v) for v in row.values()))
+
+# end of summary.py
@@ -0,0 +1,55 @@
+import os, glob, hashlib
+import numpy as np
+import chainer
+
+CACHE_DIR = "cache"
+CACHE_CHUNK = 1024
+
+def target_cache_key(bboxes, labels, coder, iou_thresh=0.5):
+    # the targets depend only on the annotations and the default boxes
+    h = hashlib.sha1()
+    for a in (bboxes, labels, chainer.backends.cuda.to_cpu(coder.default_bbox),
+              np.array(coder.variance), np.array(iou_thresh)):
+        a = np.ascontiguousarray(a)
+        h.update("{}{}".format(a.dtype.str, a.shape).encode('ascii'))
+        h.update(a.tobytes())
+    return h.hexdigest()[:16]
+
+def load_targets(dataset_dir, bboxes, labels, coder, iou_thresh=0.5):
+    # Returns (mb_locs, mb_labels) for every record as read-only memory maps,
+    # encoding them first if no cache for the current annotations and coder
+    # settings exists. Caches of other settings are removed.
+    cache_dir = os.path.join(dataset_dir, CACHE_DIR)
+    key = target_cache_key(bboxes, labels, coder, iou_thresh)
+    loc_file = os.path.join(cache_dir, "mb_loc-{}.npy".format(key))
+    label_file = os.path.join(cache_dir, "mb_label-{}.npy".format(key))
+
+    if not (os.path.isfile(loc_file) and os.path.isfile(label_file)):
+        os.makedirs(cache_dir, exist_ok=True)
+        for f in glob.glob(os.path.join(cache_dir, "mb_*-*.npy*")):
+            os.remove(f)
+        print("Encoding the training targets into {}...".format(cache_dir))
+        _build(loc_file, label_file, bboxes, labels, coder, iou_thresh)
+
+    return np.load(loc_file, mmap_mode='r'), np.load(label_file, mmap_mode='r')
+
+def _build(loc_file, label_file, bboxes, labels, coder, iou_thresh):
+    xp = coder.xp
+    n_data = len(bboxes)
+    n_default = len(coder.default_bbox)
+    mb_locs = np.lib.format.open_memmap(loc_file + ".tmp",
+        mode='w+', dtype=np.float32, shape=(n_data, n_default, 4))
+    mb_labels = np.lib.format.open_memmap(label_file + ".tmp",
+        mode='w+', dtype=np.int32, shape=(n_data, n_default))
+    for i in range(0, n_data, CACHE_CHUNK):
+        mb_loc, mb_label = coder.encode_batch(
+            xp.asarray(bboxes[i:i+CACHE_CHUNK]), xp.asarray(labels[i:i+CACHE_CHUNK]), iou_thresh)
+        mb_locs[i:i+CACHE_CHUNK] = chainer.backends.cuda.to_cpu(mb_loc)
+        mb_labels[i:i+CACHE_CHUNK] = chainer.backends.cuda.to_cpu(mb_label)
+    mb_locs.flush()
+    mb_labels.flush()
+    del mb_locs, mb_labels
+    os.replace(loc_file + ".tmp", loc_file)
+    os.replace(label_file + ".tmp", label_file)
+
+# target_cache.py
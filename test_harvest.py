@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest, importlib.util
+from mock_suica import MockSuica
+from captcha_index import CaptchaIndex
+
+# The harvester and its index against the stand-in site: run with
+# python -m unittest test_harvest
+
+spec = importlib.util.spec_from_file_location('harvest_captcha',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'harvest-captcha.py'))
+harvest_captcha = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(harvest_captcha)
+
+CAPTCHAS = [ (b'GIF89a' + bytes([ i ]) * 16, 'abcd{}'.format(i)) for i in range(3) ]
+CREDENTIALS = { 'user': 'user@example.com', 'password': 'password' }
+
+class HarvestTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.site = MockSuica(list(CAPTCHAS), CREDENTIALS)
+        self.server = self.site.serve()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.max_duplicates = harvest_captcha.MAX_DUPLICATES
+        # a site with three captchas runs out of new images quickly
+        harvest_captcha.MAX_DUPLICATES = 30
+
+    def tearDown(self):
+        harvest_captcha.MAX_DUPLICATES = self.max_duplicates
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dirname)
+
+    def harvest(self, n):
+        with CaptchaIndex(self.dirname) as index:
+            harvester = harvest_captcha.Harvester(index, url=self.url, rate=1000, burst=10, sessions=2)
+            return harvester.run(n), index.duplicates
+
+    def contents(self):
+        files = sorted(f for f in os.listdir(self.dirname) if f.endswith('.gif'))
+        result = {}
+        for f in files:
+            with open(os.path.join(self.dirname, f), 'rb') as fp:
+                result[f] = fp.read()
+        return result
+
+    def test_dedup(self):
+        saved, _ = self.harvest(3)
+        self.assertEqual(saved, 3)
+        contents = self.contents()
+        self.assertEqual(sorted(contents), [ '00000.gif', '00001.gif', '00002.gif' ])
+        self.assertEqual(sorted(contents.values()), sorted(data for data, _ in CAPTCHAS))
+
+        # every image of the site is there, so a further harvest only finds
+        # duplicates and gives up
+        saved, duplicates = self.harvest(1)
+        self.assertEqual(saved, 0)
+        self.assertGreaterEqual(duplicates, harvest_captcha.MAX_DUPLICATES)
+        self.assertEqual(len(self.contents()), 3)
+
+    def test_resume(self):
+        self.harvest(2)
+        with CaptchaIndex(self.dirname) as index:
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index.counter, 2)
+
+        # the next harvest continues with the next number and the image the
+        # first one did not get
+        saved, _ = self.harvest(1)
+        self.assertEqual(saved, 1)
+        contents = self.contents()
+        self.assertEqual(sorted(contents), [ '00000.gif', '00001.gif', '00002.gif' ])
+        self.assertEqual(len(set(contents.values())), 3)
+
+    def test_foreign_file(self):
+        # a file that another program saves under the next number while the
+        # index is open is kept and indexed
+        self.harvest(1)
+        with CaptchaIndex(self.dirname) as index:
+            with open(os.path.join(self.dirname, '00001.gif'), 'wb') as fp:
+                fp.write(b'annotated')
+            data = next(data for data, _ in CAPTCHAS if data not in index)
+            self.assertEqual(index.add(data), '00002.gif')
+            self.assertIn(b'annotated', index)
+        self.assertEqual(self.contents()['00001.gif'], b'annotated')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# end of test_harvest.py
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, argparse, copy, json, glob, re
+import os, argparse, json, glob, re
 import numpy as np
 
 import chainer
@@ -8,30 +8,33 @@ from chainer import serializers
 from chainer import training
 from chainer.training import extensions
 from chainer.training import triggers
-from chainer.datasets import TransformDataset
 
 from ssd import SSD
-from dataset import Dataset
+from dataset import Dataset, build_pack, SPLIT_MODES
+from image_hash import DEFAULT_RADIUS
 from evaluator import Evaluator
 from extractor import Extractor
 from multibox import Multibox
 from constants import *
 from multibox_loss import multibox_loss
+from target_cache import load_targets
 
 import cv2
 cv2.setNumThreads(0)
 
 class MultiboxTrainChain(chainer.Chain):
-    def __init__(self, model, alpha=1, k=3):
+    def __init__(self, model, alpha=1, k=3, comm=None, fused=False):
         super(MultiboxTrainChain, self).__init__()
         with self.init_scope():
             self.model = model
         self.alpha = alpha
         self.k = k
+        self.comm = comm
+        self.fused = fused
 
     def forward(self, imgs, gt_mb_locs, gt_mb_labels):
         mb_locs, mb_confs = self.model(imgs)
-        loc_loss, conf_loss = multibox_loss(mb_locs, mb_confs, gt_mb_locs, gt_mb_labels, self.k)
+        loc_loss, conf_loss = multibox_loss(mb_locs, mb_confs, gt_mb_locs, gt_mb_labels, self.k, self.comm, self.fused)
         loss = loc_loss * self.alpha + conf_loss
 
         chainer.reporter.report(
@@ -40,58 +43,85 @@ class MultiboxTrainChain(chainer.Chain):
 
         return loss
 
-class Transform:
+class MultiboxConverter:
+    # encodes the ground truth of a whole minibatch on the model's device
     def __init__(self, coder):
-        self.coder = copy.copy(coder)
-        self.coder.to_cpu()
+        self.coder = coder
 
-    def __call__(self, in_data):
-        img, bbox, label = in_data
-        mb_loc, mb_label = self.coder.encode(bbox, label)
-        return img, mb_loc, mb_label
+    def __call__(self, batch, device=None):
+        imgs, bboxes, labels = chainer.dataset.concat_examples(batch, device)
+        mb_locs, mb_labels = self.coder.encode_batch(bboxes, labels)
+        return imgs, mb_locs, mb_labels
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--channel', type=int, default=DEFAULT_CHANNEL)
-    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
-    parser.add_argument('--epoch', type=int, default=DEFAULT_EPOCH)
-    parser.add_argument('--frequency', type=int, default=DEFAULT_FREQUENCY)
-    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA)
-    parser.add_argument('--opt', choices=('adam', 'adabound', 'amsgrad', 'amsbound'),
-        default=DEFAULT_OPTIMIZER)
-    parser.add_argument('--gpu', type=int, default=-1)
-    parser.add_argument('--model', default='model')
-    parser.add_argument('--resume', action='store_true', default=False)
-    parser.add_argument('--retrain', action='store_true', default=False)
-    args = parser.parse_args()
+class EncodedDataset(chainer.dataset.DatasetMixin):
+    # pairs the images with the precomputed (mb_loc, mb_label) targets
+    def __init__(self, dataset, mb_locs, mb_labels):
+        self._dataset = dataset
+        self._mb_locs = mb_locs
+        self._mb_labels = mb_labels
 
-    if args.resume and args.retrain:
-        print('--resume and --retrain are exclusive')
-        exit(1)
+    def __len__(self):
+        return len(self._dataset)
 
-    dataset = Dataset(DEFAULT_DATASET_DIR)
-    n_data = len(dataset)
-    thresh = int(n_data * 0.9 + 0.5)
-    print("{} records found in the dataset. {} records will be used for training".format(n_data, thresh))
+    def get_example(self, i):
+        img, _, _ = self._dataset.get_example(i)
+        return img, self._mb_locs[i], self._mb_labels[i]
 
+def train_model(args, comm, dataset, split, n_channel, out_dir):
+    # trains an SSD of the given width on the (training, validation)
+    # indices of dataset and saves it in out_dir
+    is_master = comm is None or comm.rank == 0
+    batchsize = args.batchsize // comm.size if comm is not None else args.batchsize
+    if comm is not None:
+        import chainermn
+    n_data = len(dataset)
+    train_index, test_index = split
+    thresh = len(train_index)
     n_class = dataset.n_class
-    class_ids = dataset.class_ids
     class_labels = dataset.class_labels
 
-    model = SSD(n_class=n_class, n_channel=args.channel,
+    model = SSD(n_class=n_class, n_channel=n_channel,
                 grids=DEFAULT_GRIDS, aspect_ratios=DEFAULT_ASPECT_RATIOS,
                 nms_thresh=DEFAULT_NMS_THRESH, score_thresh=DEFAULT_SCORE_THRESH,
                 variance=DEFAULT_VARIANCE)
-    train_chain = MultiboxTrainChain(model)
+    train_chain = MultiboxTrainChain(model, comm=comm, fused=args.fused_loss)
     if args.gpu >= 0:
         chainer.cuda.get_device_from_id(args.gpu).use()
         model.to_gpu()
 
-    train = TransformDataset(dataset[:thresh], Transform(model.coder))
-    train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
+    if args.target_cache:
+        if comm is not None and not is_master:
+            comm.mpi_comm.Barrier()
+        mb_locs, mb_labels = load_targets(DEFAULT_DATASET_DIR, dataset.bboxes, dataset.labels, model.coder)
+        if comm is not None and is_master:
+            comm.mpi_comm.Barrier()
+        train = EncodedDataset(dataset, mb_locs, mb_labels)
+        converter = chainer.dataset.concat_examples
+    else:
+        train = dataset
+        converter = MultiboxConverter(model.coder)
 
-    test = dataset[thresh:]
-    test_iter = chainer.iterators.SerialIterator(test, args.batchsize, repeat=False, shuffle=False)
+    if comm is None:
+        order = np.concatenate([train_index, test_index])
+        train = chainer.datasets.SubDataset(train, 0, thresh, order=order)
+        test = chainer.datasets.SubDataset(dataset, thresh, n_data, order=order)
+    else:
+        # every process maps the whole dataset, so only the index ranges
+        # are scattered; the training part is shuffled first
+        order = None
+        if is_master:
+            order = np.concatenate([np.random.permutation(train_index), test_index])
+        order = comm.bcast_obj(order)
+        begin, end = chainermn.scatter_index(thresh, comm)
+        train = chainer.datasets.SubDataset(train, begin, end, order=order)
+        begin, end = chainermn.scatter_index(n_data - thresh, comm)
+        test = chainer.datasets.SubDataset(dataset, thresh + begin, thresh + end, order=order)
+
+    if args.loaderjob > 0:
+        train_iter = chainer.iterators.MultiprocessIterator(train, batchsize, n_processes=args.loaderjob)
+    else:
+        train_iter = chainer.iterators.SerialIterator(train, batchsize)
+    test_iter = chainer.iterators.SerialIterator(test, batchsize, repeat=False, shuffle=False)
 
     # ('adam', 'adabound', 'amsgrad', 'amsbound')
     if args.opt == 'adam':
@@ -110,63 +140,156 @@ def main():
         raise ValueExcept('invalid optimizer')
 
     optimizer = chainer.optimizers.Adam(alpha=args.alpha, adabound=adabound, amsgrad=amsgrad)
+    if comm is not None:
+        # gradients are averaged over the processes before every update
+        optimizer = chainermn.create_multi_node_optimizer(optimizer, comm)
     optimizer.setup(train_chain)
 
     updater = training.updaters.StandardUpdater(
-        train_iter, optimizer, device=args.gpu)
-    trainer = training.Trainer(updater, (args.epoch, 'epoch'), args.model)
+        train_iter, optimizer, converter=converter, device=args.gpu)
+    trainer = training.Trainer(updater, (args.epoch, 'epoch'), out_dir)
 
-    log_interval = 1, 'epoch'
-    trainer.extend(extensions.LogReport(trigger=log_interval))
-    trainer.extend(extensions.observe_lr(), trigger=log_interval)
-    trainer.extend(extensions.PrintReport(
-        ['epoch', 'iteration', 'lr',
-         'main/loss', 'main/loss/loc', 'main/loss/conf',
-         'validation/main/acc',
-         'elapsed_time']),
-        trigger=log_interval)
-    trainer.extend(extensions.ProgressBar(update_interval=5))
+    # in the data-parallel mode the details in the evaluation log cover the
+    # master's share of the validation data
+    evaluator = Evaluator(test_iter, model, label_names=class_labels, device=args.gpu,
+        log_name='evaluation' if is_master else None)
+    if comm is not None:
+        evaluator = chainermn.create_multi_node_evaluator(evaluator, comm)
+    trainer.extend(evaluator)
 
-    trainer.extend(Evaluator(test_iter, model, device=args.gpu))
+    if is_master:
+        log_interval = 1, 'epoch'
+        trainer.extend(extensions.LogReport(trigger=log_interval))
+        trainer.extend(extensions.observe_lr(), trigger=log_interval)
+        trainer.extend(extensions.PrintReport(
+            ['epoch', 'iteration', 'lr',
+             'main/loss', 'main/loss/loc', 'main/loss/conf',
+             'validation/main/acc', 'validation/main/acc/char',
+             'elapsed_time']),
+            trigger=log_interval)
+        trainer.extend(extensions.ProgressBar(update_interval=5))
 
-    trainer.extend(extensions.snapshot(filename='snapshot_epoch_{.updater.epoch}'),
-        trigger=(args.frequency, 'epoch'))
+        trainer.extend(extensions.snapshot(filename='snapshot_epoch_{.updater.epoch}'),
+            trigger=(args.frequency, 'epoch'))
 
-    trainer.extend(extensions.PlotReport(['main/loss', 'main/loss/loc', 'main/loss/conf'],
-        x_key='epoch', file_name='loss.png'))
+        trainer.extend(extensions.PlotReport(['main/loss', 'main/loss/loc', 'main/loss/conf'],
+            x_key='epoch', file_name='loss.png'))
 
-    model_file = os.path.join(args.model, "model.npz")
+    model_file = os.path.join(out_dir, "model.npz")
     if args.retrain:
-        if not os.path.isfile(model_file):
-            print("{}: not found".format(model_file))
-            exit(1)
         print("Loading pretrained model from {}...".format(model_file))
         chainer.serializers.load_npz(model_file, model)
     
     if args.resume:
         maxnum = -1
-        for s in glob.glob(os.path.join(args.model, "snapshot_epoch_*")):
+        for s in glob.glob(os.path.join(out_dir, "snapshot_epoch_*")):
             m = re.search('[0-9]+$', s)
             if m:
                 maxnum = max(maxnum, int(m.group(0)))
         if maxnum < 0:
             print("No snapshot file found. Ignore --resume option")
         else:
-            snapshot_file = os.path.join(args.model, "snapshot_epoch_{}".format(maxnum))
+            snapshot_file = os.path.join(out_dir, "snapshot_epoch_{}".format(maxnum))
             print("Loading the snapshot data from {}.".format(snapshot_file))
             chainer.serializers.load_npz(snapshot_file, trainer)
 
     trainer.run()
+    if not is_master:
+        return None
 
     print("Saving the model to {}.".format(model_file))
     chainer.serializers.save_npz(model_file, model)
 
-    metadata = { 'file': "model.npz", 'n_channel': args.channel,
-        'n_class': n_class, 'class_labels': class_labels }
-    with open(os.path.join(args.model, "model.json"), "w") as fp:
+    metadata = { 'file': "model.npz", 'formats': ['npz'], 'n_channel': n_channel,
+        'n_class': n_class, 'class_labels': class_labels,
+        'split': { 'mode': args.split, 'radius': args.split_radius } }
+    with open(os.path.join(out_dir, "model.json"), "w") as fp:
         json.dump(metadata, fp, sort_keys=True)
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channel', type=int, default=DEFAULT_CHANNEL)
+    parser.add_argument('--batchsize', type=int, default=DEFAULT_BATCHSIZE)
+    parser.add_argument('--epoch', type=int, default=DEFAULT_EPOCH)
+    parser.add_argument('--frequency', type=int, default=DEFAULT_FREQUENCY)
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA)
+    parser.add_argument('--opt', choices=('adam', 'adabound', 'amsgrad', 'amsbound'),
+        default=DEFAULT_OPTIMIZER)
+    parser.add_argument('--gpu', type=int, default=-1)
+    parser.add_argument('--model', default='model')
+    parser.add_argument('--resume', action='store_true', default=False)
+    parser.add_argument('--retrain', action='store_true', default=False)
+    parser.add_argument('--no-target-cache', dest='target_cache', action='store_false', default=True)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--fused-loss', dest='fused_loss', action='store_true', default=False,
+        help='compute the confidence loss only for the positive and hard negative boxes')
+    parser.add_argument('--loaderjob', type=int, default=0,
+        help='number of processes that load the minibatches (default=0: load them in the training process)')
+    parser.add_argument('--communicator', default=None,
+        help='train data-parallel with a ChainerMN communicator (e.g. naive, pure_nccl) under mpiexec')
+    parser.add_argument('--cascade-channel', dest='cascade_channel', type=int, default=None, metavar='N',
+        help='also train a model with N channels in MODEL/{} for the cascade of solve.py'.format(CASCADE_DIR))
+    parser.add_argument('--split', choices=SPLIT_MODES, default='fixed',
+        help='fixed: validate on the last 10%% of the records, group: keep near-identical images on one side')
+    parser.add_argument('--split-radius', dest='split_radius', type=int, default=DEFAULT_RADIUS,
+        help='largest Hamming distance of the perceptual hashes of near-identical images (default={})'.format(DEFAULT_RADIUS))
+    args = parser.parse_args()
+
+    if args.resume and args.retrain:
+        print('--resume and --retrain are exclusive')
+        exit(1)
+    if args.retrain:
+        # every pretrained model is checked before any of them is trained
+        model_dirs = [ args.model ] + ([ os.path.join(args.model, CASCADE_DIR) ] if args.cascade_channel else [])
+        for model_file in [ os.path.join(d, "model.npz") for d in model_dirs ]:
+            if not os.path.isfile(model_file):
+                print("{}: not found".format(model_file))
+                exit(1)
+
+    if args.communicator:
+        import chainermn
+        comm = chainermn.create_communicator(args.communicator)
+        if args.gpu >= 0:
+            args.gpu = comm.intra_rank
+        if args.batchsize % comm.size != 0:
+            print('--batchsize must be a multiple of the number of processes ({})'.format(comm.size))
+            exit(1)
+    else:
+        comm = None
+    is_master = comm is None or comm.rank == 0
+
+    # the pack and the target cache are written by the master and then
+    # memory-mapped by every process
+    if comm is not None:
+        if is_master:
+            build_pack(DEFAULT_DATASET_DIR, jobs=args.jobs)
+        comm.mpi_comm.Barrier()
+    dataset = Dataset(DEFAULT_DATASET_DIR, jobs=args.jobs)
+    n_data = len(dataset)
+    split = None
+    if is_master:
+        split = dataset.split(mode=args.split, radius=args.split_radius)
+        print("{} records found in the dataset. {} records will be used for training".format(n_data, len(split[0])))
+    if comm is not None:
+        split = comm.bcast_obj(split)
+
+    train_model(args, comm, dataset, split, args.channel, args.model)
 
-    return
+    # the reduced-width model of the cascade in solve.py
+    if args.cascade_channel:
+        small_dir = os.path.join(args.model, CASCADE_DIR)
+        if is_master:
+            print("Training the cascade model with {} channels in {}.".format(args.cascade_channel, small_dir))
+        train_model(args, comm, dataset, split, args.cascade_channel, small_dir)
+        if is_master:
+            metadata_file = os.path.join(args.model, "model.json")
+            with open(metadata_file, "r") as fp:
+                metadata = json.load(fp)
+            metadata['cascade'] = { 'dir': CASCADE_DIR, 'n_channel': args.cascade_channel }
+            with open(metadata_file, "w") as fp:
+                json.dump(metadata, fp, sort_keys=True)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,58 @@
+import json, struct
+import numpy as np
+
+# Layout of a weight file:
+#   8 bytes   magic
+#   8 bytes   header length (little endian)
+#   header    JSON { name: { "dtype": ..., "shape": [...], "offset": ... } }
+#   padding   up to the next multiple of ALIGNMENT
+#   arrays    raw C-order data
+# Offsets are counted from the start of the array section and are
+# multiples of ALIGNMENT, so every array is aligned in the file.
+
+MAGIC = b'SSDW0001'
+ALIGNMENT = 64
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_weights(filename, params):
+    arrays = { name: np.ascontiguousarray(a) for name, a in params.items() }
+    header = {}
+    offset = 0
+    for name in sorted(arrays.keys()):
+        a = arrays[name]
+        header[name] = { 'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset }
+        offset = _align(offset + a.nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    with open(filename, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<Q', len(header_bytes)))
+        fp.write(header_bytes)
+        for name in sorted(arrays.keys()):
+            fp.write(b'\0' * (data_start + header[name]['offset'] - fp.tell()))
+            fp.write(arrays[name].tobytes())
+
+def load_weights(filename):
+    # Returns { name: array } of read-only views into one shared memory map
+    # of the file; pages are read only when an array is used.
+    with open(filename, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{}: not a weight file".format(filename))
+        header_size, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_size).decode('utf-8'))
+    data_start = _align(len(MAGIC) + 8 + header_size)
+
+    buf = np.memmap(filename, dtype=np.uint8, mode='r')
+    params = {}
+    for name, info in header.items():
+        count = 1
+        for n in info['shape']:
+            count *= n
+        params[name] = np.frombuffer(buf, dtype=np.dtype(info['dtype']), count=count,
+            offset=data_start + info['offset']).reshape(info['shape'])
+    return params
+
+# weights.py